@@ -0,0 +1,75 @@
+"""
+Per-message CPU cost of turning a large HTML newsletter into body text.
+
+Compares the old approach (a fresh html2text.HTML2Text per part, full
+conversion, then truncation) against textextract.html_to_text().
+
+    python benchmarks/bench_html_to_text.py [--size-kb 150] [--runs 50]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import html2text
+import textextract
+
+LIMIT = 1500
+
+
+def make_newsletter(size_kb):
+    """Table-layout marketing HTML with a big <style> block, roughly size_kb KB."""
+    css = "".join(f".c{i}{{color:#{i * 997:06x};padding:4px}}" for i in range(400))
+    head = f"<html><head><style>{css}</style></head><body>"
+    row = (
+        '<table width="100%%" cellpadding="0"><tr><td class="c1">'
+        '<a href="https://shop.example.com/deal/%d?utm_source=newsletter">Deal %d</a>'
+        " - Save up to 40%% on selected items this week only.</td>"
+        '<td><img src="https://cdn.example.com/%d.png" alt="product"></td></tr></table>\n'
+    )
+    rows, i = [], 0
+    while len(head) + sum(map(len, rows)) < size_kb * 1024:
+        rows.append(row % (i, i, i))
+        i += 1
+    footer = "<p>Unsubscribe | Privacy Policy | View in browser</p></body></html>"
+    return head + "".join(rows) + footer
+
+
+def old_clean(html):
+    h = html2text.HTML2Text()
+    h.ignore_links = True
+    return h.handle(html)[:LIMIT]
+
+
+def new_clean(html):
+    return textextract.html_to_text(html, LIMIT, ignore_links=True)[:LIMIT]
+
+
+def bench(fn, html, runs):
+    fn(html)  # Warm-up
+    start = time.process_time()
+    for _ in range(runs):
+        fn(html)
+    return (time.process_time() - start) / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size-kb", type=int, default=150)
+    parser.add_argument("--runs", type=int, default=50)
+    args = parser.parse_args()
+
+    html = make_newsletter(args.size_kb)
+    old = bench(old_clean, html, args.runs)
+    new = bench(new_clean, html, args.runs)
+
+    print(f"Newsletter size: {len(html) / 1024:.0f} KB, {args.runs} runs")
+    print(f"  fresh HTML2Text, full convert: {old * 1000:8.2f} ms/message")
+    print(f"  textextract.html_to_text:      {new * 1000:8.2f} ms/message")
+    print(f"  speed-up: {old / new:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
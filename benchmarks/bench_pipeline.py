@@ -0,0 +1,179 @@
+"""
+Per-stage throughput of gatekeeper.py on a synthetic corpus.
+
+Generates a corpus with synthcorpus (personal mail, HTML newsletters,
+large attachments, legacy charsets) and times each stage on its own:
+
+    parse        email.message_from_bytes()
+    clean_body   gatekeeper.clean_email_body()
+    heuristics   gatekeeper.is_bot_or_transactional()
+    llm          gatekeeper.llm_analysis_batch() against a mocked API
+                 (empty cache), in the chunks scan_inbox() uses
+    llm_cached   the same again, now answered from the cache
+
+For each stage: messages/sec, p50/p99 latency (per message; per chunk
+for the LLM stages) and the process's peak RSS once the stage is done
+(the corpus itself is included). --json writes the results with the
+commit they were measured on; --baseline compares against such a file.
+
+    python benchmarks/bench_pipeline.py [--count 2000] [--mix personal=40,...] [--json out.json] [--baseline old.json]
+"""
+import argparse
+import email
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import decision
+import gatekeeper
+import llmclient
+import synthcorpus
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024  # bytes on macOS, KB elsewhere
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def timed(fn, items):
+    """Runs fn(item) for every item. Returns (results, per-item seconds, total seconds)."""
+    results, latencies = [], []
+    start = time.perf_counter()
+    for item in items:
+        t = time.perf_counter()
+        results.append(fn(item))
+        latencies.append(time.perf_counter() - t)
+    return results, latencies, time.perf_counter() - start
+
+
+def fake_complete(prompt, model, api_key, limiter=None, output_tokens=None, latency=0.0):
+    """Stands in for llmclient.complete(): a valid answer for batch and single prompts."""
+    if latency:
+        time.sleep(latency)
+    ids = re.findall(r'"id": (\d+)', prompt)
+    if ids:
+        return json.dumps([{"id": int(i), "verdict": "HUMAN", "reason": "benchmark"} for i in ids])
+    return "TYPE: HUMAN\nREASON: benchmark"
+
+
+def stage_result(messages, latencies, seconds, unit="message"):
+    return {
+        "messages": messages,
+        "seconds": round(seconds, 4),
+        "msgs_per_sec": round(messages / seconds, 1) if seconds else None,
+        "latency_unit": unit,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "peak_rss_mb": round(peak_rss_mb(), 1) if resource else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    corpus = list(synthcorpus.generate(args.count, args.mix, args.seed, args.html_kb, args.attachment_kb))
+    raw = [r for _, r in corpus]
+    stages = {}
+
+    msgs, lat, secs = timed(email.message_from_bytes, raw)
+    stages["parse"] = stage_result(len(raw), lat, secs)
+
+    bodies, lat, secs = timed(gatekeeper.clean_email_body, msgs)
+    stages["clean_body"] = stage_result(len(msgs), lat, secs)
+
+    subjects = [decision.decode_subject(m) for m in msgs]
+    _, lat, secs = timed(lambda i: gatekeeper.is_bot_or_transactional(msgs[i], subjects[i], bodies[i]), range(len(msgs)))
+    stages["heuristics"] = stage_result(len(msgs), lat, secs)
+
+    # Mocked API, no rate limit, fresh cache: measures prompt building,
+    # threading, reply parsing and cache writes, plus --llm-latency-ms per call
+    llmclient.complete = lambda *a, **kw: fake_complete(*a, latency=args.llm_latency_ms / 1000, **kw)
+    gatekeeper.LLM_REQUESTS_PER_MINUTE = gatekeeper.LLM_TOKENS_PER_MINUTE = 10 ** 9
+    emails = list(zip(subjects, bodies))
+    chunk = gatekeeper.LLM_BATCH_SIZE * gatekeeper.LLM_CONCURRENCY
+    chunks = [emails[i:i + chunk] for i in range(0, len(emails), chunk)]
+    with tempfile.TemporaryDirectory() as tmp:
+        gatekeeper.LLM_CACHE_FILE = os.path.join(tmp, "llm_cache.sqlite3")
+        for name in ("llm", "llm_cached"):
+            _, lat, secs = timed(gatekeeper.llm_analysis_batch, chunks)
+            stages[name] = stage_result(len(emails), lat, secs, unit=f"chunk of {chunk}")
+
+    kinds = {}
+    for kind, r in corpus:
+        kinds[kind] = kinds.get(kind, 0) + 1
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {"count": args.count, "mix": args.mix, "seed": args.seed, "html_kb": args.html_kb,
+                   "attachment_kb": args.attachment_kb, "llm_latency_ms": args.llm_latency_ms,
+                   "corpus_mb": round(sum(map(len, raw)) / 1024 / 1024, 1), "kinds": kinds},
+        "stages": stages,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=2000)
+    parser.add_argument("--mix", default=synthcorpus.DEFAULT_MIX)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--html-kb", type=int, default=synthcorpus.DEFAULT_HTML_KB)
+    parser.add_argument("--attachment-kb", type=int, default=synthcorpus.DEFAULT_ATTACHMENT_KB)
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0, help="Simulated API latency per request")
+    parser.add_argument("--json", metavar="PATH", help="Write the results as JSON")
+    parser.add_argument("--baseline", metavar="PATH", help="Earlier --json output to compare against")
+    args = parser.parse_args()
+
+    results = run(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["stages"]
+
+    params = results["params"]
+    print(f"{params['count']} messages ({params['corpus_mb']} MB: "
+          + ", ".join(f"{n} {k}" for k, n in sorted(params["kinds"].items())) + f") at {results['commit']}")
+    print(f"  {'stage':<12} {'msgs/sec':>10} {'p50 ms':>9} {'p99 ms':>9} {'peak RSS':>9}")
+    for name, s in results["stages"].items():
+        line = (f"  {name:<12} {s['msgs_per_sec']:>10,.0f} {s['p50_ms']:>9.3f} {s['p99_ms']:>9.3f}"
+                f" {s['peak_rss_mb'] or 0:>6.0f} MB")
+        if baseline and name in baseline and baseline[name]["msgs_per_sec"]:
+            line += f"   {s['msgs_per_sec'] / baseline[name]['msgs_per_sec']:.2f}x vs baseline"
+        if s["latency_unit"] != "message":
+            line += f"   (latency per {s['latency_unit']})"
+        print(line)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Startup cost of the scripts: interpreter start to the first IMAP command.
+
+Each run starts a fresh interpreter with -X importtime, replaces
+imaplib.IMAP4_SSL with a stub that ends the process on the first
+connection attempt, and times it from the parent. Prints the median and
+worst run per script plus the slowest top-level imports, which is what
+short cron runs pay for before any mail is read.
+
+    python benchmarks/bench_startup.py [--runs 10] [--top 8] [script.py ...]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = ["gatekeeper.py", "gatekeeperwithmemory.py", "test1.py", "test2.py"]
+
+# Runs the script as __main__ until it opens its IMAP connection
+CHILD = r"""
+import imaplib, os, runpy, sys, time
+def first_command(*args, **kwargs):
+    print(f"FIRST_IMAP {time.time()}", flush=True)
+    os._exit(0)
+imaplib.IMAP4_SSL = first_command
+script = sys.argv[1]
+sys.path.insert(0, os.path.dirname(script))
+sys.argv = [script]
+runpy.run_path(script, run_name="__main__")
+"""
+
+
+def run_once(script, workdir):
+    """Returns (seconds to first IMAP command, {top-level module: cumulative µs})."""
+    start = time.time()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHILD, os.path.join(REPO, script)],
+        cwd=workdir, capture_output=True, text=True,
+    )
+    marks = [line for line in proc.stdout.splitlines() if line.startswith("FIRST_IMAP ")]
+    if not marks:
+        raise RuntimeError(f"{script} never reached IMAP:\n{proc.stdout}\n{proc.stderr[-2000:]}")
+    elapsed = float(marks[0].split()[1]) - start
+
+    imports = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue  # Header line
+        if len(name) - len(name.lstrip()) == 1:  # Top level, imported by the script itself
+            imports[name.strip()] = int(cumulative)
+    return elapsed, imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("scripts", nargs="*", default=SCRIPTS)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=8, help="Slowest imports to list per script")
+    args = parser.parse_args()
+
+    # Scratch directory, so state/log files a script might create don't land in the repo
+    with tempfile.TemporaryDirectory() as workdir:
+        for script in args.scripts:
+            run_once(script, workdir)  # Warm-up (page cache, .pyc files)
+            times, imports = [], {}
+            for _ in range(args.runs):
+                elapsed, imports = run_once(script, workdir)
+                times.append(elapsed)
+
+            print(f"{script}: time to first IMAP command over {args.runs} runs")
+            print(f"  median {statistics.median(times) * 1000:7.1f} ms   worst {max(times) * 1000:7.1f} ms")
+            for name, micros in sorted(imports.items(), key=lambda kv: -kv[1])[:args.top]:
+                print(f"    {micros / 1000:7.1f} ms  import {name}")
+
+
+if __name__ == "__main__":
+    main()
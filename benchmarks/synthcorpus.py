@@ -0,0 +1,188 @@
+"""
+Synthetic mail corpus for benchmarks and replays.
+
+Generates a reproducible mix of the mail the gatekeeper actually sees:
+
+    personal     short plain-text mail from people
+    newsletter   table-layout HTML marketing mail with List-Unsubscribe
+    attachment   a short note with a large base64 attachment
+    charset      personal mail in legacy charsets (Latin-1, KOI8-R,
+                 Shift_JIS, GB2312), encoded-word subjects, QP/base64 bodies
+
+    python benchmarks/synthcorpus.py --count 5000 --out corpus.mbox
+    python benchmarks/synthcorpus.py --count 500 --mix newsletter=1 --out eml_dir/
+    python gatekeeper.py --replay corpus.mbox
+"""
+import argparse
+import os
+import random
+from datetime import datetime, timedelta, timezone
+from email.header import Header
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import format_datetime, make_msgid
+
+KINDS = ("personal", "newsletter", "attachment", "charset")
+DEFAULT_MIX = "personal=40,newsletter=35,attachment=15,charset=10"
+DEFAULT_HTML_KB = 60
+DEFAULT_ATTACHMENT_KB = 500
+
+FIRST_NAMES = ["Anna", "Ben", "Chloe", "David", "Emma", "Farid", "Grace", "Hiro", "Ines", "Jonas", "Kate", "Liam"]
+LAST_NAMES = ["Meyer", "Okafor", "Silva", "Nguyen", "Rossi", "Kowalski", "Smith", "Tanaka", "Dubois", "Jensen"]
+FREEMAIL = ["gmail.com", "outlook.com", "yahoo.com", "icloud.com", "posteo.de"]
+SHOPS = ["shopx.com", "dealsdaily.io", "mega-store.net", "travelfinds.com", "newsletter.example.org"]
+PERSONAL_LINES = [
+    "Are we still on for lunch on Thursday?",
+    "I attached the notes from yesterday, let me know what you think.",
+    "Can you send me the address again? I lost the text.",
+    "The kids loved the trip, thanks again for organising it.",
+    "Quick question about the project plan before I send it on.",
+    "Running ten minutes late, start without me.",
+    "Did you get a chance to look at the flat listing?",
+    "Happy birthday! Hope you have a great day.",
+]
+SUBJECTS = ["lunch?", "quick question", "notes from yesterday", "re: weekend plans", "flat viewing", "hello!"]
+DEALS = ["Save up to 40% on selected items", "Free shipping this week only", "Your exclusive member offer",
+         "Last chance: prices drop at midnight", "New arrivals picked for you"]
+CHARSET_TEXTS = {
+    "iso-8859-1": ("Réunion demain", "Bonjour, la réunion de demain est déplacée à 14h. À bientôt, Zoë"),
+    "koi8-r": ("Встреча завтра", "Привет! Встреча завтра переносится на два часа. До встречи."),
+    "shift_jis": ("明日の会議", "こんにちは。明日の会議は午後二時に変更になりました。よろしくお願いします。"),
+    "gb2312": ("明天的会议", "你好，明天的会议改到下午两点。谢谢。"),
+}
+
+
+def parse_mix(spec):
+    """'personal=40,newsletter=35' -> {kind: weight}; unknown kinds are an error."""
+    mix = {}
+    for item in spec.split(","):
+        kind, _, weight = item.partition("=")
+        kind = kind.strip()
+        if kind not in KINDS:
+            raise ValueError(f"Unknown message kind {kind!r} (choose from {', '.join(KINDS)})")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def _person(rng):
+    first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    return f"{first} {last}", f"{first}.{last}{rng.randint(1, 99)}@{rng.choice(FREEMAIL)}".lower()
+
+
+def _headers(msg, rng, i, name, address, subject):
+    msg["From"] = f"{name} <{address}>"
+    msg["To"] = "me@example.com"
+    msg["Subject"] = subject
+    msg["Date"] = format_datetime(datetime(2025, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=17 * i))
+    msg["Message-ID"] = make_msgid(idstring=str(i), domain=address.rpartition("@")[2])
+    return msg
+
+
+def personal(rng, i):
+    name, address = _person(rng)
+    body = "\n\n".join(rng.sample(PERSONAL_LINES, rng.randint(1, 4))) + f"\n\n{name.split()[0]}\n"
+    return _headers(MIMEText(body, "plain", "utf-8"), rng, i, name, address, rng.choice(SUBJECTS))
+
+
+def newsletter(rng, i, html_kb=DEFAULT_HTML_KB):
+    shop = rng.choice(SHOPS)
+    css = "".join(f".c{n}{{color:#{n * 997:06x};padding:4px}}" for n in range(rng.randint(50, 400)))
+    rows, size, n = [], 0, 0
+    while size < html_kb * 1024:
+        row = (f'<table width="100%" cellpadding="0"><tr><td class="c{n % 50}">'
+               f'<a href="https://{shop}/deal/{n}?utm_source=newsletter&amp;utm_campaign={i}">{rng.choice(DEALS)}</a>'
+               f'</td><td><img src="https://cdn.{shop}/{n}.png" alt="product"></td></tr></table>\n')
+        rows.append(row)
+        size += len(row)
+        n += 1
+    html = (f"<html><head><style>{css}</style></head><body>{''.join(rows)}"
+            "<p>Unsubscribe | Privacy Policy | View in browser</p></body></html>")
+
+    if rng.random() < 0.5:
+        msg = MIMEText(html, "html", "utf-8")
+    else:
+        msg = MIMEMultipart("alternative")
+        msg.attach(MIMEText(f"{rng.choice(DEALS)}\nView this email in your browser.\nUnsubscribe", "plain", "utf-8"))
+        msg.attach(MIMEText(html, "html", "utf-8"))
+    _headers(msg, rng, i, shop.split(".")[0].title(), f"news@{shop}", f"{rng.choice(DEALS)} ({i})")
+    msg["List-Unsubscribe"] = f"<https://{shop}/unsubscribe?u={i}>"
+    return msg
+
+
+def attachment(rng, i, attachment_kb=DEFAULT_ATTACHMENT_KB):
+    name, address = _person(rng)
+    msg = MIMEMultipart("mixed")
+    msg.attach(MIMEText(f"{rng.choice(PERSONAL_LINES)}\n\n{name.split()[0]}\n", "plain", "utf-8"))
+    payload = rng.getrandbits(attachment_kb * 8192).to_bytes(attachment_kb * 1024, "little")
+    part = MIMEApplication(payload, "pdf")
+    part.add_header("Content-Disposition", "attachment", filename=f"scan_{i}.pdf")
+    msg.attach(part)
+    return _headers(msg, rng, i, name, address, f"scan {i}")
+
+
+def charset(rng, i):
+    name, address = _person(rng)
+    cs = rng.choice(list(CHARSET_TEXTS))
+    subject, text = CHARSET_TEXTS[cs]
+    msg = MIMEText(text + "\n", "plain", cs)
+    return _headers(msg, rng, i, name, address, Header(subject, cs).encode())
+
+
+def generate(count, mix=DEFAULT_MIX, seed=0, html_kb=DEFAULT_HTML_KB, attachment_kb=DEFAULT_ATTACHMENT_KB):
+    """Yields (kind, raw message bytes) for `count` messages, the same ones for the same arguments."""
+    mix = parse_mix(mix) if isinstance(mix, str) else mix
+    rng = random.Random(seed)
+    kinds, weights = zip(*mix.items())
+    for i in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "newsletter":
+            msg = newsletter(rng, i, html_kb)
+        elif kind == "attachment":
+            msg = attachment(rng, i, attachment_kb)
+        elif kind == "charset":
+            msg = charset(rng, i)
+        else:
+            msg = personal(rng, i)
+        yield kind, msg.as_bytes()
+
+
+def write_mbox(messages, path):
+    """Writes raw messages as an mboxrd file ("From " lines in bodies are quoted)."""
+    with open(path, "wb") as f:
+        for raw in messages:
+            f.write(b"From synthcorpus Thu Jan  1 00:00:00 2025\n")
+            for line in raw.splitlines(keepends=True):
+                if line.lstrip(b">").startswith(b"From "):
+                    line = b">" + line
+                f.write(line)
+            f.write(b"\n" if raw.endswith(b"\n") else b"\n\n")
+
+
+def write_eml_dir(messages, path):
+    os.makedirs(path, exist_ok=True)
+    for i, raw in enumerate(messages):
+        with open(os.path.join(path, f"{i:07d}.eml"), "wb") as f:
+            f.write(raw)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Weights per kind (default {DEFAULT_MIX})")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--html-kb", type=int, default=DEFAULT_HTML_KB, help="Size of each newsletter's HTML")
+    parser.add_argument("--attachment-kb", type=int, default=DEFAULT_ATTACHMENT_KB)
+    parser.add_argument("--out", required=True, help="mbox file, or a directory (ending in /) for .eml files")
+    args = parser.parse_args()
+
+    messages = (raw for _, raw in generate(args.count, args.mix, args.seed, args.html_kb, args.attachment_kb))
+    if args.out.endswith(("/", os.sep)) or os.path.isdir(args.out):
+        write_eml_dir(messages, args.out)
+    else:
+        write_mbox(messages, args.out)
+    print(f"Wrote {args.count} messages to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Ledger of challenge emails we have sent and are waiting on.
+
+Each challenge is stored under the Message-ID we gave it. A reply is
+matched through its In-Reply-To / References headers (one indexed lookup
+per referenced id) instead of searching the mailbox for the challenge
+subject, so checking for verifications only costs as much as the new mail
+since the last run. Challenges are retired once verified, or marked
+expired after CHALLENGE_TTL.
+
+The same table doubles as the suppression list: may_challenge() refuses a
+new challenge within CHALLENGE_COOLDOWN of the last one to that address,
+or once it has had MAX_CHALLENGES, so an unverified sender isn't mailed
+again on every run.
+"""
+import re
+import time
+
+from email.utils import make_msgid, parseaddr
+
+import sqlitestore
+
+LEDGER_FILE = "challenges.sqlite3"
+CHALLENGE_TTL = 14 * 24 * 3600  # Seconds a challenge stays answerable
+CHALLENGE_COOLDOWN = 7 * 24 * 3600  # Seconds before the same address may be challenged again
+MAX_CHALLENGES = 3  # Per address, ever (0 = no limit)
+
+_MSGID_RE = re.compile(r"<[^<>\s]+>")
+
+
+def new_message_id(sender_address):
+    """A fresh Message-ID on the sender's domain."""
+    domain = parseaddr(sender_address)[1].rpartition("@")[2] or None
+    return make_msgid(domain=domain)
+
+
+def referenced_ids(msg):
+    """Message-IDs a message replies to, nearest first."""
+    ids = _MSGID_RE.findall(str(msg.get("In-Reply-To", "")))
+    ids += reversed(_MSGID_RE.findall(str(msg.get("References", ""))))
+    return list(dict.fromkeys(ids))
+
+
+class ChallengeLedger(sqlitestore.Store):
+    """SQLite-backed ledger of sent challenges. Safe to share between threads."""
+
+    def __init__(self, path=LEDGER_FILE, ttl=CHALLENGE_TTL):
+        super().__init__(path, [
+            "CREATE TABLE IF NOT EXISTS challenges ("
+            " message_id TEXT PRIMARY KEY, address TEXT NOT NULL,"
+            " sent_at REAL NOT NULL, status TEXT NOT NULL DEFAULT 'pending',"
+            " resolved_at REAL)",
+            "CREATE INDEX IF NOT EXISTS challenges_address ON challenges (address, status)",
+            "CREATE INDEX IF NOT EXISTS challenges_status ON challenges (status, sent_at)",
+        ])
+        self.ttl = ttl
+
+    def record(self, message_id, address):
+        """Remembers a challenge we just sent."""
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO challenges (message_id, address, sent_at) VALUES (?, ?, ?)",
+                (message_id, address.lower(), time.time()),
+            )
+            self._db.commit()
+
+    def record_sent(self, address, message_id):
+        """Dispatcher callback: record() once a queued challenge has actually gone out."""
+        if message_id:
+            self.record(message_id, address)
+
+    def may_challenge(self, address, cooldown=CHALLENGE_COOLDOWN, max_challenges=MAX_CHALLENGES):
+        """
+        Returns (allowed, reason) for sending `address` another challenge.
+        One indexed lookup on the address.
+        """
+        with self._lock:
+            count, last = self._db.execute(
+                "SELECT COUNT(*), MAX(sent_at) FROM challenges WHERE address = ?", (address.lower(),)
+            ).fetchone()
+        if max_challenges and count >= max_challenges:
+            return False, f"already challenged {count} times"
+        if last is not None and time.time() - last < cooldown:
+            return False, f"challenged {(time.time() - last) / 3600:.0f}h ago"
+        return True, ""
+
+    def match(self, msg):
+        """
+        Returns (message_id, address) of the pending, unexpired challenge
+        that `msg` replies to, or None.
+        """
+        ids = referenced_ids(msg)
+        if not ids:
+            return None
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT message_id, address FROM challenges"
+                f" WHERE message_id IN ({','.join('?' * len(ids))}) AND status = 'pending' AND sent_at > ?"
+                f" LIMIT 1",
+                (*ids, time.time() - self.ttl),
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def pending_for(self, address):
+        """The newest pending, unexpired challenge to `address` (for replies without threading headers)."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT message_id, address FROM challenges"
+                " WHERE address = ? AND status = 'pending' AND sent_at > ?"
+                " ORDER BY sent_at DESC LIMIT 1",
+                (address.lower(), time.time() - self.ttl),
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def resolve(self, address, status="verified"):
+        """Retires every pending challenge to `address`."""
+        with self._lock:
+            self._db.execute(
+                "UPDATE challenges SET status = ?, resolved_at = ? WHERE address = ? AND status = 'pending'",
+                (status, time.time(), address.lower()),
+            )
+            self._db.commit()
+
+    def expire(self):
+        """Marks challenges older than the TTL as expired. Returns how many."""
+        now = time.time()
+        with self._lock:
+            cur = self._db.execute(
+                "UPDATE challenges SET status = 'expired', resolved_at = ? WHERE status = 'pending' AND sent_at <= ?",
+                (now, now - self.ttl),
+            )
+            self._db.commit()
+        return cur.rowcount
+
+    def pending_count(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM challenges WHERE status = 'pending'").fetchone()[0]
+
+
+_ledgers = sqlitestore.Registry()
+
+
+def open_ledger(path=LEDGER_FILE):
+    """Returns the process-wide ChallengeLedger for `path`, opening it on first use."""
+    return _ledgers.get(path, lambda: ChallengeLedger(path))
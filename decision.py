@@ -0,0 +1,275 @@
+"""
+The decision pipeline shared by the gatekeepers and the test harnesses.
+
+Each message is wrapped in an Email, which decodes the subject, extracts
+the body and so on only when a stage first asks for it. A Pipeline is a
+list of Stages, each declared with an estimated cost. They run cheapest
+first and the first one to return a Verdict decides, so the later (more
+expensive) ones never run for that message:
+
+    pipeline = decision.Pipeline([
+        decision.Stage("whitelist", 0, whitelisted),
+        decision.Stage("bot_content", 10, bot_by_content, uses_body=True),
+        decision.Stage("llm", 1000, batch=llm_stage),
+    ])
+
+Stages that only read headers (uses_body=False) double as the needs_body()
+hook of header-first fetching. A batched stage, like the LLM, gets all the
+still-undecided messages of a chunk in one call. Stages with equal cost
+keep the order they were declared in, so a cost also fixes precedence:
+give a stage a lower cost than the ones it should overrule.
+
+scan() drives a message source (see mailsource) through a pipeline, one
+step at a time or on the threads of pipeline.py.
+"""
+from collections import namedtuple
+from email.header import decode_header, make_header
+from email.utils import parseaddr
+from functools import cached_property
+
+import metrics
+import pipeline as threaded
+import textextract
+
+BODY_LIMIT = 1500  # Characters of body text the stages get to see
+
+# label is up to the script ("pass", "bot", "human", ...); stage is filled in by the Pipeline
+Verdict = namedtuple("Verdict", "label reason stage", defaults=("",))
+
+
+# --- MESSAGE FIELDS ---
+def extract_email_address(raw_from):
+    """Extracts just the email address from 'Name <email@domain.com>'"""
+    name, addr = parseaddr(raw_from or "")
+    return addr.lower()
+
+
+def decode_subject(msg):
+    """The whole Subject (every encoded word), decoded to str."""
+    try:
+        return str(make_header(decode_header(msg.get("Subject", ""))))
+    except Exception:
+        return str(msg.get("Subject", ""))
+
+
+def _decode_part(part):
+    payload = part.get_payload(decode=True)
+    if not payload:
+        return ""
+    try:
+        return payload.decode(part.get_content_charset() or "utf-8")
+    except LookupError:  # Unknown charset name
+        return payload.decode("utf-8")
+
+
+def clean_email_body(msg, limit=BODY_LIMIT, ignore_links=True):
+    """
+    Text of the message: text/plain parts as they are, text/html converted
+    (see textextract), attachments skipped, in each part's own charset.
+    Stops decoding once `limit` characters are in.
+    """
+    body = ""
+    for part in msg.walk():
+        if len(body) >= limit:
+            break  # Enough text; don't decode the remaining parts
+        if part.is_multipart() or part.get_content_disposition() == "attachment":
+            continue
+        content_type = part.get_content_type()
+        try:
+            if content_type == "text/html":
+                body += textextract.html_to_text(_decode_part(part), limit - len(body), ignore_links=ignore_links)
+            elif content_type == "text/plain" or not msg.is_multipart():
+                body += _decode_part(part)
+        except (UnicodeDecodeError, ValueError):
+            pass  # Undecodable part; the others may still have text
+    return body[:limit].strip()
+
+
+class Email:
+    """One message, with its fields worked out on first use."""
+
+    def __init__(self, key, msg, body_fn=clean_email_body):
+        self.key = key
+        self.msg = msg
+        self._body_fn = body_fn
+        self.results = {}  # Room for stages that record instead of deciding
+
+    @cached_property
+    def raw_sender(self):
+        return self.msg.get("From", "")
+
+    @cached_property
+    def sender(self):
+        return extract_email_address(self.raw_sender)
+
+    @cached_property
+    def subject(self):
+        return decode_subject(self.msg)
+
+    @cached_property
+    def body(self):
+        with metrics.timer("clean_body"):
+            return self._body_fn(self.msg)
+
+
+# --- STAGES ---
+class Stage:
+    """
+    One step of a Pipeline. check(email) returns a Verdict or None (no
+    opinion, ask the next stage); a batched stage has batch(emails) instead,
+    returning one Verdict or None per email.
+    """
+
+    def __init__(self, name, cost, check=None, batch=None, uses_body=False):
+        self.name = name
+        self.cost = cost
+        self.check = check
+        self.batch = batch
+        self.uses_body = uses_body or batch is not None
+
+
+class Pipeline:
+    """Stages sorted by cost; see the module docstring."""
+
+    def __init__(self, stages):
+        self.stages = sorted(stages, key=lambda stage: stage.cost)
+        first_batch = next((i for i, s in enumerate(self.stages) if s.batch is not None), len(self.stages))
+        self._per_email = self.stages[:first_batch]
+        self._chunked = self.stages[first_batch:]
+
+    @property
+    def batched(self):
+        """True if some stages only run on chunks (see finish())."""
+        return bool(self._chunked)
+
+    def _check(self, stage, email):
+        with metrics.timer(stage.name):
+            verdict = stage.check(email)
+        return verdict._replace(stage=stage.name) if verdict is not None else None
+
+    def needs_body(self, msg):
+        """
+        For header-first fetching: False if the header-only stages already
+        decide `msg`, so its body never has to be downloaded.
+        """
+        email = Email(None, msg, None)
+        for stage in self.stages:
+            if stage.uses_body:
+                return True
+            if stage.check(email) is not None:
+                return False
+        return False
+
+    def triage(self, email):
+        """Runs the stages before the first batched one. Returns a Verdict or None."""
+        for stage in self._per_email:
+            verdict = self._check(stage, email)
+            if verdict is not None:
+                return verdict
+        return None
+
+    def finish(self, emails):
+        """
+        Runs the batched stage and everything after it over emails that
+        triage() left undecided, stage by stage so each batched stage sees
+        the whole chunk. Returns one Verdict (None if no stage decided) per email.
+        """
+        verdicts = [None] * len(emails)
+        undecided = list(range(len(emails)))
+        for stage in self._chunked:
+            if not undecided:
+                break
+            if stage.batch is not None:
+                with metrics.timer(stage.name):
+                    found = stage.batch([emails[i] for i in undecided])
+                found = [v._replace(stage=stage.name) if v is not None else None for v in found]
+            else:
+                found = [self._check(stage, emails[i]) for i in undecided]
+            undecided, still = [], undecided
+            for i, verdict in zip(still, found):
+                if verdict is None:
+                    undecided.append(i)
+                else:
+                    verdicts[i] = verdict
+        return verdicts
+
+    def decide(self, emails):
+        """triage() and finish() together, for a list of emails."""
+        verdicts = [self.triage(email) for email in emails]
+        todo = [i for i, verdict in enumerate(verdicts) if verdict is None]
+        for i, verdict in zip(todo, self.finish([emails[i] for i in todo])):
+            verdicts[i] = verdict
+        return verdicts
+
+
+# --- DRIVER ---
+def scan(source, pipeline, write, body_fn=clean_email_body, chunk_size=1, pipelined=False, dispatch=None):
+    """
+    Runs `pipeline` over the messages of `source` and calls
+    write(n, email, verdict) once per message (n counts from 0, verdict is
+    None if no stage decided). Batched stages see chunk_size emails at a
+    time. Returns how many emails were written.
+
+    Serially, emails decided by triage() are written at once and the rest
+    after their chunk. pipelined=True runs fetching, triage, the batched
+    stages and write() on their own threads (see pipeline.py) and writes in
+    source order; the source's mark_processed(key), if it has one, is called
+    as each email is written. dispatch(last) is passed on to pipeline.run().
+    """
+    written = 0
+    messages = source.messages(pipeline.needs_body)
+
+    def emit(n, email, verdict):
+        nonlocal written
+        write(n, email, verdict)
+        written += 1
+
+    if pipelined:
+        mark_processed = getattr(source, "mark_processed", None)
+
+        def classify(n, msg):
+            email = Email(None, msg, body_fn)
+            verdict = pipeline.triage(email)
+            row = [n, email, verdict]
+            return row, (True if verdict is None and pipeline.batched else None)
+
+        def decide(items):
+            rows = [row for row, _ in items]
+            for row, verdict in zip(rows, pipeline.finish([row[1] for row in rows])):
+                row[2] = verdict
+
+        def write_row(key, row):
+            if row is not None:
+                emit(*row)
+            if mark_processed is not None:
+                mark_processed(key)
+
+        threaded.run(messages, classify, decide, write_row, chunk_size, dispatch=dispatch)
+        return written
+
+    pending = []  # (n, email) waiting for the batched stages
+
+    def flush():
+        for (n, email), verdict in zip(pending, pipeline.finish([email for _, email in pending])):
+            emit(n, email, verdict)
+        pending.clear()
+
+    # ("source" is the time spent waiting for the next message)
+    for n, (key, msg) in enumerate(metrics.timed_iter("source", messages)):
+        email = Email(key, msg, body_fn)
+        try:
+            verdict = pipeline.triage(email)
+            if verdict is None and pipeline.batched:
+                pending.append((n, email))
+                # Decide in chunks so a long backfill is logged as it goes
+                if len(pending) >= chunk_size:
+                    flush()
+                continue
+            emit(n, email, verdict)
+        except Exception as e:
+            metrics.error("scan", e)
+            print(f"Error processing email: {e}")
+    flush()
+    if dispatch is not None:
+        dispatch(True)
+    return written
@@ -0,0 +1,226 @@
+"""
+Outbound mail dispatcher.
+
+Challenges are queued in a small SQLite outbox and sent by drain() over
+one authenticated SMTP session (STARTTLS + LOGIN once, not per message),
+which is re-established if the server drops it. Sends are held to a
+per-minute and a per-day budget (Gmail suspends accounts that go over its
+sending limits); whatever doesn't fit today stays queued and goes out
+first on the next run instead of being dropped.
+"""
+import smtplib
+import sqlite3
+import time
+
+import metrics
+import sqlitestore
+
+OUTBOX_FILE = "outbox.sqlite3"
+PER_MINUTE_LIMIT = 20
+PER_DAY_LIMIT = 400  # Gmail allows ~500/day for personal accounts; keep headroom
+MAX_ATTEMPTS = 3  # Transient failures before a message is marked failed
+STALE_CLAIM = 600  # Seconds after which a claim from a crashed process is released
+SMTP_TIMEOUT = 30  # Seconds
+
+
+class SMTPSession:
+    """One lazily opened, reusable SMTP connection."""
+
+    def __init__(self, server, port, user, password, timeout=SMTP_TIMEOUT):
+        self.server = server
+        self.port = port
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self._smtp = None
+
+    def _connect(self):
+        smtp = smtplib.SMTP(self.server, self.port, timeout=self.timeout)
+        try:
+            smtp.starttls()
+            smtp.login(self.user, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        self._smtp = smtp
+
+    def send(self, to_addr, message):
+        """Sends one message, reconnecting once if the session went stale."""
+        if self._smtp is None:
+            self._connect()
+        try:
+            self._smtp.sendmail(self.user, to_addr, message)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            self.close()
+            self._connect()
+            self._smtp.sendmail(self.user, to_addr, message)
+
+    def close(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                self._smtp.close()
+            self._smtp = None
+
+
+class Dispatcher(sqlitestore.Store):
+    """Persistent outbox plus budgeted sending over one SMTPSession."""
+
+    def __init__(self, session, path=OUTBOX_FILE, per_minute=PER_MINUTE_LIMIT, per_day=PER_DAY_LIMIT):
+        super().__init__(path, [
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, to_addr TEXT NOT NULL,"
+            " message_id TEXT, message TEXT NOT NULL, queued_at REAL NOT NULL,"
+            " status TEXT NOT NULL DEFAULT 'queued', attempts INTEGER NOT NULL DEFAULT 0,"
+            " sent_at REAL, error TEXT)",
+            "CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, id)",
+            # At most one queued message per address, even with several processes enqueueing
+            "CREATE UNIQUE INDEX IF NOT EXISTS outbox_one_queued ON outbox (to_addr) WHERE status = 'queued'",
+            "CREATE INDEX IF NOT EXISTS outbox_sent_at ON outbox (sent_at)",
+        ])
+        self.session = session
+        self.per_minute = per_minute
+        self.per_day = per_day
+        # A process that died between claiming and sending leaves 'sending' rows behind.
+        # Where a newer message to the address is queued meanwhile, that one goes instead.
+        stale = time.time() - STALE_CLAIM
+        self._db.execute(
+            "UPDATE outbox SET status = 'superseded', sent_at = NULL WHERE status = 'sending' AND sent_at < ?"
+            " AND to_addr IN (SELECT to_addr FROM outbox WHERE status = 'queued')",
+            (stale,),
+        )
+        self._db.execute(
+            "UPDATE outbox SET status = 'queued', sent_at = NULL WHERE status = 'sending' AND sent_at < ?",
+            (stale,),
+        )
+        self._db.commit()
+
+    def enqueue(self, to_addr, message, message_id=None):
+        """
+        Queues `message` (an email.message.Message) for `to_addr`. Returns
+        False if a message to that address is already waiting.
+        """
+        with self._lock:
+            cur = self._db.execute(
+                "INSERT OR IGNORE INTO outbox (to_addr, message_id, message, queued_at) VALUES (?, ?, ?, ?)",
+                (to_addr.lower(), message_id, message.as_string(), time.time()),
+            )
+            self._db.commit()
+        return cur.rowcount == 1
+
+    def queued_count(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM outbox WHERE status = 'queued'").fetchone()[0]
+
+    def _sent_since(self, since):
+        return self._db.execute("SELECT COUNT(*) FROM outbox WHERE sent_at > ?", (since,)).fetchone()[0]
+
+    def _wait_for_budget(self):
+        """Sleeps out the per-minute window. Returns False if today's budget is spent."""
+        while True:
+            now = time.time()
+            with self._lock:
+                if self._sent_since(now - 86400) >= self.per_day:
+                    return False
+                if self._sent_since(now - 60) < self.per_minute:
+                    return True
+                oldest = self._db.execute(
+                    "SELECT MIN(sent_at) FROM outbox WHERE sent_at > ?", (now - 60,)
+                ).fetchone()[0]
+            time.sleep(max(oldest + 60 - now, 0.1))
+
+    def _claim_next(self):
+        """
+        Atomically takes the oldest queued message for this process (another
+        process draining the same outbox won't get it). Its claim time counts
+        against the budgets like a send. Returns the row or None.
+        """
+        with self._lock:
+            while True:
+                row = self._db.execute(
+                    "SELECT id, to_addr, message_id, message, attempts FROM outbox"
+                    " WHERE status = 'queued' ORDER BY id LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    return None
+                cur = self._db.execute(
+                    "UPDATE outbox SET status = 'sending', sent_at = ? WHERE id = ? AND status = 'queued'",
+                    (time.time(), row[0]),
+                )
+                self._db.commit()
+                if cur.rowcount == 1:
+                    return row
+
+    def drain(self, on_sent=None, close=True):
+        """
+        Sends queued messages oldest first until the queue is empty or the
+        daily budget is used up. `on_sent(to_addr, message_id)` is called
+        after each successful send. close=False leaves the session open for
+        a later drain() (send errors still close it), and only the closing
+        drain reports a spent daily budget. Returns (sent, still_queued).
+        """
+        sent = 0
+        try:
+            while True:
+                if not self._wait_for_budget():
+                    if close and self.queued_count():
+                        print(f"   ⏸️ Daily send budget ({self.per_day}) reached, the rest waits for the next run.")
+                    break
+                row = self._claim_next()
+                if row is None:
+                    break
+
+                row_id, to_addr, message_id, message, attempts = row
+                try:
+                    with metrics.timer("smtp_send"):
+                        self.session.send(to_addr, message)
+                except smtplib.SMTPRecipientsRefused as e:
+                    metrics.error("smtp_send", e)
+                    self._finish(row_id, "failed", error=str(e))
+                    print(f"   [ERROR] {to_addr} refused: {e}")
+                    continue
+                except (smtplib.SMTPException, OSError) as e:
+                    metrics.error("smtp_send", e)
+                    self.session.close()
+                    status = "failed" if attempts + 1 >= MAX_ATTEMPTS else "queued"
+                    self._finish(row_id, status, error=str(e), attempt=True)
+                    print(f"   [ERROR] Sending to {to_addr} failed: {e}")
+                    if status == "queued":
+                        break  # Server trouble; leave the queue for the next run
+                    continue
+
+                self._finish(row_id, "sent", sent_at=time.time())
+                sent += 1
+                metrics.inc("challenges_sent")
+                print(f"   📧 Sent challenge to: {to_addr}")
+                if on_sent is not None:
+                    on_sent(to_addr, message_id)
+        finally:
+            if close:
+                self.session.close()
+        return sent, self.queued_count()
+
+    def _finish(self, row_id, status, sent_at=None, error=None, attempt=False):
+        """
+        Records the outcome of a claimed row. A row put back in the queue
+        while another message to the same address was queued (by another
+        process) is marked 'superseded' instead: that newer one goes out.
+        """
+        update = "UPDATE outbox SET status = ?, sent_at = ?, error = ?, attempts = attempts + ? WHERE id = ?"
+        with self._lock:
+            try:
+                self._db.execute(update, (status, sent_at, error, 1 if attempt else 0, row_id))
+            except sqlite3.IntegrityError:
+                self._db.execute(update, ("superseded", sent_at, error, 1 if attempt else 0, row_id))
+            self._db.commit()
+
+
+_dispatchers = sqlitestore.Registry()
+
+
+def open_dispatcher(server, port, user, password, path=OUTBOX_FILE,
+                    per_minute=PER_MINUTE_LIMIT, per_day=PER_DAY_LIMIT):
+    """Returns the process-wide Dispatcher for `path`, opening it on first use."""
+    return _dispatchers.get(path, lambda: Dispatcher(SMTPSession(server, port, user, password),
+                                                      path, per_minute, per_day))
@@ -1,26 +1,92 @@
 import imaplib
-import smtplib
 import email
-from email.header import decode_header
 from email.mime.text import MIMEText
-from email.utils import parseaddr
-import openai
-import pandas as pd
-import html2text
 import re
+import os
 from datetime import datetime
 import time
+import argparse
+import mailstate
+import mailsource
+import metrics
+import decision
+import imapidle
+import rules
+import llmcache
+import llmclient
+import reputation
+import challenges
+import dispatcher
+import runlog
 
 # ================= CONFIGURATION =================
 # GMAIL SETTINGS
 EMAIL_USER = "your@gmail.com"
 EMAIL_PASS = "" # Not your login password!
 IMAP_SERVER = "imap.gmail.com"
+SMTP_SERVER = "smtp.gmail.com"
+SMTP_PORT = 587
 EMAIL_COUNT = 40  # How many recent emails to test
 
+# INCREMENTAL SCANNING
+# Only process mail that arrived since the last run (tracked by UID in STATE_FILE).
+# EMAIL_COUNT is then only used on the very first run.
+INCREMENTAL = True
+STATE_FILE = "gatekeeper_state.json"
+
 # OPENAI SETTINGS
 OPENAI_API_KEY = "sk-......" # Your OpenAI Key
-openai.api_key = OPENAI_API_KEY
+LLM_MODEL = "gpt-4o-mini"
+LLM_PROMPT_VERSION = "human-check-v2"  # Bump when you edit the prompt (invalidates cached verdicts)
+LLM_BATCH_PROMPT_VERSION = "human-check-batch-v1"
+LLM_BATCH_SIZE = 10  # Emails per request (1 = one request per email)
+LLM_CACHE_FILE = "llm_cache.sqlite3"  # Verdicts are reused across runs
+LLM_CONCURRENCY = 8  # Parallel API requests
+LLM_REQUESTS_PER_MINUTE = 500  # Stay under your account's rate limits
+LLM_TOKENS_PER_MINUTE = 200000
+
+# LOCAL PRE-CLASSIFIER
+# Train with: python preclassifier.py paranoid_spam_test_*.csv
+# Until a model file exists every unknown sender goes to the LLM as before.
+PRECLASSIFIER_FILE = "preclassifier.npz"
+PRECLASSIFIER_BAND = (0.1, 0.9)  # P(spam) inside this band is uncertain -> ask the LLM
+
+# SENDER REPUTATION
+# Verdicts are tallied per address and domain; repeat senders with a
+# consistent history are decided without parsing, fetching or the LLM.
+REPUTATION_FILE = "sender_reputation.sqlite3"
+
+# OUTGOING CHALLENGES
+# Sent over one SMTP session while the scan runs (at the end with
+# PIPELINE = False). Anything over the budgets stays queued in OUTBOX_FILE
+# and goes out first next run.
+OUTBOX_FILE = "outbox.sqlite3"
+SEND_PER_MINUTE = 20
+SEND_PER_DAY = 400  # Gmail's limit is ~500/day
+CHALLENGE_COOLDOWN_DAYS = 7  # Don't challenge the same address again within this
+MAX_CHALLENGES_PER_ADDRESS = 3  # After this many unanswered challenges, stop (0 = no limit)
+CHALLENGE_LEDGER_FILE = "challenges.sqlite3"  # Lets gatekeeperwithmemory.py match the replies
+
+# RUN LOG
+# One row per email, appended as soon as it is decided (CSV, or JSONL if the
+# name ends in .jsonl). strftime codes in the name start a new file per period.
+LOG_FILE = f"gatekeeper_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+DAEMON_LOG_FILE = "gatekeeper_log_%Y%m%d.csv"  # One file per day
+LOG_MAX_BYTES = 50 * 1024 * 1024  # Continue in <name>.1.csv, .2.csv, ... past this size
+LOG_COLUMNS = ["Sender", "Subject", "Action", "Reason"]
+REPLAY_LOG_FILE = f"gatekeeper_replay_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"  # --replay
+
+# PIPELINE
+# Fetching, filtering, the LLM and sending overlap in their own threads (see
+# pipeline.py); rows are still logged in arrival order. False = one step at a time.
+PIPELINE = True
+
+# METRICS
+# Per-stage timings and counters. One-shot runs print a summary table at the
+# end; the file (Prometheus text format) is rewritten after every run.
+METRICS_FILE = "gatekeeper_metrics.prom"  # None to disable
+METRICS_PORT = None  # e.g. 9464: serve http://127.0.0.1:9464/metrics while running --daemon
+PROFILE_DIR = None  # e.g. "profiles": dump a cProfile .prof file per run
 
 # SAFETY SETTING
 DRY_RUN = True  # Set to False to ACTUALLY send challenge emails
@@ -44,94 +110,105 @@ Nick Nguyens Personal Automated Gatekeeper
 """
 # =================================================
 
-def extract_email_address(raw_from):
-    """Extracts just the email address from 'Name <email@domain.com>'"""
-    name, addr = parseaddr(raw_from)
-    return addr.lower()
-
 def clean_email_body(msg):
-    """Extracts and cleans text from email."""
-    body = ""
-    if msg.is_multipart():
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            try:
-                payload = part.get_payload(decode=True)
-                if payload:
-                    if content_type == "text/plain":
-                        body += payload.decode()
-                    elif content_type == "text/html":
-                        h = html2text.HTML2Text()
-                        h.ignore_links = True
-                        body += h.handle(payload.decode())
-            except:
-                pass
-    else:
-        try:
-            payload = msg.get_payload(decode=True)
-            if msg.get_content_type() == "text/html":
-                h = html2text.HTML2Text()
-                body = h.handle(payload.decode())
-            else:
-                body = payload.decode()
-        except:
-            pass
-    return body[:1500].strip()
+    """Extracts and cleans text from email (see decision.clean_email_body)."""
+    return decision.clean_email_body(msg, limit=1500)
 
 def send_challenge(to_email):
-    """Sends the automated challenge response."""
+    """
+    Queues the automated challenge response. send_queued_challenges() sends
+    the queue at the end of the run.
+    """
+    metrics.inc("challenges_queued", dry_run=DRY_RUN)
     if DRY_RUN:
         print(f"   [DRY RUN] Would send challenge email to: {to_email}")
         return True
 
-    try:
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()
-        server.login(EMAIL_USER, EMAIL_PASS)
-        
-        msg = MIMEText(CHALLENGE_BODY.format(name=EMAIL_USER))
-        msg['Subject'] = CHALLENGE_SUBJECT
-        msg['From'] = EMAIL_USER
-        msg['To'] = to_email
-        
-        server.sendmail(EMAIL_USER, to_email, msg.as_string())
-        server.quit()
-        print(f"   [SENT] Challenge email sent to: {to_email}")
-        return True
-    except Exception as e:
-        print(f"   [ERROR] Could not send email: {e}")
-        return False
+    msg = MIMEText(CHALLENGE_BODY.format(name=EMAIL_USER))
+    msg['Subject'] = CHALLENGE_SUBJECT
+    msg['From'] = EMAIL_USER
+    msg['To'] = to_email
+    msg['Message-ID'] = challenges.new_message_id(EMAIL_USER)
+    if get_outbox().enqueue(to_email, msg, msg['Message-ID']):
+        print(f"   [QUEUED] Challenge email to: {to_email}")
+    return True
+
+def may_challenge(to_email):
+    """(allowed, reason) from the challenge ledger: cool-down and per-address cap."""
+    return challenges.open_ledger(CHALLENGE_LEDGER_FILE).may_challenge(
+        to_email, CHALLENGE_COOLDOWN_DAYS * 24 * 3600, MAX_CHALLENGES_PER_ADDRESS)
+
+def get_outbox():
+    return dispatcher.open_dispatcher(SMTP_SERVER, SMTP_PORT, EMAIL_USER, EMAIL_PASS,
+                                      OUTBOX_FILE, SEND_PER_MINUTE, SEND_PER_DAY)
+
+def send_queued_challenges(close=True):
+    """
+    Sends queued challenges (oldest first, including ones deferred by an
+    earlier run) over one SMTP session, within the send budgets.
+    close=False keeps the session open for the next call.
+    """
+    if DRY_RUN:
+        return
+    ledger = challenges.open_ledger(CHALLENGE_LEDGER_FILE)
+    with metrics.timer("send_queue"):
+        sent, waiting = get_outbox().drain(on_sent=ledger.record_sent, close=close)
+    if sent or waiting or close:
+        print(f"Challenges sent: {sent}" + (f", {waiting} deferred to the next run" if waiting else ""))
 
 # --- FILTER LOGIC ---
-def is_bot_or_transactional(msg, subject, body):
+def is_bot_by_technical_headers(msg):
     """
-    Determines if an email is clearly a bot, newsletter, or receipt.
-    We DO NOT want to send challenge emails to bots (backscatter).
+    List-Unsubscribe / Auto-Submitted. Mailing lists add these to posts by
+    people too, so they say nothing about the sender's domain.
     """
     # 1. Technical Headers (Strongest Signal)
     if msg.get("List-Unsubscribe") or msg.get("Auto-Submitted") == 'auto-generated':
         return True, "Technical Header (List-Unsubscribe/Auto)"
+    return False, "Looks Human"
 
-    # 2. Sender Name Checks
-    sender = extract_email_address(msg.get("From", ""))
-    bad_prefixes = ["no-reply", "noreply", "newsletter", "bounce", "notifications", "service", "support"]
-    if any(x in sender for x in bad_prefixes):
-        return True, "Bot Sender Name"
+def is_bot_by_sender(msg):
+    """Sender name checks (patterns in rules.json)."""
+    # 2. Sender Name Checks (patterns in rules.json)
+    sender = decision.extract_email_address(msg.get("From", ""))
+    is_bot, reasons = rules.get_ruleset("bot_filter").matches(sender=sender)
+    if is_bot:
+        return True, reasons[0]
+    return False, "Looks Human"
+
+def is_bot_by_headers(msg):
+    """
+    Header-only part of the bot filter, so it can run before the body is downloaded.
+    """
+    is_bot, reason = is_bot_by_technical_headers(msg)
+    if is_bot:
+        return is_bot, reason
+    return is_bot_by_sender(msg)
 
-    # 3. Content Checks (Heuristic)
+def is_bot_by_content(subject, body):
+    """
+    Content part of the bot filter. Needs the (cleaned) body.
+    """
+    # 3. Content Checks (Heuristic, triggers in rules.json)
     text = (str(subject) + " " + str(body)).lower()
-    bot_triggers = ["unsubscribe", "privacy policy", "view in browser", "receipt", "order confirmation"]
-    if any(t in text for t in bot_triggers):
-        return True, f"Automated Content Trigger"
+    is_bot, reasons = rules.get_ruleset("bot_filter").matches(text=text)
+    if is_bot:
+        return True, reasons[0]
 
     return False, "Looks Human"
 
-def llm_analysis(subject, body):
+def is_bot_or_transactional(msg, subject, body):
     """
-    LLM sanity check.
+    Determines if an email is clearly a bot, newsletter, or receipt.
+    We DO NOT want to send challenge emails to bots (backscatter).
     """
-    client = openai.Client(api_key=OPENAI_API_KEY)
-    prompt = f"""
+    is_bot, reason = is_bot_by_headers(msg)
+    if is_bot:
+        return is_bot, reason
+    return is_bot_by_content(subject, body)
+
+def human_check_prompt(subject, body):
+    return f"""
     Analyze this email.
     Subject: {subject}
     Body: {body}
@@ -142,110 +219,315 @@ def llm_analysis(subject, body):
     Format:
     TYPE: [HUMAN or BOT]
     """
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0
-        )
-        content = response.choices[0].message.content
-        return "HUMAN" in content
-    except:
-        return False
+
+HUMAN_CHECK_INSTRUCTIONS = """
+    For each email, decide whether it is likely from a specific HUMAN being trying to contact the user personally,
+    or a newsletter, receipt, notification, or cold-marketing blast (BOT).
+"""
+
+def human_check():
+    """The LLM check with the current settings. Result: True = human, False = bot."""
+    # Only the TYPE line counts; "HUMAN" in the prose (or an echoed
+    # "[HUMAN or BOT]") used to pass as a human verdict.
+    return llmclient.Classifier(
+        human_check_prompt, HUMAN_CHECK_INSTRUCTIONS, "TYPE", ("HUMAN", "BOT"),
+        lambda label, reason: label == "HUMAN",
+        LLM_MODEL, OPENAI_API_KEY, LLM_PROMPT_VERSION, LLM_BATCH_PROMPT_VERSION, LLM_CACHE_FILE,
+        LLM_BATCH_SIZE, LLM_CONCURRENCY, llmclient.get_limiter(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE)
+    )
+
+def llm_analysis(subject, body):
+    """
+    LLM sanity check. Verdicts are cached on disk (see llmcache).
+    Returns True / False, or None on error (treated as "don't challenge" but not remembered).
+    """
+    return human_check().classify(subject, body)
+
+def llm_analysis_batch(emails):
+    """
+    Same check as llm_analysis() for a list of (subject, body) pairs, sending
+    LLM_BATCH_SIZE emails per request. Returns one bool (None on error) per email, in order.
+    Emails without a valid verdict in the batch reply are asked one by one.
+    """
+    return human_check().classify_many(emails)
+
+def preclassify(raw_sender, subject, body):
+    """
+    Local model verdict: (True = human / False = bot / None = uncertain, p_spam).
+    None also when no model has been trained.
+    """
+    if not os.path.exists(PRECLASSIFIER_FILE):
+        return None, None
+    import preclassifier  # Deferred: pulls in numpy, only worth it once a model is trained
+    model = preclassifier.get_model(PRECLASSIFIER_FILE)
+    if model is None:
+        return None, None
+    verdict, p_spam = model.decide(raw_sender, subject, body, PRECLASSIFIER_BAND)
+    if verdict is None:
+        return None, p_spam
+    return verdict == "HAM", p_spam
 
 # --- MAIN EXECUTION ---
-def main():
+def connect():
+    """Logs in to IMAP and selects the inbox."""
     print("Connecting to Gmail IMAP...")
-    mail = imaplib.IMAP4_SSL(IMAP_SERVER)
-    try:
+    with metrics.timer("imap_connect"):
+        mail = imaplib.IMAP4_SSL(IMAP_SERVER)
         mail.login(EMAIL_USER, EMAIL_PASS)
-    except Exception as e:
-        print(f"Login Failed: {e}")
-        return
-    mail.select("inbox")
-    
-    status, messages = mail.search(None, "ALL")
-    latest_email_ids = messages[0].split()[-EMAIL_COUNT:]
+        mail.select("inbox")
+    return mail
+
+def disconnect(mail):
+    """Closes the mailbox and logs out, ignoring a connection that is already gone."""
+    try:
+        mail.close()
+        mail.logout()
+    except (imaplib.IMAP4.error, OSError):
+        pass
+
+# --- DECISION STAGES ---
+# Cheapest first (see decision.py); the first stage with a verdict decides.
+# Labels: "pass" (whitelisted), "bot", "human" (challenge, reason = where the
+# verdict came from) and "unknown" (LLM unavailable).
+def whitelisted(email):
+    if email.sender in WHITELIST:
+        return decision.Verdict("pass", "Sender in Whitelist")
+
+def sender_reputation(email):
+    """(verdict, reason) from the reputation store, looked up once per email."""
+    if "reputation" not in email.results:
+        email.results["reputation"] = reputation.open_store(REPUTATION_FILE).lookup(email.sender)
+    return email.results["reputation"]
+
+def known_bulk_sender(email):
+    """Sender reputation, bulk side: one indexed lookup settles repeat bulk senders."""
+    verdict, reason = sender_reputation(email)
+    if verdict == "bot":
+        return decision.Verdict("bot", reason)
+
+def known_human_sender(email):
+    """
+    Sender reputation, human side. Runs after the header bot checks, so an
+    address that turned bulk (or was taken over) is still caught by them.
+    """
+    verdict, _ = sender_reputation(email)
+    if verdict == "human":
+        return decision.Verdict("human", "reputation")
+
+def bot_by_headers(email):
+    is_bot, reason = is_bot_by_technical_headers(email.msg)
+    if is_bot:
+        return decision.Verdict("bot", f"Identified as Bot ({reason})")
+
+def bot_by_sender(email):
+    is_bot, reason = is_bot_by_sender(email.msg)
+    if is_bot:
+        return decision.Verdict("bot", f"Identified as Bot ({reason})")
+
+def bot_by_content(email):
+    is_bot, reason = is_bot_by_content(email.subject, email.body)
+    if is_bot:
+        return decision.Verdict("bot", f"Identified as Bot ({reason})")
+
+def local_model(email):
+    """The pre-classifier settles confident cases, the rest goes to the LLM."""
+    is_human, p_spam = preclassify(email.raw_sender, email.subject, email.body)
+    if is_human is False:
+        return decision.Verdict("bot", f"Pre-classifier: likely bot (p={p_spam:.2f})")
+    if is_human:
+        return decision.Verdict("human", "pre-classifier")
+
+def llm_stage(emails):
+    """
+    LLM second opinion on potential humans, to avoid challenging subtle
+    spam: LLM_BATCH_SIZE emails per request, LLM_CONCURRENCY requests at a time.
+    """
+    print(f"\nAsking the LLM about {len(emails)} unknown senders...")
+    verdicts = []
+    for is_human in llm_analysis_batch([(email.subject, email.body) for email in emails]):
+        if is_human is None:
+            verdicts.append(decision.Verdict("unknown", "LLM unavailable, not challenged"))
+        elif is_human:
+            verdicts.append(decision.Verdict("human", ""))
+        else:
+            verdicts.append(decision.Verdict("bot", "LLM identified as subtle spam/marketing"))
+    return verdicts
+
+FILTERS = decision.Pipeline([
+    decision.Stage("whitelist", 0, whitelisted),
+    decision.Stage("reputation_bot", 1, known_bulk_sender),
+    decision.Stage("bot_headers", 2, bot_by_headers),
+    decision.Stage("bot_sender", 2, bot_by_sender),
+    decision.Stage("reputation_human", 3, known_human_sender),
+    decision.Stage("bot_content", 10, bot_by_content, uses_body=True),
+    decision.Stage("preclassifier", 20, local_model, uses_body=True),
+    decision.Stage("llm", 1000, batch=llm_stage),
+])
+
+def act(email, verdict):
+    """Turns a verdict into the action (challenge or not) and the log row."""
+    if verdict.stage in ("bot_headers", "bot_sender", "bot_content", "llm") and verdict.label in ("bot", "human"):
+        # Mailing-list headers say nothing about the domain (see reputation.py)
+        reputation.open_store(REPUTATION_FILE).record(email.sender, is_bot=verdict.label == "bot",
+                                                      domain=verdict.stage != "bot_headers")
+
+    reason = verdict.reason
+    if verdict.label == "pass":
+        action_taken, shown = "PASSED", f"✅ {reason}"
+    elif verdict.label == "human":
+        with metrics.timer("challenge_check"):
+            allowed, suppressed_why = may_challenge(email.sender)
+        if allowed:
+            action_taken = "CHALLENGED"
+            reason = "Unknown Sender + Looks Human" + (f" ({reason})" if reason else "")
+            shown = f"❓ {reason}"
+        else:
+            action_taken = "SUPPRESSED"
+            reason = f"Looks Human, not re-challenged ({suppressed_why})"
+            shown = f"🔕 {reason}"
+    elif verdict.label == "unknown":
+        action_taken, shown = "IGNORED", f"⚠️ {reason}"
+    elif verdict.stage in ("preclassifier", "llm"):
+        action_taken, shown = "IGNORED", f"🗑️ {reason}"
+    else:
+        action_taken, shown = "IGNORED", f"🤖 {reason} - No challenge sent."
 
-    results = []
+    print(f"   {shown}")
+    if action_taken == "CHALLENGED":
+        send_challenge(email.sender)
+    return {
+        "Sender": email.sender,
+        "Subject": email.subject,
+        "Action": action_taken,
+        "Reason": reason
+    }
 
-    print(f"Scanning last {len(latest_email_ids)} emails...")
+def scan_inbox(source, log=None, pipelined=False):
+    """
+    Runs the filter over the messages of `source` (see mailsource), writing
+    a row to `log` (a RunLog) as each email is decided. Returns the number
+    of emails decided.
+    pipelined=True runs fetching, filtering, the LLM and sending in their
+    own threads (see pipeline.py); rows are still logged in source order,
+    and the source's high-water mark only advances as they are.
+    """
     print(f"Mode: {'DRY RUN (No emails sent)' if DRY_RUN else 'LIVE (Sending Challenges)'}")
     print("-" * 60)
 
-    for i, e_id in enumerate(latest_email_ids):
-        try:
-            _, msg_data = mail.fetch(e_id, "(RFC822)")
-            for response_part in msg_data:
-                if isinstance(response_part, tuple):
-                    msg = email.message_from_bytes(response_part[1])
-                    
-                    # 1. Extract Details
-                    subject_header = decode_header(msg["Subject"])[0]
-                    subject = subject_header[0]
-                    if isinstance(subject, bytes):
-                        subject = subject.decode(subject_header[1] if subject_header[1] else "utf-8")
-                    
-                    raw_sender = msg.get("From")
-                    sender_email = extract_email_address(raw_sender)
-                    body = clean_email_body(msg)
-
-                    print(f"[{i+1}] {sender_email} | {subject[:30]}...")
-
-                    action_taken = "None"
-                    reason = ""
-
-                    # 2. LOGIC FLOW
-                    
-                    # A. Whitelist Check
-                    if sender_email in WHITELIST:
-                        action_taken = "PASSED"
-                        reason = "Sender in Whitelist"
-                        print(f"   ✅ {reason}")
-
-                    # B. Bot Filter (Traditional)
-                    else:
-                        is_bot, bot_reason = is_bot_or_transactional(msg, subject, body)
-                        
-                        if is_bot:
-                            action_taken = "IGNORED"
-                            reason = f"Identified as Bot ({bot_reason})"
-                            print(f"   🤖 {reason} - No challenge sent.")
-                        
-                        # C. Potential Human (Send Challenge)
-                        else:
-                            # Optional: Ask LLM for second opinion before challenging
-                            # (To avoid challenging subtle spam)
-                            is_llm_human = llm_analysis(subject, body)
-                            
-                            if is_llm_human:
-                                action_taken = "CHALLENGED"
-                                reason = "Unknown Sender + Looks Human"
-                                print(f"   ❓ {reason}")
-                                send_challenge(sender_email)
-                            else:
-                                action_taken = "IGNORED"
-                                reason = "LLM identified as subtle spam/marketing"
-                                print(f"   🗑️ {reason}")
-
-                    results.append({
-                        "Sender": sender_email,
-                        "Subject": subject,
-                        "Action": action_taken,
-                        "Reason": reason
-                    })
-
-        except Exception as e:
-            print(f"Error processing email: {e}")
-
-    # Save Log
-    df = pd.DataFrame(results)
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    df.to_csv(f"gatekeeper_log_{timestamp}.csv", index=False)
+    def write(n, email, verdict):
+        print(f"[{n+1}] {email.sender} | {email.subject[:30]}...")
+        row = act(email, verdict)
+        metrics.inc("emails", action=row["Action"])
+        if log is not None:
+            log.write(row)
+
+    # Headers first, the body only for messages the header stages can't settle
+    return decision.scan(source, FILTERS, write, clean_email_body, LLM_BATCH_SIZE * LLM_CONCURRENCY, pipelined,
+                         dispatch=None if DRY_RUN else (lambda last: send_queued_challenges(close=last)))
+
+def main():
+    try:
+        mail = connect()
+    except Exception as e:
+        print(f"Login Failed: {e}")
+        return
+
+    state = mailstate.load_state(STATE_FILE) if INCREMENTAL else None
+    source = mailsource.IMAPSource(mail, "inbox", state, EMAIL_COUNT, auto_mark=not PIPELINE)
+    # Rows are written as they are decided
+    log = runlog.RunLog(LOG_FILE, LOG_COLUMNS, LOG_MAX_BYTES)
+    try:
+        with metrics.profile(PROFILE_DIR), log:
+            scan_inbox(source, log, pipelined=PIPELINE)
+    except BaseException as e:
+        # Pipelined, the state only covers logged emails, so it is kept and the
+        # rest comes again next run. Serially it can be ahead of the log.
+        if PIPELINE and state is not None:
+            mailstate.save_state(STATE_FILE, state)
+        print(f"Stopped. {log.rows} emails logged" + (f" to {log.path}" if log.path else ""))
+        disconnect(mail)
+        if isinstance(e, KeyboardInterrupt):
+            return
+        raise
+    if state is not None:
+        mailstate.save_state(STATE_FILE, state)
+    if log.rows:
+        print(f"Log saved to {log.path}")
     
-    mail.close()
-    mail.logout()
+    disconnect(mail)
+    print(llmcache.open_cache(LLM_CACHE_FILE).stats())
+    print("\n" + metrics.summary())
+    if METRICS_FILE:
+        metrics.write_prometheus(METRICS_FILE)
     print("\nProcess Complete.")
 
+def run_daemon():
+    """
+    Long-running mode: one IMAP connection, woken up by IDLE, scanning only
+    new UIDs. Always incremental, whatever INCREMENTAL says.
+    """
+    state = mailstate.load_state(STATE_FILE)
+    log = runlog.RunLog(DAEMON_LOG_FILE, LOG_COLUMNS, LOG_MAX_BYTES)
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+
+    def process(mail):
+        source = mailsource.IMAPSource(mail, "inbox", state, EMAIL_COUNT, auto_mark=not PIPELINE)
+        try:
+            with metrics.profile(PROFILE_DIR):
+                scan_inbox(source, log, pipelined=PIPELINE)
+        except BaseException:
+            # Ctrl-C, or an IMAP error the daemon reconnects after: keep what was logged
+            if PIPELINE:
+                mailstate.save_state(STATE_FILE, state)
+            raise
+        mailstate.save_state(STATE_FILE, state)
+        log.flush()
+        if METRICS_FILE:
+            metrics.write_prometheus(METRICS_FILE)
+        print(llmcache.open_cache(LLM_CACHE_FILE).stats())
+        print("Waiting for new mail (IDLE)...")
+
+    try:
+        imapidle.run_daemon(connect, process)
+    finally:
+        log.close()
+
+def replay(path, workers=None):
+    """
+    Runs the whole pipeline over a local mbox / Maildir / .eml corpus, no
+    network needed except for the LLM (cached verdicts are reused). Always
+    a dry run, and reputation and challenge history start empty and are
+    thrown away afterwards, so a replay is repeatable and never touches the
+    live stores.
+    With `workers`, parsing runs on a process pool (see
+    mailsource.ParallelSource). The scan itself is not pipelined, so
+    reputation updates land in the same order every time.
+    """
+    global DRY_RUN, REPUTATION_FILE, CHALLENGE_LEDGER_FILE
+    DRY_RUN = True
+    REPUTATION_FILE = CHALLENGE_LEDGER_FILE = ":memory:"
+
+    source = mailsource.open_source(path)
+    if workers is not None:
+        # Parse and extract bodies on a process pool (0 = one worker per core)
+        source = mailsource.ParallelSource(source, clean_email_body, workers or None)
+    with metrics.profile(PROFILE_DIR), runlog.RunLog(REPLAY_LOG_FILE, LOG_COLUMNS, LOG_MAX_BYTES) as log:
+        scan_inbox(source, log)
+    print(f"\nReplayed {log.rows} emails, log saved to {log.path}")
+    print(llmcache.open_cache(LLM_CACHE_FILE).stats())
+    print("\n" + metrics.summary())
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Zero-trust email gatekeeper")
+    parser.add_argument("--daemon", action="store_true", help="Stay connected and classify new mail as it arrives (IMAP IDLE)")
+    parser.add_argument("--replay", metavar="PATH", help="Run offline over an mbox file, Maildir or directory of .eml files (always a dry run)")
+    parser.add_argument("--workers", type=int, metavar="N", help="With --replay: parse on N processes (0 = one per core)")
+    args = parser.parse_args()
+
+    if args.replay:
+        replay(args.replay, args.workers)
+    elif args.daemon:
+        run_daemon()
+    else:
+        main()
\ No newline at end of file
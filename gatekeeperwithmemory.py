@@ -1,15 +1,20 @@
 import imaplib
-import smtplib
 import email
-from email.header import decode_header
 from email.mime.text import MIMEText
-from email.utils import parseaddr
-import openai
-import pandas as pd
-import html2text
 import os
-from datetime import datetime
 import time
+import argparse
+import mailstate
+import mailsource
+import metrics
+import decision
+import imapfetch
+import imapidle
+import rules
+import whitelist
+import challenges
+import dispatcher
+import runlog
 
 # ================= CONFIGURATION =================
 # GMAIL SETTINGS
@@ -20,13 +25,40 @@ SMTP_SERVER = "smtp.gmail.com"
 SMTP_PORT = 587
 EMAIL_COUNT = 20 
 
+# INCREMENTAL SCANNING
+# Only process mail that arrived since the last run (tracked by UID in STATE_FILE).
+# EMAIL_COUNT is then only used on the very first run.
+INCREMENTAL = True
+
 # FILES
 WHITELIST_FILE = "whitelist.txt"
-LOG_FILE = f"gatekeeper_log_{datetime.now().strftime('%Y%m%d')}.csv"
+STATE_FILE = "gatekeeperwithmemory_state.json"  # Its own: gatekeeper.py keeps an "inbox" mark too
+CHALLENGE_LEDGER_FILE = "challenges.sqlite3"  # Sent challenges, matched to replies by Message-ID
+
+# OUTGOING CHALLENGES
+# Sent over one SMTP session at the end of each run. Anything over the
+# budgets stays queued in OUTBOX_FILE and goes out first next run.
+OUTBOX_FILE = "outbox.sqlite3"
+SEND_PER_MINUTE = 20
+SEND_PER_DAY = 400  # Gmail's limit is ~500/day
+CHALLENGE_COOLDOWN_DAYS = 7  # Don't challenge the same address again within this
+MAX_CHALLENGES_PER_ADDRESS = 3  # After this many unanswered challenges, stop (0 = no limit)
+# Rows are appended as each email is decided (CSV, or JSONL if the name ends
+# in .jsonl); strftime codes in the name start a new file every day.
+LOG_FILE = "gatekeeperwithmemory_log_%Y%m%d.csv"  # Not gatekeeper.py's name: the columns differ
+LOG_MAX_BYTES = 50 * 1024 * 1024  # Continue in <name>.1.csv, .2.csv, ... past this size
+LOG_COLUMNS = ["Sender", "Subject", "Status"]
+REPLAY_LOG_FILE = f"gatekeeperwithmemory_replay_{time.strftime('%Y%m%d_%H%M%S')}.csv"  # --replay
 
 # OPENAI SETTINGS
 OPENAI_API_KEY = "sk-...." 
-openai.api_key = OPENAI_API_KEY
+
+# METRICS
+# Per-stage timings and counters: a summary table after one-shot runs, and
+# the Prometheus text file rewritten after every run.
+METRICS_FILE = "gatekeeperwithmemory_metrics.prom"  # None to disable
+METRICS_PORT = None  # e.g. 9465: serve http://127.0.0.1:9465/metrics while running --daemon
+PROFILE_DIR = None  # e.g. "profiles": dump a cProfile .prof file per run
 
 # SAFETY SETTING
 DRY_RUN = True  # Set to False to ACTUALLY send challenges and update whitelist
@@ -50,191 +82,366 @@ Automated Gatekeeper
 
 # --- FILE MANAGEMENT ---
 def load_whitelist():
-    """Reads trusted emails from a file."""
+    """
+    Returns the trusted senders (see whitelist.py for the *@domain rules).
+    Loaded once per process and only re-read when the file changes.
+    """
     if not os.path.exists(WHITELIST_FILE):
         # Create file if it doesn't exist
         with open(WHITELIST_FILE, "w") as f:
             f.write("mom@gmail.com\n") # Example
-        return set(["mom@gmail.com"])
-    
-    with open(WHITELIST_FILE, "r") as f:
-        # Read lines, strip whitespace, remove empty lines
-        emails = {line.strip().lower() for line in f if line.strip()}
-    return emails
+    return whitelist.open_whitelist(WHITELIST_FILE)
 
 def update_whitelist(new_email):
-    """Adds a new email to the file."""
-    current_list = load_whitelist()
-    if new_email in current_list:
+    """Queues a new email for the file; save_whitelist() writes the queue."""
+    trusted = load_whitelist()
+    if new_email in trusted:
         return # Already exists
     
     if DRY_RUN:
         print(f"   [DRY RUN] Would write {new_email} to {WHITELIST_FILE}")
         return
 
-    with open(WHITELIST_FILE, "a") as f:
-        f.write(f"\n{new_email}")
-    print(f"   💾 Saved {new_email} to {WHITELIST_FILE}")
+    trusted.add(new_email)
 
-# --- EMAIL TOOLS ---
-def extract_email_address(raw_from):
-    name, addr = parseaddr(raw_from)
-    return addr.lower()
+def save_whitelist():
+    """Writes queued additions in one locked, atomic rewrite of the file."""
+    for new_email in load_whitelist().flush():
+        print(f"   💾 Saved {new_email} to {WHITELIST_FILE}")
 
+# --- EMAIL TOOLS ---
 def clean_email_body(msg):
-    body = ""
-    if msg.is_multipart():
-        for part in msg.walk():
-            if part.get_content_type() == "text/plain":
-                try:
-                    body += part.get_payload(decode=True).decode()
-                except: pass
-    else:
-        try: 
-            body = msg.get_payload(decode=True).decode() 
-        except: pass
-    return body[:1000].strip()
+    return decision.clean_email_body(msg, limit=1000)
 
 def send_challenge(to_email):
+    """Queues a challenge; send_queued_challenges() sends it at the end of the run."""
+    metrics.inc("challenges_queued", dry_run=DRY_RUN)
     if DRY_RUN:
         print(f"   [DRY RUN] Sending challenge to: {to_email}")
         return
-    try:
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()
-        server.login(EMAIL_USER, EMAIL_PASS)
-        msg = MIMEText(CHALLENGE_BODY.format(name=EMAIL_USER))
-        msg['Subject'] = CHALLENGE_SUBJECT_BASE
-        msg['From'] = EMAIL_USER
-        msg['To'] = to_email
-        server.sendmail(EMAIL_USER, to_email, msg.as_string())
-        server.quit()
-        print(f"   📧 Sent challenge to: {to_email}")
-    except Exception as e:
-        print(f"   [ERROR] Sending failed: {e}")
+    msg = MIMEText(CHALLENGE_BODY.format(name=EMAIL_USER))
+    msg['Subject'] = CHALLENGE_SUBJECT_BASE
+    msg['From'] = EMAIL_USER
+    msg['To'] = to_email
+    msg['Message-ID'] = challenges.new_message_id(EMAIL_USER)
+    get_outbox().enqueue(to_email, msg, msg['Message-ID'])
+
+def may_challenge(to_email):
+    """(allowed, reason) from the challenge ledger: cool-down and per-address cap."""
+    return challenges.open_ledger(CHALLENGE_LEDGER_FILE).may_challenge(
+        to_email, CHALLENGE_COOLDOWN_DAYS * 24 * 3600, MAX_CHALLENGES_PER_ADDRESS)
+
+def get_outbox():
+    return dispatcher.open_dispatcher(SMTP_SERVER, SMTP_PORT, EMAIL_USER, EMAIL_PASS,
+                                      OUTBOX_FILE, SEND_PER_MINUTE, SEND_PER_DAY)
+
+def send_queued_challenges():
+    """
+    Sends queued challenges (oldest first, including ones deferred by an
+    earlier run) over one SMTP session, within the send budgets.
+    """
+    if DRY_RUN:
+        return
+    ledger = challenges.open_ledger(CHALLENGE_LEDGER_FILE)
+    with metrics.timer("send_queue"):
+        sent, waiting = get_outbox().drain(on_sent=ledger.record_sent)
+    print(f"   Challenges sent: {sent}" + (f", {waiting} deferred to the next run" if waiting else ""))
 
 # --- PHASE 1: CHECK FOR VERIFICATIONS ---
-def process_challenge_replies(mail):
+def process_challenge_replies(mail, state=None):
     """
-    Scans for emails replying to our challenge. 
+    Looks for replies to the challenges we sent (matched through their
+    In-Reply-To/References headers against the challenge ledger, or by
+    subject for clients that drop them and for pre-ledger challenges).
     If they contain the SECRET_CODE, whitelist them.
+    With a `state` dict only mail that arrived since the last check is read.
     """
     print("\n🔍 Phase 1: Checking for Verified Humans...")
-    
-    # Search for emails with our specific subject line
-    # (RFC822 search criteria)
-    search_crit = f'(SUBJECT "{CHALLENGE_SUBJECT_BASE}")'
-    status, messages = mail.search(None, search_crit)
-    
-    if not messages[0]:
-        print("   No verification replies found.")
-        return
+    ledger = challenges.open_ledger(CHALLENGE_LEDGER_FILE)
+    expired = ledger.expire()
+    if expired:
+        print(f"   ⌛ {expired} challenges expired without a valid reply.")
 
-    email_ids = messages[0].split()
-    
-    for e_id in email_ids:
-        _, msg_data = mail.fetch(e_id, "(RFC822)")
-        msg = email.message_from_bytes(msg_data[0][1])
-        
-        sender = extract_email_address(msg.get("From"))
-        subject = msg.get("Subject", "")
-        body = clean_email_body(msg).upper() # Uppercase for easier comparison
-
-        # Ensure it is a REPLY, not the one we sent
+    # Our own high-water mark, separate from Phase 2's
+    state_key = "inbox:challenge-replies"
+    if state is not None:
+        uidvalidity, email_ids = mailstate.select_new_uids(mail, "inbox", state, EMAIL_COUNT, key=state_key)
+    else:
+        status, messages = mail.uid("search", None, "ALL")
+        email_ids = messages[0].split()[-EMAIL_COUNT:]
+
+    def find_challenge(msg):
+        sender = decision.extract_email_address(msg.get("From", ""))
         if sender == EMAIL_USER.lower():
+            return None
+        found = ledger.match(msg)
+        # Some clients drop the threading headers, and challenges sent before
+        # the ledger existed have no row: fall back to subject + sender
+        if found is None and CHALLENGE_SUBJECT_BASE.lower() in str(msg.get("Subject", "")).lower():
+            found = ledger.pending_for(sender) or (None, sender)
+        return found
+
+    replies = 0
+    # Only replies to a challenge get their body downloaded
+    messages = imapfetch.fetch_header_first(mail, email_ids, lambda m: find_challenge(m) is not None)
+    for e_id, msg in metrics.timed_iter("phase1_source", messages):
+        challenge = find_challenge(msg)
+        if challenge is None:
+            if state is not None:
+                mailstate.mark_processed(state, state_key, uidvalidity, e_id)
             continue
 
+        replies += 1
+        sender = decision.extract_email_address(msg.get("From"))
+        with metrics.timer("clean_body"):
+            body = clean_email_body(msg).upper() # Uppercase for easier comparison
+
         print(f"   Checking reply from {sender}...")
 
         # Check for the secret code (e.g., "HUMAN")
-        if SECRET_CODE in body:
+        if SECRET_CODE.upper() in body:
             print(f"   🎉 SUCCESS: '{SECRET_CODE}' found!")
+            metrics.inc("challenge_replies", result="verified")
             update_whitelist(sender)
+            if DRY_RUN:
+                print(f"   [DRY RUN] Would mark the challenge to {challenge[1]} verified")
+            else:
+                ledger.resolve(challenge[1])
         else:
+            metrics.inc("challenge_replies", result="no_code")
             print(f"   ❌ Failed: Reply did not contain secret code.")
+        # Only once handled, so a state saved after an error never skips a reply
+        if state is not None:
+            mailstate.mark_processed(state, state_key, uidvalidity, e_id)
+
+    if not replies:
+        print("   No verification replies found.")
+
+    save_whitelist()
 
 # --- PHASE 2: SCAN INBOX ---
-def is_bot(msg, subject, body):
+def is_bot_by_headers(msg):
     # 1. Technical Headers
-    if msg.get("List-Unsubscribe") or msg.get("Auto-Submitted") == 'auto-generated':
-        return True
-    # 2. Keywords
+    return bool(msg.get("List-Unsubscribe") or msg.get("Auto-Submitted") == 'auto-generated')
+
+def is_bot_by_content(subject, body):
+    # 2. Keywords (triggers in rules.json)
     text = (str(subject) + " " + str(body)).lower()
-    if any(x in text for x in ["unsubscribe", "privacy policy", "view in browser"]):
-        return True
-    return False
+    return rules.get_ruleset("bot_filter_memory").matches(text=text)[0]
 
-def main():
-    # 1. Setup
-    print(f"Loading whitelist from {WHITELIST_FILE}...")
-    whitelist = load_whitelist()
-    print(f"Trusted senders: {len(whitelist)}")
+def is_bot(msg, subject, body):
+    return is_bot_by_headers(msg) or is_bot_by_content(subject, body)
 
-    mail = imaplib.IMAP4_SSL(IMAP_SERVER)
-    mail.login(EMAIL_USER, EMAIL_PASS)
-    mail.select("inbox")
+def connect():
+    """Logs in to IMAP and selects the inbox."""
+    with metrics.timer("imap_connect"):
+        mail = imaplib.IMAP4_SSL(IMAP_SERVER)
+        mail.login(EMAIL_USER, EMAIL_PASS)
+        mail.select("inbox")
+    return mail
+
+def disconnect(mail):
+    """Closes the mailbox and logs out, ignoring a connection that is already gone."""
+    try:
+        mail.close()
+        mail.logout()
+    except (imaplib.IMAP4.error, OSError):
+        pass
+
+def save_progress(state):
+    """
+    After an error: writes the verifications found so far and the
+    high-water marks, which only pass mail that was handled and logged.
+    """
+    save_whitelist()
+    if state is not None:
+        mailstate.save_state(STATE_FILE, state)
 
+def run_phases(mail, state=None, log=None):
+    """
+    Runs Phase 1 (verifications) and Phase 2 (inbox scan), writing a row to
+    `log` (a RunLog) per email as it is decided. Returns how many were logged.
+    With a `state` dict Phase 2 only scans mail newer than its high-water mark.
+    """
     # 2. Run Verification Phase (Updates Whitelist)
-    process_challenge_replies(mail)
-    
-    # Reload whitelist in case we just added someone
-    whitelist = load_whitelist()
+    with metrics.timer("phase1"):
+        process_challenge_replies(mail, state)
 
     # 3. Run Scanning Phase
+    with metrics.timer("phase2"):
+        logged = scan_inbox(mailsource.IMAPSource(mail, "inbox", state, EMAIL_COUNT, auto_mark=False), log)
+
+    if state is not None:
+        mailstate.save_state(STATE_FILE, state)
+
+    return logged
+
+def scan_inbox(source, log=None):
+    """
+    Phase 2 over the messages of `source` (see mailsource). Returns how many
+    emails were logged.
+    """
+    # Already includes anyone Phase 1 just added (and other runs' additions)
+    trusted = load_whitelist()
+    me = EMAIL_USER.lower()
+    # An IMAP source's mark only passes logged emails (see save_progress())
+    mark_processed = getattr(source, "mark_processed", None)
+
     print("\n🔍 Phase 2: Scanning Recent Emails...")
-    status, messages = mail.search(None, "ALL")
-    latest_email_ids = messages[0].split()[-EMAIL_COUNT:]
-    
-    results = []
+    logged = 0
 
-    for e_id in latest_email_ids:
-        try:
-            _, msg_data = mail.fetch(e_id, "(RFC822)")
-            msg = email.message_from_bytes(msg_data[0][1])
-            sender = extract_email_address(msg.get("From"))
-            
-            # Skip if it's me (Sent items often appear in All Mail/Inbox depending on view)
-            if sender == EMAIL_USER.lower():
-                continue
-
-            # Decode Subject
-            subject_header = decode_header(msg["Subject"])[0]
-            subject = subject_header[0]
-            if isinstance(subject, bytes):
-                subject = subject.decode(subject_header[1] or "utf-8")
-            
-            body = clean_email_body(msg)
-
-            # LOGIC TREE
-            status = "UNKNOWN"
-            
-            # A. Whitelisted?
-            if sender in whitelist:
-                status = "✅ PASSED (Whitelisted)"
-            
-            # B. Bot?
-            elif is_bot(msg, subject, body):
-                status = "🤖 BLOCKED (Bot/Newsletter)"
-            
-            # C. Challenge?
+    # LOGIC TREE, cheapest check first (see decision.py). Only the bot
+    # keywords need the body, so it is only downloaded when the rest can't settle it.
+    def is_me(email):
+        # Skip if it's me (Sent items often appear in All Mail/Inbox depending on view)
+        if email.sender == me:
+            return decision.Verdict("skip", "")
+
+    def whitelisted(email):
+        # A. Whitelisted?
+        if email.sender in trusted:
+            return decision.Verdict("pass", "✅ PASSED (Whitelisted)")
+
+    def bot_by_headers(email):
+        # B. Bot? (headers first, body only if they are inconclusive)
+        if is_bot_by_headers(email.msg):
+            return decision.Verdict("bot", "🤖 BLOCKED (Bot/Newsletter)")
+
+    def bot_by_content(email):
+        if is_bot_by_content(email.subject, email.body):
+            return decision.Verdict("bot", "🤖 BLOCKED (Bot/Newsletter)")
+
+    filters = decision.Pipeline([
+        decision.Stage("self", 0, is_me),
+        decision.Stage("whitelist", 0, whitelisted),
+        decision.Stage("bot_headers", 1, bot_by_headers),
+        decision.Stage("bot_content", 10, bot_by_content, uses_body=True),
+    ])
+
+    def write(n, email, verdict):
+        log_email(email, verdict)
+        if mark_processed is not None:
+            mark_processed(email.key)
+
+    def log_email(email, verdict):
+        nonlocal logged
+        if verdict is not None and verdict.label == "skip":
+            return
+        if verdict is not None:
+            status = verdict.reason
+
+        # C. Challenge? (unless we already did recently, or too often)
+        else:
+            with metrics.timer("challenge_check"):
+                allowed, suppressed_why = may_challenge(email.sender)
+            if not allowed:
+                status = f"🔕 SUPPRESSED ({suppressed_why})"
             else:
                 # LLM check to ensure it's not subtle spam
                 # (Can remove this if you want to challenge EVERYONE not in whitelist)
                 status = "❓ CHALLENGING (Sent Request)"
-                send_challenge(sender)
+                send_challenge(email.sender)
+
+        print(f"[{email.sender}] -> {status}")
+        metrics.inc("emails", status=status.split()[1])
+
+        if log is not None:
+            log.write({"Sender": email.sender, "Subject": email.subject[:30], "Status": status})
+        logged += 1
 
-            print(f"[{sender}] -> {status}")
-            
-            results.append({"Sender": sender, "Subject": subject[:30], "Status": status})
+    decision.scan(source, filters, write, clean_email_body, dispatch=lambda last: send_queued_challenges())
+    return logged
 
-        except Exception as e:
-            print(f"Error: {e}")
+def main():
+    # 1. Setup
+    print(f"Loading whitelist from {WHITELIST_FILE}...")
+    trusted = load_whitelist()
+    print(f"Trusted senders: {len(trusted)}")
 
-    # Save logs
-    pd.DataFrame(results).to_csv(LOG_FILE, index=False)
-    mail.close()
-    mail.logout()
+    try:
+        mail = connect()
+    except Exception as e:
+        print(f"Login Failed: {e}")
+        return
+
+    state = mailstate.load_state(STATE_FILE) if INCREMENTAL else None
+    # Logs are written as we go
+    log = runlog.RunLog(LOG_FILE, LOG_COLUMNS, LOG_MAX_BYTES)
+    try:
+        with metrics.profile(PROFILE_DIR), log:
+            run_phases(mail, state, log)
+    except BaseException as e:
+        save_progress(state)
+        print(f"Stopped. {log.rows} emails logged" + (f" to {log.path}" if log.path else ""))
+        disconnect(mail)
+        if isinstance(e, KeyboardInterrupt):
+            return
+        raise
+    disconnect(mail)
+    print("\n" + metrics.summary())
+    if METRICS_FILE:
+        metrics.write_prometheus(METRICS_FILE)
     print("\nDone.")
 
+def run_daemon():
+    """
+    Long-running mode: one IMAP connection, woken up by IDLE. Every wake-up
+    runs both phases; Phase 2 is always incremental here.
+    """
+    state = mailstate.load_state(STATE_FILE)
+    log = runlog.RunLog(LOG_FILE, LOG_COLUMNS, LOG_MAX_BYTES)
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+
+    def process(mail):
+        try:
+            with metrics.profile(PROFILE_DIR):
+                run_phases(mail, state, log)
+        except BaseException:
+            # Ctrl-C, or an IMAP error the daemon reconnects after
+            save_progress(state)
+            raise
+        log.flush()
+        if METRICS_FILE:
+            metrics.write_prometheus(METRICS_FILE)
+        print("\nWaiting for new mail (IDLE)...")
+
+    try:
+        imapidle.run_daemon(connect, process)
+    finally:
+        log.close()
+
+def replay(path, workers=None):
+    """
+    Runs Phase 2 over a local mbox / Maildir / .eml corpus. Always a dry
+    run, against an empty challenge history that is thrown away afterwards;
+    the whitelist is only read.
+    With `workers`, parsing runs on a process pool (see
+    mailsource.ParallelSource).
+    """
+    global DRY_RUN, CHALLENGE_LEDGER_FILE
+    DRY_RUN = True
+    CHALLENGE_LEDGER_FILE = ":memory:"
+
+    source = mailsource.open_source(path)
+    if workers is not None:
+        # Parse and extract bodies on a process pool (0 = one worker per core)
+        source = mailsource.ParallelSource(source, clean_email_body, workers or None)
+    with metrics.profile(PROFILE_DIR), runlog.RunLog(REPLAY_LOG_FILE, LOG_COLUMNS, LOG_MAX_BYTES) as log:
+        scan_inbox(source, log)
+    print(f"\nReplayed {log.rows} emails, log saved to {log.path}")
+    print("\n" + metrics.summary())
+
 if __name__ == "__main__":
-    main() 
+    parser = argparse.ArgumentParser(description="Zero-trust email gatekeeper with challenge memory")
+    parser.add_argument("--daemon", action="store_true", help="Stay connected and classify new mail as it arrives (IMAP IDLE)")
+    parser.add_argument("--replay", metavar="PATH", help="Run Phase 2 offline over an mbox file, Maildir or directory of .eml files (always a dry run)")
+    parser.add_argument("--workers", type=int, metavar="N", help="With --replay: parse on N processes (0 = one per core)")
+    args = parser.parse_args()
+
+    if args.replay:
+        replay(args.replay, args.workers)
+    elif args.daemon:
+        run_daemon()
+    else:
+        main() 
@@ -0,0 +1,281 @@
+"""
+Batched IMAP FETCH helpers.
+
+Instead of one `FETCH` round trip per message, UIDs are packed into compact
+sets ("101:180,183,190:201") and requested in chunks. The untagged responses
+are parsed into one dict per message and yielded as they come, so callers can
+stream them straight into the classifier.
+"""
+import binascii
+import email
+import quopri
+import re
+from itertools import takewhile
+
+import metrics
+
+FETCH_CHUNK_SIZE = 100  # Messages per FETCH command
+BODY_FETCH_BYTES = 8192  # Max bytes of the chosen text part we download
+
+
+# --- UID SETS ---
+def compress_uid_set(uids):
+    """Turns [1, 2, 3, 7, 9, 10] into '1:3,7,9:10'."""
+    numbers = sorted({int(u) for u in uids})
+    ranges = []
+    for n in numbers:
+        if ranges and n == ranges[-1][1] + 1:
+            ranges[-1][1] = n
+        else:
+            ranges.append([n, n])
+    return ",".join(f"{lo}:{hi}" if lo != hi else str(lo) for lo, hi in ranges)
+
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# --- RESPONSE PARSING ---
+_LITERAL_RE = re.compile(rb"\{(\d+)\}$")
+_NEW_MESSAGE_RE = re.compile(rb"^\d+ \(")
+
+
+def _group_responses(data):
+    """
+    imaplib hands back a flat list mixing bytes and (prefix, literal) tuples.
+    Group it into one list of (text, literal) pieces per FETCH response.
+    """
+    groups = []
+    for item in data:
+        if item is None:
+            continue
+        text, literal = (item[0], item[1]) if isinstance(item, tuple) else (item, None)
+        if _NEW_MESSAGE_RE.match(text) or not groups:
+            groups.append([])
+        groups[-1].append((text, literal))
+    return groups
+
+
+def _tokenize(pieces):
+    """
+    Yields (kind, value) tokens where kind is one of "(", ")", "atom",
+    "string" (quoted strings and literals) or "nil".
+    """
+    for text, literal in pieces:
+        if literal is not None:
+            # The literal marker is the last thing in the text part.
+            text = _LITERAL_RE.sub(b"", text.rstrip())
+        i, n = 0, len(text)
+        while i < n:
+            c = text[i:i + 1]
+            if c in (b" ", b"\r", b"\n"):
+                i += 1
+            elif c in (b"(", b")"):
+                yield c.decode(), None
+                i += 1
+            elif c == b'"':
+                j, out = i + 1, bytearray()
+                while j < n and text[j:j + 1] != b'"':
+                    if text[j:j + 1] == b"\\":
+                        j += 1
+                    out += text[j:j + 1]
+                    j += 1
+                yield "string", bytes(out)
+                i = j + 1
+            else:
+                # Atom. Brackets (BODY[HEADER.FIELDS (FROM)]) and partial
+                # origins (BODY[1]<0>) belong to the atom even with spaces.
+                j, depth = i, 0
+                while j < n:
+                    ch = text[j:j + 1]
+                    if ch in (b"[", b"<"):
+                        depth += 1
+                    elif ch in (b"]", b">"):
+                        depth -= 1
+                    elif depth == 0 and ch in (b" ", b"(", b")"):
+                        break
+                    j += 1
+                atom = text[i:j]
+                if atom.upper() == b"NIL":
+                    yield "nil", None
+                else:
+                    yield "atom", atom
+                i = j
+        if literal is not None:
+            yield "string", literal
+
+
+def _parse_list(tokens):
+    """Parses tokens up to the matching ')' into a (nested) Python list."""
+    values = []
+    for kind, value in tokens:
+        if kind == ")":
+            return values
+        if kind == "(":
+            values.append(_parse_list(tokens))
+        else:
+            values.append(value)
+    return values
+
+
+def parse_fetch_response(data):
+    """
+    Parses the data returned by `mail.uid("fetch", ...)` into a list of dicts,
+    one per message, e.g. {"UID": b"42", "RFC822": b"..."}.
+    """
+    messages = []
+    for pieces in _group_responses(data):
+        tokens = _tokenize(pieces)
+        next(tokens, None)  # Sequence number
+        if next(tokens, (None, None))[0] != "(":
+            continue
+        items = _parse_list(tokens)
+        messages.append({
+            items[i].decode("ascii", "replace").upper(): items[i + 1]
+            for i in range(0, len(items) - 1, 2)
+            if isinstance(items[i], bytes)
+        })
+    return messages
+
+
+# --- FETCHING ---
+def fetch_messages(mail, uids, query="(RFC822)", chunk_size=FETCH_CHUNK_SIZE):
+    """
+    Fetches `query` for all `uids` using one UID FETCH per chunk.
+    Yields (uid, items) in ascending UID order as each chunk arrives.
+    """
+    wanted = sorted({int(u) for u in uids})
+    if not re.search(r"\bUID\b", query, re.IGNORECASE):
+        query = f"(UID {query.strip('()')})"
+
+    for chunk in chunked(wanted, chunk_size):
+        with metrics.timer("imap_fetch"):
+            status, data = mail.uid("fetch", compress_uid_set(chunk), query)
+        metrics.inc("bytes_fetched", sum(len(item[1] or b"") for item in data if isinstance(item, tuple)), source="imap")
+        if status != "OK":
+            print(f"   [WARN] FETCH failed for {len(chunk)} messages: {data}")
+            continue
+
+        requested = set(chunk)
+        by_uid = {}
+        for items in parse_fetch_response(data):
+            uid = items.get("UID")
+            # Skip unsolicited FETCH responses (e.g. flag updates).
+            if uid is not None and int(uid) in requested:
+                by_uid.setdefault(int(uid), {}).update(items)
+
+        for uid in chunk:
+            if uid in by_uid:
+                yield str(uid).encode(), by_uid[uid]
+
+
+# --- BODYSTRUCTURE ---
+def _walk_structure(structure, section=""):
+    """Yields (section, part) for every leaf part of a parsed BODYSTRUCTURE."""
+    if structure and isinstance(structure[0], list):
+        # Multipart: child parts come first, then the subtype and extension data.
+        children = takewhile(lambda p: isinstance(p, list), structure)
+        for n, child in enumerate(children, 1):
+            yield from _walk_structure(child, f"{section}.{n}" if section else str(n))
+    else:
+        # A non-multipart message still calls its only part "1".
+        yield section or "1", structure
+
+
+def _text(value):
+    return value.decode("ascii", "replace").lower() if isinstance(value, bytes) else ""
+
+
+def find_text_part(structure):
+    """
+    Picks the part we want to read from a parsed BODYSTRUCTURE: the first
+    inline text/plain, otherwise the first inline text/html.
+    Returns (section, subtype, encoding, charset), or None if there is none.
+    """
+    html = None
+    for section, part in _walk_structure(structure):
+        if len(part) < 7 or _text(part[0]) != "text":
+            continue
+        subtype = _text(part[1])
+        params = part[2] if isinstance(part[2], list) else []
+        params = {_text(k): _text(v) for k, v in zip(params[::2], params[1::2])}
+        # For text parts the disposition sits after md5, at index 9.
+        disposition = part[9] if len(part) > 9 and isinstance(part[9], list) else []
+        if disposition and _text(disposition[0]) == "attachment":
+            continue
+
+        found = (section, subtype, _text(part[5]), params.get("charset"))
+        if subtype == "plain":
+            return found
+        if subtype == "html" and html is None:
+            html = found
+    return html
+
+
+def decode_partial(data, encoding, charset):
+    """
+    Decodes a (possibly truncated) part body to str. A partial FETCH can cut
+    a base64 quantum, a QP escape or a multi-byte character in half, so we
+    trim those instead of failing.
+    """
+    if encoding == "base64":
+        compact = re.sub(rb"\s+", b"", data)
+        data = binascii.a2b_base64(compact[:len(compact) // 4 * 4])
+    elif encoding == "quoted-printable":
+        data = quopri.decodestring(re.sub(rb"=[0-9A-Fa-f]?$", b"", data))
+    try:
+        return data.decode(charset or "utf-8", errors="ignore")
+    except LookupError:
+        return data.decode("utf-8", errors="ignore")
+
+
+def _with_text_body(msg, subtype, text):
+    """Turns a header-only message into a single-part text message carrying `text`."""
+    del msg["Content-Type"]
+    del msg["Content-Transfer-Encoding"]
+    msg["Content-Type"] = f"text/{subtype}"
+    msg.set_payload(text, "utf-8")
+    return msg
+
+
+# --- TWO-STAGE FETCH ---
+def fetch_header_first(mail, uids, needs_body, chunk_size=FETCH_CHUNK_SIZE, max_body_bytes=BODY_FETCH_BYTES):
+    """
+    Two-stage fetch. For each chunk, headers and BODYSTRUCTURE come down
+    first and `needs_body(msg)` is asked about every message. Only the ones
+    it returns True for get a second, batched FETCH of their preferred text
+    part (see find_text_part), capped at `max_body_bytes`, so attachments
+    are never transferred.
+
+    Yields (uid, msg) in ascending UID order. If the body was fetched, `msg`
+    is a single-part text message holding that part; otherwise it only has
+    headers. PEEK means neither stage marks the message as \\Seen.
+    """
+    for chunk in chunked(sorted({int(u) for u in uids}), chunk_size):
+        headers = {}
+        for uid, items in fetch_messages(mail, chunk, "(BODY.PEEK[HEADER] BODYSTRUCTURE)", chunk_size):
+            with metrics.timer("parse"):
+                msg = email.message_from_bytes(items.get("BODY[HEADER]") or b"")
+            headers[uid] = (msg, items.get("BODYSTRUCTURE"))
+
+        # FETCH takes one section for the whole UID set, so group by section.
+        by_section = {}
+        for uid, (msg, structure) in headers.items():
+            part = find_text_part(structure) if isinstance(structure, list) else None
+            if part and needs_body(msg):
+                by_section.setdefault(part[0], []).append((uid, part))
+
+        bodies = {}
+        for section, wanted in by_section.items():
+            parts = dict(wanted)
+            query = f"(BODY.PEEK[{section}]<0.{max_body_bytes}>)"
+            for uid, items in fetch_messages(mail, list(parts), query, chunk_size):
+                data = items.get(f"BODY[{section}]<0>") or items.get(f"BODY[{section}]") or b""
+                _, subtype, encoding, charset = parts[uid]
+                bodies[uid] = (subtype, decode_partial(data, encoding, charset))
+
+        for uid, (msg, _) in headers.items():
+            if uid in bodies:
+                msg = _with_text_body(msg, *bodies[uid])
+            yield uid, msg
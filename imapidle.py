@@ -0,0 +1,143 @@
+"""
+IMAP IDLE support (RFC 2177) and a reconnecting daemon loop.
+
+imaplib (before Python 3.14) has no IDLE command, so we drive it by hand:
+send IDLE, wait on the socket for an untagged EXISTS, then send DONE.
+"""
+import imaplib
+import itertools
+import re
+import select
+import time
+
+IDLE_TIMEOUT = 29 * 60  # Servers drop IDLE after ~30 minutes, so re-issue before that
+IDLE_FALLBACK_POLL = 60  # Seconds between NOOP polls if the server has no IDLE
+RESPONSE_TIMEOUT = 30  # Seconds to wait for the server to answer IDLE / DONE
+MAX_RECONNECT_BACKOFF = 300
+
+_EXISTS_RE = re.compile(rb"^\* \d+ EXISTS")
+_tag_counter = itertools.count(1)
+
+
+class _LineReader:
+    """
+    Reads CRLF-terminated lines straight off the (SSL) socket with a timeout.
+    We can't use mail.readline() here: a timeout on imaplib's buffered file
+    object leaves it unusable.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b""
+
+    def readline(self, timeout):
+        """Returns the next line, or None if nothing complete arrived in time."""
+        deadline = time.monotonic() + timeout
+        while b"\r\n" not in self.buffer:
+            # SSL sockets can hold decrypted bytes that select() can't see.
+            if not getattr(self.sock, "pending", lambda: 0)():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                ready, _, _ = select.select([self.sock], [], [], remaining)
+                if not ready:
+                    return None
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise imaplib.IMAP4.abort("connection closed during IDLE")
+            self.buffer += chunk
+        line, _, self.buffer = self.buffer.partition(b"\r\n")
+        return line
+
+
+def supports_idle(mail):
+    return "IDLE" in mail.capabilities
+
+
+def wait_for_new_mail(mail, timeout=IDLE_TIMEOUT):
+    """
+    Blocks until the server reports new messages in the selected mailbox, or
+    until `timeout` seconds pass. Returns True if new mail was announced.
+    """
+    if not supports_idle(mail):
+        time.sleep(min(timeout, IDLE_FALLBACK_POLL))
+        mail.noop()
+        return True
+
+    reader = _LineReader(mail.socket())
+    tag = f"IDLE{next(_tag_counter)}".encode()
+    mail.send(tag + b" IDLE\r\n")
+
+    line = reader.readline(RESPONSE_TIMEOUT)
+    if line is None or not line.startswith(b"+"):
+        raise imaplib.IMAP4.error(f"Server rejected IDLE: {line!r}")
+
+    new_mail = False
+    deadline = time.monotonic() + timeout
+    while not new_mail:
+        remaining = deadline - time.monotonic()
+        line = reader.readline(remaining) if remaining > 0 else None
+        if line is None:
+            break
+        if line.startswith(b"* BYE"):
+            raise imaplib.IMAP4.abort(line.decode(errors="replace"))
+        new_mail = bool(_EXISTS_RE.match(line))
+
+    # Leave IDLE and drain everything up to our tagged completion.
+    mail.send(b"DONE\r\n")
+    while True:
+        line = reader.readline(RESPONSE_TIMEOUT)
+        if line is None:
+            raise imaplib.IMAP4.abort("No response to DONE")
+        if line.startswith(tag + b" "):
+            break
+        new_mail = new_mail or bool(_EXISTS_RE.match(line))
+
+    if not line.startswith(tag + b" OK"):
+        raise imaplib.IMAP4.error(f"IDLE failed: {line!r}")
+    return new_mail
+
+
+def _safe_logout(mail):
+    if mail is None:
+        return
+    try:
+        mail.logout()
+    except Exception:
+        pass
+
+
+def run_daemon(connect, process, idle_timeout=IDLE_TIMEOUT):
+    """
+    Holds one authenticated connection open. `connect()` must return a logged
+    in IMAP4 object with the mailbox selected; `process(mail)` is called once
+    after connecting and again every time IDLE wakes up. Dropped connections
+    are re-established with exponential backoff, and so is any IMAP error
+    after login (e.g. NO/BAD to IDLE, SEARCH or FETCH). Login errors are not
+    retried; they propagate to the caller.
+    """
+    backoff = 1
+    while True:
+        mail = None
+        try:
+            mail = connect()
+            connected = time.monotonic()
+            process(mail)
+            while True:
+                # Also process on a plain IDLE timeout: it is only a UID
+                # SEARCH, and catches anything a missed EXISTS would hide.
+                wait_for_new_mail(mail, idle_timeout)
+                process(mail)
+        except KeyboardInterrupt:
+            print("\nStopping daemon...")
+            _safe_logout(mail)
+            return
+        except (imaplib.IMAP4.error, OSError) as e:  # IMAP4.abort is an IMAP4.error too
+            if mail is None and not isinstance(e, (imaplib.IMAP4.abort, OSError)):
+                raise  # connect() itself was refused (login, mailbox): retrying won't help
+            if mail is not None and time.monotonic() - connected > MAX_RECONNECT_BACKOFF:
+                backoff = 1  # The last session held up for a while
+            print(f"   [WARN] Connection lost ({e}), reconnecting in {backoff}s...")
+            _safe_logout(mail)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, MAX_RECONNECT_BACKOFF)
@@ -0,0 +1,113 @@
+"""
+Persistent LLM verdict cache.
+
+Verdicts are stored in a local SQLite file, keyed by a hash of the
+normalized subject and body plus the prompt version and model name, so
+re-scanning the same mail (overlapping windows, reruns, replays) never pays
+for the same API call twice. Entries expire after a TTL and the table is
+trimmed to a maximum size, least recently used first.
+"""
+import hashlib
+import json
+import re
+import time
+
+import metrics
+import sqlitestore
+
+CACHE_FILE = "llm_cache.sqlite3"
+DEFAULT_TTL = 30 * 24 * 3600  # Seconds
+MAX_ENTRIES = 50_000
+EVICT_EVERY = 500  # Run eviction after this many writes
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize(text):
+    """Lowercases and collapses whitespace so trivial re-wraps hit the same entry."""
+    return _WHITESPACE_RE.sub(" ", str(text or "")).strip().lower()
+
+
+def make_key(subject, body, prompt_version, model):
+    h = hashlib.sha256()
+    for part in (prompt_version, model, normalize(subject), normalize(body)):
+        h.update(part.encode("utf-8", "replace"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class VerdictCache(sqlitestore.Store):
+    """SQLite-backed verdict store. Safe to share between threads and processes."""
+
+    def __init__(self, path=CACHE_FILE, ttl=DEFAULT_TTL, max_entries=MAX_ENTRIES):
+        super().__init__(path, [
+            "CREATE TABLE IF NOT EXISTS verdicts ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " created REAL NOT NULL, last_used REAL NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS verdicts_last_used ON verdicts (last_used)",
+        ])
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+
+    def get(self, key):
+        """Returns the cached verdict, or None on a miss / expired entry."""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM verdicts WHERE key = ? AND created > ?", (key, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics.inc("llm_cache", result="miss")
+                return None
+            self.hits += 1
+            metrics.inc("llm_cache", result="hit")
+            self._db.execute("UPDATE verdicts SET last_used = ? WHERE key = ?", (now, key))
+            self._db.commit()
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO verdicts (key, value, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            self._db.commit()
+            self._writes += 1
+            if self._writes % EVICT_EVERY == 0:
+                self._evict(now)
+
+    def evict(self):
+        """Drops expired entries and trims the table to max_entries."""
+        with self._lock:
+            self._evict(time.time())
+
+    def _evict(self, now):
+        self._db.execute("DELETE FROM verdicts WHERE created <= ?", (now - self.ttl,))
+        self._db.execute(
+            "DELETE FROM verdicts WHERE key IN ("
+            " SELECT key FROM verdicts ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        self._db.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        rate = (100.0 * self.hits / total) if total else 0.0
+        return f"LLM cache: {self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate)"
+
+    def close(self):
+        self.evict()
+        super().close()
+
+
+_caches = sqlitestore.Registry()
+
+
+def open_cache(path=CACHE_FILE):
+    """Returns the process-wide VerdictCache for `path`, opening it on first use."""
+    return _caches.get(path, lambda: VerdictCache(path))
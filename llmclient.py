@@ -0,0 +1,335 @@
+"""
+Shared OpenAI client, rate limiting and concurrent classification.
+
+One openai.Client per API key is reused for the whole process, so its
+HTTP connection pool (keep-alive) is shared instead of paying a new TLS
+handshake per email. The openai package itself is only imported when the
+first client is created, so runs that never reach the LLM don't pay for it.
+Calls go through a token bucket on requests and tokens per minute, and
+map_ordered() runs a classifier over many messages on a thread pool while
+returning results in input order.
+
+For batch mode, build_batch_prompt() packs several emails into one request
+that must answer with a JSON array of {id, verdict, reason}, and
+parse_batch_verdicts() validates it strictly. Anything missing or malformed
+is left for the caller to retry one message at a time (see run_batched()).
+
+Classifier puts it all together for one check: cached verdicts first (see
+llmcache), then batches, then one request per email for whatever a batch
+left out. The scripts only supply the prompts and what a label means.
+"""
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import llmcache
+import metrics
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_REQUESTS_PER_MINUTE = 500
+DEFAULT_TOKENS_PER_MINUTE = 200_000
+EXPECTED_OUTPUT_TOKENS = 60  # Budgeted per call (per email in a batch) on top of the prompt
+
+_clients = {}
+_limiters = {}
+_lock = threading.Lock()
+
+
+def get_client(api_key):
+    """Returns the process-wide openai.Client for `api_key`."""
+    with _lock:
+        if api_key not in _clients:
+            import openai  # Deferred: takes longer to import than a short run takes
+            _clients[api_key] = openai.Client(api_key=api_key)
+        return _clients[api_key]
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at `rate_per_minute`."""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        """Blocks until `amount` tokens are available, then takes them."""
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute limits, as the API enforces them."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    def acquire(self, tokens):
+        self.requests.acquire(1)
+        self.tokens.acquire(tokens)
+
+
+def get_limiter(requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE):
+    """Returns the process-wide limiter for these limits."""
+    key = (requests_per_minute, tokens_per_minute)
+    with _lock:
+        if key not in _limiters:
+            _limiters[key] = RateLimiter(requests_per_minute, tokens_per_minute)
+        return _limiters[key]
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token for English)."""
+    return len(text) // 4 + 1
+
+
+def complete(prompt, model, api_key, limiter=None, output_tokens=EXPECTED_OUTPUT_TOKENS):
+    """Runs one zero-temperature chat completion and returns the reply text."""
+    if limiter is not None:
+        with metrics.timer("llm_rate_limit_wait"):
+            limiter.acquire(estimate_tokens(prompt) + output_tokens)
+    metrics.inc("api_calls", model=model)
+    try:
+        with metrics.timer("llm_api_call"):
+            response = get_client(api_key).chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0
+            )
+    except Exception as e:
+        metrics.error("llm_api_call", e)
+        raise
+    return response.choices[0].message.content
+
+
+def map_ordered(fn, items, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Applies `fn` to every item on up to `concurrency` threads and returns the
+    results in the same order as `items`.
+    """
+    items = list(items)
+    if concurrency <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(items))) as pool:
+        return list(pool.map(fn, items))
+
+
+# --- VERDICT PARSING ---
+def parse_label(content, field, labels):
+    """
+    Reads a "FIELD: LABEL" line (brackets optional) from a single-email
+    reply. Returns the label, or None if the line is missing or ambiguous.
+    Unlike a substring test, a reason that merely mentions a label doesn't count.
+    """
+    pattern = rf"^\W*{re.escape(field)}\W*:\W*\[?\s*({'|'.join(map(re.escape, labels))})\b"
+    match = re.search(pattern, content or "", re.IGNORECASE | re.MULTILINE)
+    return match.group(1).upper() if match else None
+
+
+# --- BATCH MODE ---
+def build_batch_prompt(instructions, emails, labels):
+    """
+    `emails` is a list of {"id", "subject", "body"} dicts. The shared
+    instructions are sent once for the whole batch.
+    """
+    label_list = " or ".join(f'"{label}"' for label in labels)
+    return f"""
+    {instructions.strip()}
+
+    Classify EACH of the {len(emails)} emails below independently.
+    Respond with ONLY a JSON array (no prose, no code fences) containing exactly one object per email:
+    [{{"id": <email id>, "verdict": {label_list}, "reason": "<short explanation>"}}]
+
+    Emails (JSON):
+    {json.dumps(emails, ensure_ascii=False)}
+    """
+
+
+def parse_batch_verdicts(content, ids, labels):
+    """
+    Strictly validates a batch reply. Returns {id: {"verdict", "reason"}} for
+    the well-formed items only; anything else is silently left out so the
+    caller can fall back for it.
+    """
+    text = (content or "").strip()
+    # Tolerate a ```json fence, nothing else.
+    fenced = re.fullmatch(r"```(?:json)?\s*(.*?)\s*```", text, re.DOTALL)
+    if fenced:
+        text = fenced.group(1)
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return {}
+    if not isinstance(data, list):
+        return {}
+
+    wanted = set(ids)
+    verdicts, seen_twice = {}, set()
+    for item in data:
+        if not isinstance(item, dict) or set(item) != {"id", "verdict", "reason"}:
+            continue
+        item_id, verdict, reason = item["id"], item["verdict"], item["reason"]
+        if type(item_id) is not int or item_id not in wanted:
+            continue
+        if verdict not in labels or not isinstance(reason, str):
+            continue
+        if item_id in verdicts:
+            seen_twice.add(item_id)
+        verdicts[item_id] = {"verdict": verdict, "reason": reason.strip()}
+    # Contradicting (or repeated) answers for one email: trust neither.
+    for item_id in seen_twice:
+        del verdicts[item_id]
+    return verdicts
+
+
+def classify_batch(emails, instructions, labels, model, api_key, limiter=None):
+    """Sends one batched request; returns parse_batch_verdicts() of the reply."""
+    prompt = build_batch_prompt(instructions, emails, labels)
+    content = complete(prompt, model, api_key, limiter, output_tokens=EXPECTED_OUTPUT_TOKENS * len(emails))
+    return parse_batch_verdicts(content, [e["id"] for e in emails], labels)
+
+
+def run_batched(items, batch_fn, single_fn, batch_size, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Classifies `items` in batches of `batch_size`, batches running
+    concurrently. `batch_fn(list of (index, item))` returns {index: result}
+    for whatever it could classify; every item it leaves out is retried
+    with `single_fn(item)`. Returns results in the order of `items`.
+    """
+    items = list(items)
+    if batch_size <= 1:
+        return map_ordered(single_fn, items, concurrency)
+
+    indexed = list(enumerate(items))
+    batches = [indexed[i:i + batch_size] for i in range(0, len(indexed), batch_size)]
+
+    def safe_batch(batch):
+        try:
+            return batch_fn(batch)
+        except Exception as e:
+            metrics.error("llm_batch", e)
+            print(f"   [WARN] Batch of {len(batch)} failed ({e}), retrying one by one.")
+            return {}
+
+    results = [None] * len(items)
+    done = set()
+    for parsed in map_ordered(safe_batch, batches, concurrency):
+        for index, result in parsed.items():
+            results[index] = result
+            done.add(index)
+
+    retry = [i for i in range(len(items)) if i not in done]
+    if retry:
+        metrics.inc("llm_batch_fallbacks", len(retry))
+        print(f"   {len(retry)} of {len(items)} emails had no valid batch verdict, asking one by one...")
+        for index, result in zip(retry, map_ordered(lambda i: single_fn(items[i]), retry, concurrency)):
+            results[index] = result
+    return results
+
+
+# --- CACHED CLASSIFICATION ---
+class Classifier:
+    """
+    One LLM check over (subject, body) pairs, with its settings:
+
+        prompt(subject, body)     the single-email prompt; the reply must
+                                  have a "<field>: <label>" line and may
+                                  have a "REASON: ..." line
+        instructions              what the batch prompt asks (see
+                                  build_batch_prompt())
+        to_result(label, reason)  what callers get back and the cache keeps
+                                  (must be JSON-serializable)
+
+    Results are None where no valid verdict could be had (API error, reply
+    without a label); those are never cached, so the next run asks again.
+    """
+
+    def __init__(self, prompt, instructions, field, labels, to_result, model, api_key,
+                 prompt_version, batch_prompt_version, cache_file=llmcache.CACHE_FILE,
+                 batch_size=1, concurrency=DEFAULT_CONCURRENCY, limiter=None):
+        self.prompt = prompt
+        self.instructions = instructions
+        self.field = field
+        self.labels = labels
+        self.to_result = to_result
+        self.model = model
+        self.api_key = api_key
+        self.prompt_version = prompt_version
+        self.batch_prompt_version = batch_prompt_version
+        self.cache = llmcache.open_cache(cache_file)
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.limiter = limiter
+
+    def classify(self, subject, body):
+        """One email, one request (unless cached). Returns the result or None."""
+        key = llmcache.make_key(subject, body, self.prompt_version, self.model)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        try:
+            content = complete(self.prompt(subject, body), self.model, self.api_key, self.limiter)
+            # Only the label line counts, not a label mentioned anywhere in the reply
+            label = parse_label(content, self.field, self.labels)
+            if label is None:
+                raise ValueError(f"No {self.field} line in the reply")
+        except Exception as e:
+            metrics.error("llm", e)
+            print(f"   [WARN] LLM error: {e}")
+            return None
+        reason = content.split("REASON:")[1].strip() if "REASON:" in content else content
+        result = self.to_result(label, reason)
+        self.cache.put(key, result)
+        return result
+
+    def classify_many(self, emails):
+        """
+        A list of (subject, body) pairs, batch_size per request and
+        concurrency requests at a time. Returns one result (or None) per
+        email, in order.
+        """
+        keys = [llmcache.make_key(subject, body, self.batch_prompt_version, self.model) for subject, body in emails]
+        results = [self.cache.get(key) for key in keys]
+        todo = [i for i, result in enumerate(results) if result is None]
+        if not todo:
+            return results
+
+        def classify(batch):
+            parsed = classify_batch(
+                [{"id": i, "subject": subject, "body": body} for i, (_, (subject, body)) in batch],
+                self.instructions, self.labels, self.model, self.api_key, self.limiter
+            )
+            found = {}
+            for i, (key, _) in batch:
+                if i in parsed:
+                    found[i] = self.to_result(parsed[i]["verdict"], parsed[i]["reason"])
+                    self.cache.put(key, found[i])
+            return found
+
+        def fallback(item):
+            # Also cached under the batch key, or every rerun would ask again
+            key, (subject, body) = item
+            result = self.classify(subject, body)
+            if result is not None:
+                self.cache.put(key, result)
+            return result
+
+        fresh = run_batched([(keys[i], emails[i]) for i in todo], classify, fallback,
+                            self.batch_size, self.concurrency)
+        for i, result in zip(todo, fresh):
+            results[i] = result
+        return results
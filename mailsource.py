@@ -0,0 +1,281 @@
+"""
+Message sources: the live inbox over IMAP, or a local corpus for replays.
+
+Every source has the same interface, messages(needs_body), which yields
+(message id, email.message.Message) one message at a time and takes the
+same needs_body(msg) hook as imapfetch.fetch_header_first(): the headers
+are parsed first and the body only if the hook asks for it. Local sources
+read one message into memory at a time, so a multi-GB mbox replays in
+constant memory.
+
+    IMAPSource(mail, "inbox", state, 40)    the selected mailbox (incremental with a state dict)
+    MboxSource("archive.mbox")              mbox / mboxrd file
+    MaildirSource("~/Maildir")              Maildir (cur/ and new/)
+    EmlDirSource("corpus/")                 directory tree of .eml files
+
+open_source(path) picks the local source that fits the path.
+
+For big backfills, ParallelSource(local source, body_fn) moves the CPU
+work (MIME parsing and body extraction) to a process pool. Workers send
+back compact records, only the headers the filters look at, the decoded
+subject and the capped body. These are rebuilt into small text/plain
+messages in the original order, with a bounded number of batches in
+flight so memory stays flat.
+"""
+import email
+import os
+import re
+from collections import deque
+from email.message import Message
+from email.parser import BytesParser
+
+import decision
+import imapfetch
+import mailstate
+import metrics
+
+PARALLEL_BATCH = 64  # Messages per task sent to a worker
+BATCHES_IN_FLIGHT = 2  # Per worker; bounds how much raw mail sits in memory
+# What survives the trip back from a worker (plus the decoded Subject)
+KEEP_HEADERS = ("From", "To", "Date", "Message-ID", "In-Reply-To", "References",
+                "List-Unsubscribe", "List-Id", "Auto-Submitted", "Precedence")
+
+_header_parser = BytesParser()
+_MBOXRD_QUOTED_RE = re.compile(rb"^>(>*From )")
+_KEEP = {name.lower() for name in KEEP_HEADERS}
+
+
+def _parse(raw, needs_body):
+    """Headers only if needs_body(msg) says the body isn't wanted, else the whole message."""
+    if needs_body is not None:
+        with metrics.timer("parse"):
+            msg = _header_parser.parsebytes(raw, headersonly=True)
+        if not needs_body(msg):
+            return msg
+    with metrics.timer("parse"):
+        return email.message_from_bytes(raw)
+
+
+class IMAPSource:
+    """
+    The selected IMAP mailbox. With a `state` dict only mail above its
+    high-water mark is fetched, and the mark advances as messages are
+    yielded (the caller saves the state); otherwise the newest `count`.
+    With auto_mark=False the caller advances it with mark_processed(uid)
+    instead, e.g. once the message is logged.
+    """
+
+    def __init__(self, mail, mailbox="inbox", state=None, count=40, key=None, auto_mark=True):
+        self.mail = mail
+        self.mailbox = mailbox
+        self.state = state
+        self.count = count
+        self.key = key or mailbox
+        self.auto_mark = auto_mark
+        self.uidvalidity = None
+
+    def mark_processed(self, uid):
+        if self.state is not None:
+            mailstate.mark_processed(self.state, self.key, self.uidvalidity, uid)
+
+    def messages(self, needs_body=None):
+        if self.state is not None:
+            self.uidvalidity, uids = mailstate.select_new_uids(self.mail, self.mailbox, self.state, self.count, key=self.key)
+            print(f"Scanning {len(uids)} new emails...")
+        else:
+            _, data = self.mail.uid("search", None, "ALL")
+            uids = (data[0] or b"").split()[-self.count:]
+            print(f"Scanning last {len(uids)} emails...")
+
+        # Headers first, bodies only for messages that need_body(); fetched in
+        # batches of imapfetch.FETCH_CHUNK_SIZE and streamed one at a time
+        for uid, msg in imapfetch.fetch_header_first(self.mail, uids, needs_body or (lambda msg: True)):
+            if self.auto_mark:
+                self.mark_processed(uid)
+            yield uid, msg
+
+
+class MboxSource:
+    """An mbox file, split on "From " lines while reading (never loaded whole)."""
+
+    def __init__(self, path):
+        self.path = path
+
+    kind = "mbox"
+
+    def _split(self):
+        with open(self.path, "rb") as f:
+            lines, blank = [], True
+            for line in f:
+                if blank and line.startswith(b"From "):
+                    if lines:
+                        yield b"".join(lines)
+                    lines, blank = [], False
+                    continue
+                blank = not line.strip()
+                lines.append(_MBOXRD_QUOTED_RE.sub(rb"\1", line) if line.startswith(b">") else line)
+            if lines:
+                yield b"".join(lines)
+
+    def raw_messages(self):
+        """Yields (message number, raw bytes)."""
+        for i, raw in enumerate(self._split(), 1):
+            metrics.inc("bytes_fetched", len(raw), source="local")
+            yield i, raw
+
+    def messages(self, needs_body=None):
+        print(f"Replaying {self.path} ({self.kind})...")
+        for i, raw in self.raw_messages():
+            yield i, _parse(raw, needs_body)
+
+
+class _FileSource:
+    """One message per file; subclasses say which files."""
+
+    kind = ""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _files(self):
+        raise NotImplementedError
+
+    def raw_messages(self):
+        """Yields (file name relative to the source, raw bytes)."""
+        for path in self._files():
+            try:
+                with open(path, "rb") as f:
+                    raw = f.read()
+            except OSError as e:
+                print(f"   [WARN] Skipping {path}: {e}")
+                continue
+            metrics.inc("bytes_fetched", len(raw), source="local")
+            yield (os.path.relpath(path, self.path) if path != self.path else os.path.basename(path)), raw
+
+    def messages(self, needs_body=None):
+        print(f"Replaying {self.path} ({self.kind})...")
+        for name, raw in self.raw_messages():
+            yield name, _parse(raw, needs_body)
+
+
+class MaildirSource(_FileSource):
+    """A Maildir: cur/ then new/, in file name (delivery) order."""
+
+    kind = "Maildir"
+
+    def _files(self):
+        for sub in ("cur", "new"):
+            folder = os.path.join(self.path, sub)
+            if os.path.isdir(folder):
+                for name in sorted(os.listdir(folder)):
+                    if not name.startswith("."):
+                        yield os.path.join(folder, name)
+
+
+class EmlDirSource(_FileSource):
+    """Every *.eml file under a directory, walked in sorted order."""
+
+    kind = ".eml files"
+
+    def _files(self):
+        if os.path.isfile(self.path):
+            yield self.path
+            return
+        for root, dirs, files in os.walk(self.path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(".eml"):
+                    yield os.path.join(root, name)
+
+
+# --- PARALLEL PARSING ---
+def parse_compact(raws, body_fn):
+    """
+    Worker side of ParallelSource: parses each raw message and returns
+    (kept headers, decoded subject, body_fn(msg)) per message.
+    """
+    records = []
+    for raw in raws:
+        try:
+            msg = email.message_from_bytes(raw)
+            headers = [(name, str(value)) for name, value in msg.items() if name.lower() in _KEEP]
+            records.append((headers, decision.decode_subject(msg), body_fn(msg)))
+        except Exception as e:
+            records.append(e)
+    return records
+
+
+def _rebuild(headers, subject, body):
+    """A compact record as a single-part text/plain message the filters can read."""
+    msg = Message()
+    for name, value in headers:
+        msg[name] = value
+    msg["Subject"] = subject
+    msg["Content-Type"] = "text/plain"
+    msg.set_payload(body, "utf-8")
+    return msg
+
+
+class ParallelSource:
+    """
+    Wraps a local source and parses it on `workers` processes (default: all
+    cores). body_fn(msg) runs in the workers, so it must be a module-level
+    function (e.g. the script's clean_email_body). Messages come back in the
+    source's order; needs_body is not consulted since the workers extract
+    every body anyway.
+    """
+
+    def __init__(self, source, body_fn, workers=None, batch_size=PARALLEL_BATCH):
+        self.source = source
+        self.body_fn = body_fn
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+
+    def _batches(self):
+        batch = []
+        for name, raw in self.source.raw_messages():
+            batch.append((name, raw))
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def messages(self, needs_body=None):
+        from concurrent.futures import ProcessPoolExecutor  # Deferred: only replays use worker processes
+
+        print(f"Replaying {self.source.path} ({self.source.kind}) on {self.workers} worker processes...")
+        in_flight = deque()
+        with ProcessPoolExecutor(self.workers) as pool:
+            batches = self._batches()
+            while True:
+                # Keep the pool busy, but never read too far ahead of the consumer
+                while len(in_flight) < self.workers * BATCHES_IN_FLIGHT:
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    names = [name for name, _ in batch]
+                    in_flight.append((names, pool.submit(parse_compact, [raw for _, raw in batch], self.body_fn)))
+                if not in_flight:
+                    return
+                names, future = in_flight.popleft()
+                for name, record in zip(names, future.result()):
+                    if isinstance(record, Exception):
+                        metrics.error("parse", record)
+                        print(f"   [WARN] Could not parse {name}: {record}")
+                        continue
+                    yield name, _rebuild(*record)
+
+
+def open_source(path):
+    """The local source for `path`: a Maildir, a directory (or file) of .eml, or an mbox file."""
+    path = os.path.expanduser(path)
+    if os.path.isdir(path):
+        if os.path.isdir(os.path.join(path, "cur")) or os.path.isdir(os.path.join(path, "new")):
+            return MaildirSource(path)
+        return EmlDirSource(path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No such mbox, Maildir or .eml corpus: {path}")
+    if path.lower().endswith(".eml"):
+        return EmlDirSource(path)
+    return MboxSource(path)
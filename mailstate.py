@@ -0,0 +1,81 @@
+"""
+Persistent IMAP high-water mark.
+
+Remembers, per mailbox, the UIDVALIDITY and the highest UID we have already
+processed, so each run only fetches `UID n+1:*` instead of re-scanning the
+last EMAIL_COUNT messages.
+"""
+import json
+import os
+import re
+
+
+def load_state(path):
+    """Reads the state file. Returns an empty dict if it does not exist yet."""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (ValueError, OSError) as e:
+        print(f"   [WARN] Could not read {path} ({e}), starting fresh.")
+        return {}
+
+
+def save_state(path, state):
+    """Writes the state file atomically (write-then-rename)."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def get_uidvalidity(mail, mailbox):
+    """Returns the UIDVALIDITY of the selected mailbox as an int."""
+    # SELECT already sends it as an untagged response, so try that first.
+    data = mail.untagged_responses.get("UIDVALIDITY")
+    if data and data[-1]:
+        return int(data[-1])
+
+    _, status = mail.status(mailbox, "(UIDVALIDITY)")
+    match = re.search(rb"UIDVALIDITY (\d+)", status[0] or b"")
+    return int(match.group(1)) if match else 0
+
+
+def select_new_uids(mail, mailbox, state, bootstrap_count, key=None):
+    """
+    Returns (uidvalidity, uids) for the mailbox that is currently selected.
+    `key` names the high-water mark (default: the mailbox), so several
+    passes over one mailbox can each keep their own.
+
+    With a stored high-water mark we only ask for `UID last+1:*`, however many
+    messages that is. On the first run (or after the server reset
+    UIDVALIDITY) there is nothing to compare against, so we fall back to the
+    newest `bootstrap_count` messages.
+    """
+    uidvalidity = get_uidvalidity(mail, mailbox)
+    key = key or mailbox
+    entry = state.get(key)
+
+    if entry and entry.get("uidvalidity") == uidvalidity:
+        last_uid = entry.get("last_uid", 0)
+        _, data = mail.uid("search", None, f"UID {last_uid + 1}:*")
+        # "n:*" always matches the newest message, even if its UID is < n.
+        uids = [u for u in (data[0] or b"").split() if int(u) > last_uid]
+        return uidvalidity, uids
+
+    if entry:
+        print(f"   [WARN] UIDVALIDITY changed for {key}, resetting high-water mark.")
+
+    _, data = mail.uid("search", None, "ALL")
+    uids = (data[0] or b"").split()
+    return uidvalidity, uids[-bootstrap_count:]
+
+
+def mark_processed(state, key, uidvalidity, uid):
+    """Advances the high-water mark `key` (normally the mailbox) to `uid` (never backwards)."""
+    entry = state.get(key)
+    if not entry or entry.get("uidvalidity") != uidvalidity:
+        entry = {"uidvalidity": uidvalidity, "last_uid": 0}
+        state[key] = entry
+    entry["last_uid"] = max(entry["last_uid"], int(uid))
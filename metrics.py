@@ -0,0 +1,235 @@
+"""
+Stage timers and counters for the scan loop.
+
+The modules record into one process-wide registry:
+
+    with metrics.timer("clean_body"):
+        body = clean_email_body(msg)
+    metrics.inc("emails", action="IGNORED")
+    metrics.inc("bytes_fetched", len(data))
+
+Timers keep a count, a total, a maximum and histogram buckets per stage,
+so they can be read three ways: summary() formats a table for the end of a
+one-shot run, write_prometheus() writes the Prometheus text format to a
+file (atomically, for node_exporter's textfile collector) and serve()
+answers GET /metrics on a local port from a background thread.
+
+profile(directory) is an opt-in cProfile hook that dumps one .prof file
+per run, including the pipeline's stage threads; view it with `python -m pstats` or snakeviz.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+PREFIX = "gatekeeper"
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)  # Seconds
+
+_lock = threading.Lock()
+_counters = {}  # (name, ((label, value), ...)) -> float
+_timers = {}  # stage -> [count, total, max, bucket counts...]
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    """Adds `amount` to the counter `name` (one series per label combination)."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def error(stage, exc):
+    """Counts an exception, by stage and exception type."""
+    inc("errors", stage=stage, type=type(exc).__name__)
+
+
+def observe(stage, seconds):
+    with _lock:
+        entry = _timers.get(stage)
+        if entry is None:
+            entry = _timers[stage] = [0, 0.0, 0.0] + [0] * len(BUCKETS)
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                entry[3 + i] += 1
+
+
+@contextmanager
+def timer(stage):
+    """Times the block as one call of `stage` (also when it raises)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def timed_iter(stage, iterable):
+    """Yields from `iterable`, timing each step as `stage` (e.g. a fetching generator)."""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            observe(stage, time.perf_counter() - start)
+        yield item
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+
+
+# --- OUTPUT ---
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def prometheus_text():
+    """All series in the Prometheus text exposition format."""
+    with _lock:
+        counters = sorted(_counters.items())
+        timers = sorted((stage, list(entry)) for stage, entry in _timers.items())
+
+    lines, typed = [], set()
+    for (name, labels), value in counters:
+        metric = f"{PREFIX}_{name}_total"
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} counter")
+            typed.add(metric)
+        lines.append(f"{metric}{_labels(labels)} {value:.15g}")
+
+    metric = f"{PREFIX}_stage_seconds"
+    if timers:
+        lines.append(f"# TYPE {metric} histogram")
+    for stage, (count, total, _, *buckets) in timers:
+        for bound, n in zip(BUCKETS, buckets):
+            lines.append(f'{metric}_bucket{{stage="{stage}",le="{bound:g}"}} {n}')
+        lines.append(f'{metric}_bucket{{stage="{stage}",le="+Inf"}} {count}')
+        lines.append(f'{metric}_sum{{stage="{stage}"}} {total:.6f}')
+        lines.append(f'{metric}_count{{stage="{stage}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path):
+    """Writes prometheus_text() to `path` via a temporary file and rename."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(prometheus_text())
+    os.replace(tmp_path, path)
+
+
+def summary():
+    """A plain-text table of stage timings and counters for the end of a run."""
+    with _lock:
+        counters = sorted(_counters.items())
+        timers = sorted(_timers.items(), key=lambda kv: -kv[1][1])
+
+    lines = [f"{'Stage':<22}{'calls':>8}{'total s':>10}{'mean ms':>10}{'max ms':>10}"]
+    for stage, (count, total, longest, *_) in timers:
+        lines.append(f"{stage:<22}{count:>8}{total:>10.2f}{total / count * 1000:>10.1f}{longest * 1000:>10.1f}")
+    if counters:
+        lines.append("")
+        for (name, labels), value in counters:
+            label = name + (" " + " ".join(f"{k}={v}" for k, v in labels) if labels else "")
+            lines.append(f"{label:<50}{value:>12,.0f}")
+    return "\n".join(lines)
+
+
+def serve(port, host="127.0.0.1"):
+    """Serves GET /metrics on host:port from a daemon thread. Returns the server."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # Scrapes every few seconds would drown the console
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics on http://{host}:{port}/metrics")
+    return server
+
+
+_profilers = None  # Per-thread profilers of the running profile() block, else None
+
+
+@contextmanager
+def profile(directory=None):
+    """
+    With a directory, runs the block under cProfile and dumps the stats to
+    <directory>/run_<timestamp>.prof. Without one, does nothing. Threads
+    started with profiled(target) are profiled too and merged into the same
+    file (the pipelined scan's stages).
+    """
+    global _profilers
+    if not directory:
+        yield
+        return
+    import cProfile
+    import pstats
+
+    profiler = cProfile.Profile()
+    _profilers = []
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        with _lock:
+            threads, _profilers = _profilers, None
+        stats = pstats.Stats(profiler)
+        for p in threads:
+            stats.add(p)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"run_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.prof")
+        stats.dump_stats(path)
+        print(f"Profile written to {path}")
+
+
+def profiled(target):
+    """
+    Wraps a thread target so it is profiled while a profile() block runs.
+    cProfile only sees the thread that enabled it (before Python 3.12).
+    """
+    def run(*args, **kwargs):
+        if _profilers is None:
+            return target(*args, **kwargs)
+        import cProfile
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+: the profile() block's profiler already sees every thread
+            return target(*args, **kwargs)
+        try:
+            return target(*args, **kwargs)
+        finally:
+            profiler.disable()
+            with _lock:
+                if _profilers is not None:
+                    _profilers.append(profiler)
+    return run
@@ -0,0 +1,190 @@
+"""
+Pipelined scan: fetching, filtering, the LLM and sending run concurrently.
+
+    fetch thread     source.messages()  (IMAP round trips / file reads, parsing)
+         |  bounded queue
+    calling thread   classify()         (whitelist, reputation, heuristics, ...)
+         |  bounded queue of LLM chunks
+    LLM thread       decide(chunk)      (llmclient fans each chunk out further)
+         |
+    writer thread    write()            (run log and state, in source order)
+
+    dispatch thread  dispatch(last)     (sends queued challenges meanwhile)
+
+Everything between fetching a message and writing its row counts against
+one window of WINDOW messages. When the LLM falls behind, the window fills
+up, classify stops taking messages, the fetch queue fills up and fetching
+pauses, so a slow API holds the mailbox back instead of buffering it in
+memory. Rows are written in the order the source yielded the messages,
+whichever stage finished them; write() is also the place to advance a
+high-water mark, which then never passes an undecided message.
+
+Ctrl-C stops fetching and classifying at once. Chunks already with the
+LLM are finished and written, undecided messages are dropped (they are
+fetched again next run), then KeyboardInterrupt is re-raised.
+"""
+import queue
+import threading
+
+import metrics
+
+QUEUE_SIZE = 100  # Fetched messages waiting for classify
+WINDOW = 500  # Messages between fetching and the run log, all stages together
+DISPATCH_INTERVAL = 5  # Seconds between dispatch() calls while the scan runs
+SHUTDOWN_TIMEOUT = 30  # Seconds to wait for a stage thread after Ctrl-C
+
+_DONE = object()
+
+
+def _put(q, item, stop):
+    """q.put() that gives up once `stop` is set. Returns False if it gave up."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.2)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def run(messages, classify, decide, write, chunk_size, dispatch=None,
+        window=WINDOW, queue_size=QUEUE_SIZE, dispatch_interval=DISPATCH_INTERVAL):
+    """
+    Runs the stages over `messages`, an iterable of (key, message):
+
+        classify(n, message) -> (row, pending)   n counts from 0; pending is
+                                                None when the row is final
+        decide([(row, pending), ...])           fills in the rows, chunk_size
+                                                at a time (fewer when the
+                                                window is full or at the end)
+        write(key, row)                         row is None if a stage failed
+        dispatch(last)                          optional, called every
+                                                dispatch_interval seconds and
+                                                once more (last=True) after
+                                                the last row
+
+    An exception from fetching ends the input: everything fetched before it
+    is still decided and written, then it is re-raised here. An exception
+    from write() stops the pipeline at once (later rows are not written, so
+    a high-water mark never skips them) and is re-raised. A failing
+    classify or decide only costs its messages.
+    """
+    stop = threading.Event()
+    finished = threading.Event()  # All rows written
+    fetch_errors, write_errors = [], []
+    inbox = queue.Queue(queue_size)
+    to_llm = queue.Queue(1)  # One chunk queued while the LLM thread works on another
+    to_writer = queue.Queue()  # Unbounded, but the window limits what is in flight
+    slots = threading.BoundedSemaphore(window)
+
+    def fetch():
+        try:
+            for n, (key, msg) in enumerate(metrics.timed_iter("source", messages)):
+                if not _put(inbox, (n, key, msg), stop):
+                    return
+        except Exception as e:
+            fetch_errors.append(e)  # What was fetched so far is still decided and written
+        _put(inbox, _DONE, stop)
+
+    def llm():
+        while True:
+            chunk = to_llm.get()
+            if chunk is _DONE:
+                break
+            try:
+                decide([(row, pending) for _, _, row, pending in chunk])
+            except Exception as e:
+                metrics.error("llm", e)
+                print(f"Error deciding {len(chunk)} emails: {e}")
+                chunk = [(n, key, None, None) for n, key, _, _ in chunk]
+            for n, key, row, _ in chunk:
+                to_writer.put((n, key, row))
+        to_writer.put(_DONE)
+
+    def writer():
+        waiting, next_n = {}, 0
+        while True:
+            item = to_writer.get()
+            if item is _DONE:
+                break
+            waiting[item[0]] = item
+            while next_n in waiting:
+                _, key, row = waiting.pop(next_n)
+                next_n += 1
+                if not write_errors:
+                    try:
+                        write(key, row)
+                    except Exception as e:
+                        write_errors.append(e)
+                        stop.set()
+                slots.release()
+        finished.set()
+
+    def dispatcher():
+        while not finished.wait(dispatch_interval):
+            if stop.is_set():
+                return
+            dispatch(False)
+        dispatch(True)
+
+    threads = [threading.Thread(target=metrics.profiled(fetch), name="fetch", daemon=True),
+               threading.Thread(target=metrics.profiled(llm), name="llm", daemon=True),
+               threading.Thread(target=metrics.profiled(writer), name="writer", daemon=True)]
+    if dispatch is not None:
+        threads.append(threading.Thread(target=metrics.profiled(dispatcher), name="dispatch", daemon=True))
+    for thread in threads:
+        thread.start()
+
+    pending = []  # (n, key, row, pending) waiting to fill a chunk
+
+    def send_chunk():
+        nonlocal pending
+        if pending:
+            to_llm.put(pending)
+            pending = []
+
+    interrupted = False
+    try:
+        while not stop.is_set():
+            try:
+                item = inbox.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                break
+            n, key, msg = item
+            if not slots.acquire(blocking=False):
+                send_chunk()  # The window may be waiting on these
+                slots.acquire()
+            try:
+                row, waits_for = classify(n, msg)
+            except Exception as e:
+                metrics.error("scan", e)
+                print(f"Error processing email: {e}")
+                row, waits_for = None, None
+            if waits_for is None:
+                to_writer.put((n, key, row))
+            else:
+                pending.append((n, key, row, waits_for))
+                if len(pending) >= chunk_size:
+                    send_chunk()
+        if not stop.is_set():
+            send_chunk()
+    except KeyboardInterrupt:
+        interrupted = True
+        print("\nInterrupted: finishing the emails already with the LLM...")
+        stop.set()
+        pending = []  # Undecided, so not logged and not marked as processed
+        try:
+            to_llm.get_nowait()  # Nor is the chunk waiting behind the current one
+        except queue.Empty:
+            pass
+    finally:
+        to_llm.put(_DONE)
+        for thread in threads:
+            thread.join(SHUTDOWN_TIMEOUT if interrupted else None)
+
+    if interrupted:
+        raise KeyboardInterrupt
+    if write_errors or fetch_errors:
+        raise (write_errors + fetch_errors)[0]
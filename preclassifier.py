@@ -0,0 +1,213 @@
+"""
+Local spam/ham pre-classifier, trained on the CSVs test1.py and test2.py write.
+
+Features are hashed word unigrams and bigrams of the From header, subject
+and body snippet; the model is a logistic regression fitted with plain
+NumPy. Scoring a message is a handful of hashes and one sum over the
+weight vector, so the gatekeeper can settle the confident cases on-box and
+only send the uncertain band to the LLM.
+
+Train (labels come from Human_Review when filled in, else LLM_Prediction):
+
+    python preclassifier.py paranoid_spam_test_*.csv [--human-only] [--out preclassifier.npz]
+
+Train on test2.py ("personal-only") results for the gatekeeper: its HAM
+means "written by a person", which is the question llm_analysis() asks.
+"""
+import argparse
+import csv
+import os
+import re
+import threading
+import zlib
+
+import numpy as np
+
+MODEL_FILE = "preclassifier.npz"
+N_FEATURES = 2 ** 18  # Hashed feature space (power of two)
+SNIPPET_CHARS = 100  # The CSVs keep body[:100]; score the same amount
+EPOCHS = 300
+LEARNING_RATE = 0.5
+L2 = 1e-4
+HOLDOUT_FRACTION = 0.2
+DEFAULT_BAND = (0.1, 0.9)  # P(spam) inside this band is "not sure"
+
+_WORD_RE = re.compile(r"[a-z0-9$€£%!']+")
+
+
+# --- FEATURES ---
+def _tokens(prefix, text):
+    words = _WORD_RE.findall(str(text or "").lower())
+    yield from (f"{prefix}:{w}" for w in words)
+    yield from (f"{prefix}:{a} {b}" for a, b in zip(words, words[1:]))
+
+
+def features(sender, subject, body):
+    """Sorted unique hashed feature indices for one message."""
+    tokens = [*_tokens("f", sender), *_tokens("s", subject), *_tokens("b", str(body or "")[:SNIPPET_CHARS])]
+    # crc32 rather than hash(): str hashes are salted per process.
+    return np.unique(np.fromiter((zlib.crc32(t.encode("utf-8")) for t in tokens), np.uint32, len(tokens))
+                     & np.uint32(N_FEATURES - 1)).astype(np.int64)
+
+
+# --- MODEL ---
+class PreClassifier:
+    """A trained model. decide() returns ("SPAM" | "HAM" | None, p_spam); None means ask the LLM."""
+
+    def __init__(self, weights, bias):
+        self.weights = weights
+        self.bias = float(bias)
+
+    def spam_probability(self, sender, subject, body):
+        z = self.bias + self.weights[features(sender, subject, body)].sum()
+        return float(1.0 / (1.0 + np.exp(-z)))
+
+    def decide(self, sender, subject, body, band=DEFAULT_BAND):
+        p = self.spam_probability(sender, subject, body)
+        if p >= band[1]:
+            return "SPAM", p
+        if p <= band[0]:
+            return "HAM", p
+        return None, p
+
+    def save(self, path=MODEL_FILE):
+        tmp = path + ".tmp.npz"
+        np.savez_compressed(tmp, weights=self.weights, bias=self.bias, n_features=N_FEATURES)
+        os.replace(tmp, path)
+
+
+def _stack(rows):
+    """Flattened feature indices plus the row each one belongs to."""
+    lengths = [len(r) for r in rows]
+    indices = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+    return indices, np.repeat(np.arange(len(rows)), lengths)
+
+
+def train(samples, epochs=EPOCHS, learning_rate=LEARNING_RATE, l2=L2):
+    """
+    Fits a logistic regression on (sender, subject, body, is_spam) samples
+    with full-batch AdaGrad. Returns a PreClassifier.
+    """
+    rows = [features(s, subj, body) for s, subj, body, _ in samples]
+    y = np.array([1.0 if is_spam else 0.0 for *_, is_spam in samples])
+    indices, row_of = _stack(rows)
+
+    weights = np.zeros(N_FEATURES)
+    bias = 0.0
+    g2_w = np.full(N_FEATURES, 1e-8)
+    g2_b = 1e-8
+    n = max(len(rows), 1)
+    for _ in range(epochs):
+        z = bias + np.bincount(row_of, weights=weights[indices], minlength=len(rows))
+        p = 1.0 / (1.0 + np.exp(-z))
+        err = (p - y) / n
+        grad = np.bincount(indices, weights=err[row_of], minlength=N_FEATURES) + l2 * weights
+        grad_b = err.sum()
+        g2_w += grad * grad
+        g2_b += grad_b * grad_b
+        weights -= learning_rate * grad / np.sqrt(g2_w)
+        bias -= learning_rate * grad_b / np.sqrt(g2_b)
+    return PreClassifier(weights, bias)
+
+
+# --- TRAINING DATA ---
+def load_labeled_csvs(paths, human_only=False):
+    """
+    Reads test1/test2 result CSVs into (sender, subject, body, is_spam).
+    Human_Review wins over LLM_Prediction; rows without a SPAM/HAM label are skipped,
+    and so are LLM labels from failed calls (older CSVs logged those as HAM).
+    """
+    samples = []
+    for path in paths:
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                label = (row.get("Human_Review") or "").strip().upper()
+                if label not in ("SPAM", "HAM") and not human_only:
+                    if (row.get("LLM_Reason") or "").startswith("Error"):
+                        continue
+                    label = (row.get("LLM_Prediction") or "").strip().upper()
+                if label not in ("SPAM", "HAM"):
+                    continue
+                samples.append((row.get("From", ""), row.get("Subject", ""), row.get("Body_Snippet", ""), label == "SPAM"))
+    return samples
+
+
+# --- LOADING ---
+_lock = threading.Lock()
+_cache = {"path": None, "mtime": None, "model": None}
+
+
+def load_model(path=MODEL_FILE):
+    with np.load(path) as data:
+        if int(data["n_features"]) != N_FEATURES:
+            raise ValueError(f"{path} was trained with a different N_FEATURES, retrain it")
+        return PreClassifier(data["weights"], data["bias"])
+
+
+def get_model(path=MODEL_FILE):
+    """
+    Returns the trained model, reloading it after a retrain, or None if
+    nothing has been trained yet.
+    """
+    with _lock:
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        if _cache["path"] != path or _cache["mtime"] != mtime:
+            try:
+                _cache["model"] = load_model(path)
+            except Exception as e:
+                print(f"   [WARN] Could not load {path}: {e}")
+                if _cache["path"] != path:
+                    _cache["model"] = None
+            _cache["path"], _cache["mtime"] = path, mtime
+        return _cache["model"]
+
+
+# --- TRAINING COMMAND ---
+def _report(model, samples, band):
+    if not samples:
+        return
+    decided = correct = right = 0
+    for sender, subject, body, is_spam in samples:
+        verdict, p = model.decide(sender, subject, body, band)
+        right += (p >= 0.5) == is_spam
+        if verdict is not None:
+            decided += 1
+            correct += (verdict == "SPAM") == is_spam
+    print(f"   accuracy {right / len(samples):.1%} on {len(samples)} held-out rows")
+    print(f"   decided locally: {decided / len(samples):.0%}"
+          + (f", {correct / decided:.1%} of those correct" if decided else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the local pre-classifier from test1/test2 result CSVs.")
+    parser.add_argument("csvs", nargs="+", help="spam_test_*.csv / paranoid_spam_test_*.csv files")
+    parser.add_argument("--human-only", action="store_true", help="Ignore rows without a Human_Review label")
+    parser.add_argument("--out", default=MODEL_FILE)
+    parser.add_argument("--band", type=float, nargs=2, default=DEFAULT_BAND, metavar=("LOW", "HIGH"),
+                        help="P(spam) band reported as undecided")
+    args = parser.parse_args()
+
+    samples = load_labeled_csvs(args.csvs, args.human_only)
+    spam = sum(s[3] for s in samples)
+    print(f"Loaded {len(samples)} labeled rows ({spam} SPAM, {len(samples) - spam} HAM)")
+    if spam == 0 or spam == len(samples):
+        print("Need both SPAM and HAM examples to train.")
+        return
+
+    order = np.random.default_rng(0).permutation(len(samples))
+    cut = int(len(samples) * (1 - HOLDOUT_FRACTION))
+    holdout = [samples[i] for i in order[cut:]]
+    if holdout:
+        print("Validating on a held-out split...")
+        _report(train([samples[i] for i in order[:cut]]), holdout, args.band)
+
+    model = train(samples)
+    model.save(args.out)
+    print(f"Saved model trained on all {len(samples)} rows to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Persistent sender / domain reputation.
+
+Verdicts from the header/content heuristics and the LLM are added
+to a per-address and a per-domain tally in a local SQLite file. Tallies
+decay with a half-life, so a sender that changes its ways is re-evaluated
+eventually, and rows not seen for MAX_AGE are dropped. Once a sender has
+enough, consistent history, lookup() decides it with one indexed query
+instead of header checks, a body download and an API call.
+
+Only addresses can be trusted as human; a domain is only ever used to
+recognise bulk senders, and only once several of its addresses look like
+bots. Mailbox providers (gmail.com, outlook.com, ...) host people and
+newsletters alike and are never judged as a whole. Callers pass
+domain=False to record() for verdicts that say nothing about the domain,
+like a List-Unsubscribe header, which mailing lists add to every post by
+a gmail.com member.
+"""
+import math
+import time
+
+from email.utils import parseaddr
+
+import sqlitestore
+
+REPUTATION_FILE = "sender_reputation.sqlite3"
+HALF_LIFE = 30 * 24 * 3600  # Seconds for a verdict to count half as much
+MAX_AGE = 180 * 24 * 3600  # Forget senders not seen for this long
+MIN_OBSERVATIONS = 2.5  # Decayed verdict count needed before deciding (~3 recent verdicts)
+CONFIDENCE = 0.9  # Share of verdicts that must agree
+DOMAIN_MIN_OBSERVATIONS = 9.5  # Domains mix many senders; want more evidence (~10)
+DOMAIN_MIN_SENDERS = 2.5  # Distinct bot addresses needed before a domain counts (~3 recent ones)
+# Mailbox providers: one address says nothing about the next one
+PUBLIC_DOMAINS = frozenset({
+    "gmail.com", "googlemail.com", "outlook.com", "hotmail.com", "live.com", "msn.com",
+    "yahoo.com", "ymail.com", "aol.com", "icloud.com", "me.com", "mac.com",
+    "proton.me", "protonmail.com", "gmx.com", "gmx.de", "gmx.net", "web.de",
+    "mail.com", "zoho.com", "yandex.com", "yandex.ru", "mail.ru", "fastmail.com",
+    "qq.com", "163.com", "126.com",
+})
+EVICT_EVERY = 500  # Writes between expiry sweeps
+
+
+def _keys(sender_email):
+    """("addr:user@host", "domain:host") for an address (domain key may be None)."""
+    address = parseaddr(sender_email or "")[1].strip().lower()
+    domain = address.rpartition("@")[2] if "@" in address else ""
+    if not domain or domain in PUBLIC_DOMAINS:
+        return (f"addr:{address}" if address else None), None
+    return (f"addr:{address}" if address else None), f"domain:{domain}"
+
+
+class ReputationStore(sqlitestore.Store):
+    """SQLite-backed tallies of bot / human verdicts. Safe to share between threads."""
+
+    def __init__(self, path=REPUTATION_FILE, half_life=HALF_LIFE, max_age=MAX_AGE):
+        super().__init__(path, [
+            "CREATE TABLE IF NOT EXISTS reputation ("
+            " key TEXT PRIMARY KEY, bot REAL NOT NULL, human REAL NOT NULL,"
+            " first_seen REAL NOT NULL, last_seen REAL NOT NULL,"
+            " senders REAL NOT NULL DEFAULT 0)",
+            "CREATE INDEX IF NOT EXISTS reputation_last_seen ON reputation (last_seen)",
+        ])
+        self.half_life = half_life
+        self.max_age = max_age
+        self._writes = 0
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(reputation)")]
+        if "senders" not in columns:  # Files from before DOMAIN_MIN_SENDERS; their domains start over
+            self._db.execute("ALTER TABLE reputation ADD COLUMN senders REAL NOT NULL DEFAULT 0")
+            self._db.execute("UPDATE reputation SET bot = 0, human = 0 WHERE key LIKE 'domain:%'")
+            self._db.commit()
+
+    def _decay(self, age):
+        return math.pow(0.5, max(age, 0) / self.half_life)
+
+    def _tallies(self, keys, now):
+        """{key: (bot, human, senders)} with decay applied, for the keys that exist."""
+        keys = [k for k in keys if k]
+        if not keys:
+            return {}
+        rows = self._db.execute(
+            f"SELECT key, bot, human, senders, last_seen FROM reputation WHERE key IN ({','.join('?' * len(keys))})",
+            keys,
+        ).fetchall()
+        return {key: tuple(value * self._decay(now - seen) for value in (bot, human, senders))
+                for key, bot, human, senders, seen in rows if now - seen < self.max_age}
+
+    def lookup(self, sender_email):
+        """
+        Returns "bot", "human" or None (not enough consistent history), plus a
+        short reason for the log.
+        """
+        address_key, domain_key = _keys(sender_email)
+        with self._lock:
+            tallies = self._tallies([address_key, domain_key], time.time())
+
+        verdict = None
+        if address_key in tallies:
+            bot, human, _ = tallies[address_key]
+            total = bot + human
+            if total >= MIN_OBSERVATIONS:
+                if bot / total >= CONFIDENCE:
+                    verdict = "bot", f"Known bulk sender ({total:.0f} past verdicts)"
+                elif human / total >= CONFIDENCE:
+                    verdict = "human", f"Known human sender ({total:.0f} past verdicts)"
+        if verdict is None and domain_key in tallies:
+            bot, human, senders = tallies[domain_key]
+            total = bot + human
+            if total >= DOMAIN_MIN_OBSERVATIONS and senders >= DOMAIN_MIN_SENDERS and bot / total >= CONFIDENCE:
+                verdict = "bot", f"Known bulk domain {domain_key[7:]} ({total:.0f} past verdicts)"
+
+        return verdict or (None, "")
+
+    def record(self, sender_email, is_bot, domain=True):
+        """
+        Adds one verdict to the sender's address tally and, with domain=True,
+        to its domain's. A domain also counts the bot addresses it has seen.
+        """
+        now = time.time()
+        address_key, domain_key = _keys(sender_email)
+        keys = [k for k in (address_key, domain_key if domain else None) if k]
+        with self._lock:
+            current = self._tallies(keys, now)
+            # A first bot verdict for this address: one more bot sender for the domain
+            new_bot_sender = is_bot and current.get(address_key, (0.0,))[0] < 0.5
+            for key in keys:
+                bot, human, senders = current.get(key, (0.0, 0.0, 0.0))
+                if key == domain_key and new_bot_sender:
+                    senders += 1
+                self._db.execute(
+                    "INSERT INTO reputation (key, bot, human, first_seen, last_seen, senders) VALUES (?, ?, ?, ?, ?, ?)"
+                    " ON CONFLICT(key) DO UPDATE SET bot = excluded.bot, human = excluded.human,"
+                    " last_seen = excluded.last_seen, senders = excluded.senders",
+                    (key, bot + (1 if is_bot else 0), human + (0 if is_bot else 1), now, now, senders),
+                )
+            self._db.commit()
+            self._writes += 1
+            if self._writes % EVICT_EVERY == 0:
+                self._evict(now)
+
+    def evict(self):
+        """Drops senders not seen for max_age."""
+        with self._lock:
+            self._evict(time.time())
+
+    def _evict(self, now):
+        self._db.execute("DELETE FROM reputation WHERE last_seen <= ?", (now - self.max_age,))
+        self._db.commit()
+
+    def close(self):
+        self.evict()
+        super().close()
+
+
+_stores = sqlitestore.Registry()
+
+
+def open_store(path=REPUTATION_FILE):
+    """Returns the process-wide ReputationStore for `path`, opening it on first use."""
+    return _stores.get(path, lambda: ReputationStore(path))
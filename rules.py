@@ -0,0 +1,205 @@
+"""
+Config-driven rule engine for the heuristic filters.
+
+Trigger lists, weights, sender patterns and thresholds live in rules.json.
+Each ruleset is compiled into one regex per field (a trie of all its
+patterns wrapped in a lookahead), so a message is scored in a single pass
+over its text no matter how many triggers there are. The file is watched
+and recompiled when it changes.
+
+A ruleset looks like:
+
+    "bot_filter": {
+        "threshold": 1,
+        "groups": [
+            {"field": "sender", "mode": "once", "weight": 1,
+             "reason": "Bot Sender Name", "patterns": ["no-reply", "noreply"]},
+            {"field": "text", "mode": "each", "reason": "Contains '{match}'",
+             "patterns": {"lottery": 5, "urgent": 2}}
+        ]
+    }
+
+`mode` is "each" (every matching pattern scores) or "once" (the group
+scores once, naming its first matching pattern). `patterns` is a list (all
+use the group `weight`) or a {pattern: weight} dict. Matching is plain
+case-sensitive substring matching; callers lowercase "text" themselves.
+"""
+import json
+import os
+import re
+import threading
+import time
+
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules.json")
+RELOAD_CHECK_INTERVAL = 1.0  # Seconds between mtime checks
+
+
+class RulesError(ValueError):
+    """Raised for an invalid rules file or an unknown ruleset."""
+
+
+# --- COMPILATION ---
+def _trie_regex(patterns):
+    """
+    Builds a regex matching any of `patterns`, shaped as a trie so the engine
+    never retries the same prefix. Optional tails are greedy, so at any
+    position it matches the longest pattern that starts there.
+    """
+    trie = {}
+    for pattern in patterns:
+        node = trie
+        for ch in pattern:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def build(node):
+        alternatives = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not alternatives:
+            return ""
+        body = alternatives[0] if len(alternatives) == 1 else "(?:" + "|".join(alternatives) + ")"
+        return f"(?:{body})?" if "" in node else body
+
+    return build(trie)
+
+
+class _FieldMatcher:
+    """Finds every pattern occurring in one field's text, in one regex pass."""
+
+    def __init__(self, patterns):
+        patterns = set(patterns)
+        self.regex = re.compile(f"(?=({_trie_regex(patterns)}))")
+        # The regex only reports the longest pattern at each position; any
+        # shorter pattern starting there is necessarily a prefix of it.
+        self.prefixes = {p: [p[:i] for i in range(1, len(p) + 1) if p[:i] in patterns] for p in patterns}
+
+    def find(self, text):
+        found = set()
+        for m in self.regex.finditer(text):
+            longest = m.group(1)
+            if longest and longest not in found:
+                found.update(self.prefixes[longest])
+        return found
+
+
+class Ruleset:
+    """A compiled ruleset. Use score() to evaluate a message."""
+
+    def __init__(self, name, config):
+        self.name = name
+        try:
+            self.threshold = float(config.get("threshold", 1))
+            self.groups = []
+            patterns_by_field = {}
+            for group in config["groups"]:
+                patterns = group["patterns"]
+                if not isinstance(patterns, dict):
+                    patterns = {p: group.get("weight", 1) for p in patterns}
+                patterns = {str(p): float(w) for p, w in patterns.items() if p}
+                self.groups.append({
+                    "field": group.get("field", "text"),
+                    "mode": group.get("mode", "each"),
+                    "weight": float(group.get("weight", 1)),
+                    "reason": group.get("reason", "Contains '{match}'"),
+                    "patterns": patterns,
+                    "order": {p: i for i, p in enumerate(patterns)},
+                    "feature": group.get("reason", "Contains '{match}'").replace("{match}", "*"),
+                })
+                patterns_by_field.setdefault(self.groups[-1]["field"], []).extend(patterns)
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            raise RulesError(f"Invalid ruleset '{name}': {e!r}")
+
+        self.matchers = {field: _FieldMatcher(p) for field, p in patterns_by_field.items()}
+
+    def features(self):
+        """
+        The scoring units as (name, weight): every pattern of an "each" group
+        (named by the pattern) and every "once" group as a whole (named by
+        its reason, with '*' for the match). score() is the sum of the
+        weights of the units hits() reports.
+        """
+        units = []
+        for group in self.groups:
+            if group["mode"] == "once":
+                units.append((group["feature"], group["weight"]))
+            else:
+                units.extend(group["patterns"].items())
+        return units
+
+    def hits(self, **fields):
+        """
+        The scoring units the given fields (e.g. text=..., sender=...)
+        trigger, as (name, weight, reason) in rule order. Groups whose field
+        wasn't passed are skipped.
+        """
+        found = {field: self.matchers[field].find(value)
+                 for field, value in fields.items() if field in self.matchers and value}
+
+        units = []
+        for group in self.groups:
+            hits = found.get(group["field"])
+            if not hits:
+                continue
+            hits = sorted((p for p in hits if p in group["patterns"]), key=group["order"].get)
+            if not hits:
+                continue
+            if group["mode"] == "once":
+                units.append((group["feature"], group["weight"], group["reason"].format(match=hits[0])))
+            else:
+                for p in hits:
+                    units.append((p, group["patterns"][p], group["reason"].format(match=p)))
+        return units
+
+    def score(self, **fields):
+        """Scores the given fields (see hits()). Returns (score, reasons)."""
+        units = self.hits(**fields)
+        return sum(weight for _, weight, _ in units), [reason for _, _, reason in units]
+
+    def matches(self, **fields):
+        """Returns (is_match, reasons) using the configured threshold."""
+        score, reasons = self.score(**fields)
+        return score >= self.threshold, reasons
+
+
+# --- LOADING / HOT RELOAD ---
+_lock = threading.Lock()
+_cache = {"path": None, "mtime": None, "checked": 0.0, "rulesets": {}}
+
+
+def load_rules(path=RULES_FILE):
+    """Reads and compiles every ruleset in `path`."""
+    with open(path, "r") as f:
+        try:
+            config = json.load(f)
+        except ValueError as e:
+            raise RulesError(f"{path} is not valid JSON: {e}")
+    return {name: Ruleset(name, rs) for name, rs in config.get("rulesets", {}).items()}
+
+
+def get_ruleset(name, path=RULES_FILE):
+    """
+    Returns the compiled ruleset `name`, recompiling if the file changed.
+    A broken edit keeps the last good version running and prints a warning.
+    """
+    with _lock:
+        now = time.monotonic()
+        if _cache["path"] != path or now - _cache["checked"] >= RELOAD_CHECK_INTERVAL:
+            _cache["checked"] = now
+            first_load = _cache["path"] != path
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                if first_load or mtime != _cache["mtime"]:
+                    if not first_load:
+                        _cache["mtime"] = mtime  # Warn about a broken edit only once
+                    _cache["rulesets"] = load_rules(path)
+                    if not first_load:
+                        print(f"   🔄 Reloaded rules from {path}")
+                    _cache["path"], _cache["mtime"] = path, mtime
+            except (RulesError, OSError) as e:
+                if first_load:
+                    raise
+                print(f"   [WARN] Keeping previous rules, could not reload {path}: {e}")
+
+        ruleset = _cache["rulesets"].get(name)
+    if ruleset is None:
+        raise RulesError(f"No ruleset named '{name}' in {path}")
+    return ruleset
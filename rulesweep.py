@@ -0,0 +1,222 @@
+"""
+Offline threshold and weight sweep for the traditional filters of test1.py
+and test2.py.
+
+Each run of a harness stores, per email, the rule units that fired
+(Trigger_Hits, see rules.Ruleset.hits), the LLM verdict and a blank
+Human_Review column. Once the reviews are filled in, those CSVs are all it
+takes to try other rule settings: the hits become a 0/1 matrix (emails x
+units), a set of weight vectors becomes a second matrix, and one product
+gives every email's score under every weight set. Comparing against a
+range of thresholds then yields the confusion matrix of each combination,
+so many thousands of rule configurations are evaluated in seconds, without
+a single API call.
+
+The weight sets are the current ones, each unit switched off on its own,
+and --random sets where every weight is scaled by one of WEIGHT_FACTORS.
+Usually run through the harness, which knows its ruleset (the harnesses
+share the options through add_arguments() and main()):
+
+    python test2.py --sweep paranoid_spam_test_*.csv [--random 5000] [--thresholds 0.5:10:0.5] [--out sweep.csv]
+"""
+import csv
+import json
+import time
+
+try:
+    import numpy as np
+except ImportError:  # Only the sweep needs it; the harnesses import add_arguments() regardless
+    np = None
+
+DEFAULT_RANDOM = 5000  # Random weight sets on top of the current and the ablations
+DEFAULT_THRESHOLDS = "0.5:10:0.5"  # start:stop:step, stop included
+WEIGHT_FACTORS = (0.0, 0.5, 1.0, 1.5, 2.0)
+CHUNK = 1000  # Weight sets scored at once; bounds the (emails x sets x thresholds) array
+LABELS = ("SPAM", "HAM")
+
+
+def parse_thresholds(spec):
+    """'0.5:10:0.5' -> array([0.5, 1.0, ..., 10.0]); '2,4' -> array([2.0, 4.0])."""
+    if ":" in spec:
+        start, stop, step = (float(x) for x in spec.split(":"))
+        return np.round(np.arange(start, stop + step / 2, step), 6)
+    return np.array([float(x) for x in spec.split(",")])
+
+
+# --- LOADING ---
+def load_runs(paths):
+    """
+    Reads harness CSVs. Returns (hits, human, llm, skipped): per reviewed
+    email the list of fired units, Human_Review and LLM_Prediction as
+    booleans (True = SPAM; llm is None where it wasn't SPAM/HAM), plus how
+    many rows had no review.
+    """
+    hits, human, llm = [], [], []
+    skipped = 0
+    for path in paths:
+        with open(path, newline="", encoding="utf-8") as f:
+            reader = csv.DictReader(f)
+            if "Trigger_Hits" not in (reader.fieldnames or []):
+                raise ValueError(f"{path} has no Trigger_Hits column (written before the sweep existed); rerun the harness")
+            for row in reader:
+                review = (row.get("Human_Review") or "").strip().upper()
+                if review not in LABELS:
+                    skipped += 1
+                    continue
+                prediction = (row.get("LLM_Prediction") or "").strip().upper()
+                hits.append(json.loads(row["Trigger_Hits"] or "[]"))
+                human.append(review == "SPAM")
+                llm.append(prediction == "SPAM" if prediction in LABELS else None)
+    return hits, human, llm, skipped
+
+
+def hit_matrix(hits, names):
+    """0/1 matrix, one row per email and one column per unit in `names`. Unknown units are dropped."""
+    column = {name: i for i, name in enumerate(names)}
+    matrix = np.zeros((len(hits), len(names)))
+    for row, fired in enumerate(hits):
+        for name in fired:
+            if name in column:
+                matrix[row, column[name]] = 1
+    return matrix
+
+
+# --- WEIGHT SETS ---
+def weight_sets(defaults, random_count=DEFAULT_RANDOM, seed=0):
+    """
+    Rows of weights: the defaults, then each unit at 0 alone, then
+    `random_count` random rescalings.
+    """
+    defaults = np.asarray(defaults, dtype=float)
+    ablations = np.tile(defaults, (len(defaults), 1))
+    np.fill_diagonal(ablations, 0)
+    rng = np.random.default_rng(seed)
+    factors = rng.choice(WEIGHT_FACTORS, size=(random_count, len(defaults)))
+    return np.vstack([defaults, ablations, defaults * factors])
+
+
+# --- EVALUATION ---
+def confusion(matrix, is_spam, weights, thresholds, chunk=CHUNK):
+    """
+    TP, FP, FN, TN (SPAM is positive) for every weight set x threshold,
+    each an array of shape (len(weights), len(thresholds)).
+    """
+    positive = np.asarray(is_spam, dtype=float)
+    negative = 1 - positive
+    tp = np.empty((len(weights), len(thresholds)))
+    fp = np.empty_like(tp)
+    for start in range(0, len(weights), chunk):
+        scores = matrix @ weights[start:start + chunk].T  # emails x sets
+        flagged = (scores[:, :, None] >= thresholds).astype(float)  # emails x sets x thresholds
+        tp[start:start + chunk] = np.tensordot(positive, flagged, axes=1)
+        fp[start:start + chunk] = np.tensordot(negative, flagged, axes=1)
+    return tp, fp, positive.sum() - tp, negative.sum() - fp
+
+
+def rates(tp, fp, fn, tn):
+    """(precision, recall, F1); 0 where undefined."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.nan_to_num(tp / (tp + fp))
+        recall = np.nan_to_num(tp / (tp + fn))
+        f1 = np.nan_to_num(2 * precision * recall / (precision + recall))
+    return precision, recall, f1
+
+
+# --- REPORT ---
+def _changes(weights, defaults, names, limit=4):
+    """Short description of how a weight set differs from the defaults."""
+    changed = [(names[i], w) for i, (w, d) in enumerate(zip(weights, defaults)) if w != d]
+    if not changed:
+        return "current weights"
+    text = ", ".join(f"{name}={w:g}" for name, w in changed[:limit])
+    return text + (f" (+{len(changed) - limit} more)" if len(changed) > limit else "")
+
+
+def _line(label, threshold, tp, fp, fn, tn):
+    precision, recall, f1 = rates(np.float64(tp), np.float64(fp), np.float64(fn), np.float64(tn))
+    return (f"  {label:<44} {threshold:>9} {precision:>9.3f} {recall:>7.3f} {f1:>6.3f}"
+            f" {tp:>6.0f} {fp:>6.0f} {fn:>6.0f} {tn:>6.0f}")
+
+
+def sweep(paths, features, threshold, random_count=DEFAULT_RANDOM, thresholds=DEFAULT_THRESHOLDS,
+          metric="f1", top=10, out=None, seed=0):
+    """
+    Runs the sweep over harness CSVs. `features` is the harness's
+    [(unit name, weight), ...] and `threshold` its current threshold.
+    Prints the current setting, the stored LLM verdicts and the `top`
+    settings by `metric`; `out` also writes every setting to a CSV.
+    """
+    hits, human, llm, skipped = load_runs(paths)
+    if not hits:
+        print(f"No reviewed emails in {len(paths)} file(s): fill in Human_Review with SPAM or HAM first.")
+        return
+    names = [name for name, _ in features]
+    defaults = [weight for _, weight in features]
+    unknown = sorted({name for fired in hits for name in fired} - set(names))
+    if unknown:
+        print(f"   [WARN] Ignoring units no longer in the rules: {', '.join(unknown)}")
+
+    start = time.perf_counter()
+    matrix = hit_matrix(hits, names)
+    weights = weight_sets(defaults, random_count, seed)
+    grid = parse_thresholds(thresholds) if isinstance(thresholds, str) else np.asarray(thresholds, dtype=float)
+    tp, fp, fn, tn = confusion(matrix, human, weights, grid)
+    precision, recall, f1 = rates(tp, fp, fn, tn)
+    elapsed = time.perf_counter() - start
+
+    print(f"{len(hits):,} reviewed emails ({skipped:,} without Human_Review skipped), "
+          f"{sum(human):,} SPAM / {len(human) - sum(human):,} HAM")
+    print(f"{len(weights):,} weight sets x {len(grid)} thresholds = {tp.size:,} settings in {elapsed:.2f}s")
+    print(f"\n  {'setting':<44} {'threshold':>9} {'precision':>9} {'recall':>7} {'F1':>6}"
+          f" {'TP':>6} {'FP':>6} {'FN':>6} {'TN':>6}")
+
+    current = confusion(matrix, human, weights[:1], np.array([threshold]))
+    print(_line("current rules", f"{threshold:g}", *(a[0, 0] for a in current)))
+    reviewed_llm = [(h, l) for h, l in zip(human, llm) if l is not None]
+    if reviewed_llm:
+        h, l = np.array(reviewed_llm, dtype=bool).T
+        print(_line("LLM (stored verdicts)", "-", (h & l).sum(), (~h & l).sum(), (h & ~l).sum(), (~h & ~l).sum()))
+
+    ranking = {"f1": f1, "precision": precision, "recall": recall}[metric]
+    order = np.argsort(-ranking, axis=None, kind="stable")[:top]
+    print(f"\n  Best {len(order)} by {metric}:")
+    for flat in order:
+        w, t = np.unravel_index(flat, ranking.shape)
+        # Row 0 is the current weights, rows 1..len(names) the ablations
+        label = f"without {names[w - 1]}" if 1 <= w <= len(names) else _changes(weights[w], defaults, names)
+        print(_line(label[:44], f"{grid[t]:g}", tp[w, t], fp[w, t], fn[w, t], tn[w, t]))
+
+    if out:
+        with open(out, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["set", "threshold", "precision", "recall", "f1", "tp", "fp", "fn", "tn", "weights"])
+            for w in range(len(weights)):
+                weights_json = json.dumps(dict(zip(names, weights[w].tolist())))
+                for t in range(len(grid)):
+                    writer.writerow([w, f"{grid[t]:g}", f"{precision[w, t]:.4f}", f"{recall[w, t]:.4f}",
+                                     f"{f1[w, t]:.4f}", int(tp[w, t]), int(fp[w, t]), int(fn[w, t]),
+                                     int(tn[w, t]), weights_json])
+        print(f"\nAll {tp.size:,} settings written to {out}")
+
+
+# --- COMMAND LINE ---
+def add_arguments(parser):
+    """Adds --sweep and its options to a harness's argparse parser."""
+    parser.add_argument("--sweep", nargs="+", metavar="CSV", help="Don't fetch: try rule weights and thresholds against reviewed result CSVs")
+    parser.add_argument("--random", type=int, default=DEFAULT_RANDOM, metavar="N", help=f"With --sweep: random weight sets to try (default {DEFAULT_RANDOM})")
+    parser.add_argument("--thresholds", default=DEFAULT_THRESHOLDS, help=f"With --sweep: start:stop:step or a comma list (default {DEFAULT_THRESHOLDS})")
+    parser.add_argument("--metric", choices=("f1", "precision", "recall"), default="f1", help="With --sweep: what to rank by")
+    parser.add_argument("--top", type=int, default=10, help="With --sweep: settings to show")
+    parser.add_argument("--out", metavar="CSV", help="With --sweep: also write every setting to this file")
+
+
+def main(args, ruleset, code_weights):
+    """
+    Runs the sweep for parsed add_arguments() options: the units of
+    `ruleset` (a rules.Ruleset) plus the harness's `code_weights`
+    ({name: weight} for the checks written in code).
+    """
+    if np is None:
+        raise SystemExit("The sweep needs numpy: pip install numpy")
+    sweep(args.sweep, ruleset.features() + list(code_weights.items()), ruleset.threshold,
+          args.random, args.thresholds, args.metric, args.top, args.out)
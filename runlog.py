@@ -0,0 +1,140 @@
+"""
+Streaming run log.
+
+Rows are appended to disk as soon as each message is decided, instead of
+being collected in a list and written with pandas at the end, so a crash
+late in a long backfill loses at most the last few unflushed rows and
+memory stays flat. The file can be tailed while the run is going.
+
+The format follows the extension: ".jsonl" writes one JSON object per
+line, anything else CSV with a header (only when the file is new, so
+appending to a daily log works). The path may contain strftime codes
+(e.g. "gatekeeper_log_%Y%m%d.csv"); when the formatted name changes, the
+log moves on to the new file. With max_bytes, a file that grows past it is
+continued in "name.1.csv", "name.2.csv", ... The same happens to an
+existing file with other columns (another script's log of the same name):
+it is never appended to.
+"""
+import csv
+import io
+import json
+import os
+import time
+from datetime import datetime
+
+FLUSH_EVERY = 20  # Rows between flushes
+FLUSH_INTERVAL = 5.0  # ...or seconds, whichever comes first
+
+
+class RunLog:
+    """Append-only CSV/JSONL writer with periodic flush and rotation."""
+
+    def __init__(self, path, columns, max_bytes=None, flush_every=FLUSH_EVERY,
+                 flush_interval=FLUSH_INTERVAL, fsync=True):
+        self.pattern = path
+        self.columns = list(columns)
+        self.max_bytes = max_bytes
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.jsonl = path.lower().endswith(".jsonl")
+        self.rows = 0
+        self.path = None
+        self._base = None
+        self._part = 0
+        self._file = None
+        self._size = 0
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+
+    def _part_path(self, part):
+        if not part:
+            return self._base
+        stem, ext = os.path.splitext(self._base)
+        return f"{stem}.{part}{ext}"
+
+    def _same_columns(self, path):
+        """True if `path` is new, empty, or was written with this log's columns."""
+        try:
+            with open(path, newline="", encoding="utf-8") as f:
+                first = f.readline()
+        except FileNotFoundError:
+            return True
+        except (OSError, UnicodeDecodeError):
+            return False
+        if not first:
+            return True
+        if self.jsonl:
+            try:
+                return list(json.loads(first)) == self.columns
+            except (ValueError, TypeError):
+                return False
+        return first == self._format([self.columns])
+
+    def _open(self):
+        self.close()
+        path = self._part_path(self._part)
+        # Continue a rotated series left by an earlier run where it ended
+        while True:
+            if self.max_bytes and os.path.exists(path) and os.path.getsize(path) >= self.max_bytes:
+                pass  # Full
+            elif not self._same_columns(path):
+                print(f"   [WARN] {path} has other columns, continuing in the next part")
+            else:
+                break
+            self._part += 1
+            path = self._part_path(self._part)
+        self._size = os.path.getsize(path) if os.path.exists(path) else 0
+        self._file = open(path, "a", newline="", encoding="utf-8")
+        self.path = path
+        if not self.jsonl and not self._size:
+            self._write_text(self._format([self.columns]))
+
+    def _format(self, rows):
+        buf = io.StringIO()
+        csv.writer(buf, lineterminator="\n").writerows(rows)
+        return buf.getvalue()
+
+    def _write_text(self, text):
+        self._file.write(text)
+        self._size += len(text.encode("utf-8"))
+
+    def write(self, row):
+        """Appends one row (a dict keyed by the log's columns)."""
+        base = datetime.now().strftime(self.pattern)
+        if base != self._base:
+            self._base, self._part = base, 0
+            self._open()
+        elif self.max_bytes and self._size >= self.max_bytes:
+            self._part += 1
+            self._open()
+
+        if self.jsonl:
+            self._write_text(json.dumps({c: row.get(c, "") for c in self.columns}, ensure_ascii=False) + "\n")
+        else:
+            self._write_text(self._format([[row.get(c, "") for c in self.columns]]))
+        self.rows += 1
+        self._unflushed += 1
+        if self._unflushed >= self.flush_every or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._file is None:
+            return
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
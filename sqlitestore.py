@@ -0,0 +1,60 @@
+"""
+Shared plumbing of the SQLite-backed stores (llmcache, reputation,
+challenges, dispatcher).
+
+Each store is one connection opened for use from any thread, in WAL mode
+so several processes (a daemon and a one-shot run) can share the file,
+behind one lock. Registry hands out one store per path for the whole
+process:
+
+    class VerdictCache(sqlitestore.Store):
+        def __init__(self, path):
+            super().__init__(path, ["CREATE TABLE IF NOT EXISTS verdicts (...)"])
+
+    _caches = sqlitestore.Registry()
+
+    def open_cache(path):
+        return _caches.get(path, lambda: VerdictCache(path))
+"""
+import sqlite3
+import threading
+
+BUSY_TIMEOUT = 30  # Seconds to wait for another process's write lock
+
+
+def connect(path, schema=()):
+    """Opens `path` for use from any thread, in WAL mode, and runs the `schema` statements."""
+    db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    for statement in schema:
+        db.execute(statement)
+    db.commit()
+    return db
+
+
+class Store:
+    """Base of the stores: self._db, guarded by self._lock. Safe to share between threads."""
+
+    def __init__(self, path, schema=()):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = connect(path, schema)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class Registry:
+    """Process-wide instances by path, each created on first use."""
+
+    def __init__(self):
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, path, factory):
+        """The instance for `path`, calling factory() to create it the first time."""
+        with self._lock:
+            if path not in self._items:
+                self._items[path] = factory()
+            return self._items[path]
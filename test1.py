@@ -1,12 +1,16 @@
+import argparse
 import imaplib
-import email
-from email.header import decode_header
-import openai
-import pandas as pd
-import html2text
+import json
 import re
 import os
 from datetime import datetime
+import decision
+import mailsource
+import rules
+import rulesweep
+import llmcache
+import llmclient
+import runlog
 
 # ================= CONFIGURATION =================
 # GMAIL SETTINGS
@@ -17,132 +21,127 @@ EMAIL_COUNT = 40  # How many recent emails to test
 
 # OPENAI SETTINGS
 OPENAI_API_KEY = "sk-......" # Your OpenAI Key
-openai.api_key = OPENAI_API_KEY
+LLM_MODEL = "gpt-4o-mini"  # Cost effective model
+LLM_PROMPT_VERSION = "spam-ham-v2"  # Bump when you edit the prompt (invalidates cached verdicts)
+LLM_BATCH_PROMPT_VERSION = "spam-ham-batch-v1"
+LLM_BATCH_SIZE = 10  # Emails per request (1 = one request per email)
+LLM_CACHE_FILE = "llm_cache.sqlite3"  # Verdicts are reused across runs
+LLM_CONCURRENCY = 8  # Parallel API requests
+LLM_REQUESTS_PER_MINUTE = 500  # Stay under your account's rate limits
+LLM_TOKENS_PER_MINUTE = 200000
 
 # OUTPUT FILE
 OUTPUT_FILE = f"spam_test_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+OUTPUT_COLUMNS = ["From", "Subject", "Body_Snippet", "Traditional_Prediction", "Traditional_Reason",
+                  "LLM_Prediction", "LLM_Reason", "Human_Review", "Trigger_Hits"]
+
+# RULES (trigger words, weights and the threshold are in rules.json, "spam_score")
+CODE_WEIGHTS = {"Subject is ALL CAPS": 3}  # Heuristics scored in this script; --sweep varies them too
 # =================================================
 
 def clean_email_body(msg):
     """Extracts and cleans text from email, removing HTML."""
-    body = ""
-    if msg.is_multipart():
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            content_disposition = str(part.get("Content-Disposition"))
-            try:
-                if "attachment" not in content_disposition:
-                    payload = part.get_payload(decode=True)
-                    if payload:
-                        if content_type == "text/plain":
-                            body += payload.decode()
-                        elif content_type == "text/html":
-                            h = html2text.HTML2Text()
-                            h.ignore_links = False
-                            body += h.handle(payload.decode())
-            except:
-                pass
-    else:
-        try:
-            payload = msg.get_payload(decode=True)
-            if msg.get_content_type() == "text/html":
-                h = html2text.HTML2Text()
-                body = h.handle(payload.decode())
-            else:
-                body = payload.decode()
-        except:
-            pass
-            
     # Truncate to save tokens and processing time (first 1000 chars)
-    return body[:1000].strip()
+    return decision.clean_email_body(msg, limit=1000, ignore_links=False)
 
 # --- METHOD 1: TRADITIONAL (Heuristic / Rule Based) ---
 def traditional_spam_filter(subject, body):
     """
     A logic-based filter representing traditional SpamAssassin-style scoring.
+    Trigger words, weights and the threshold live in rules.json ("spam_score").
     """
-    score = 0
-    reasons = []
-    
+    ruleset = rules.get_ruleset("spam_score")
+
     # Normalize
     text = (str(subject) + " " + str(body)).lower()
     
-    # 1. Trigger Words (Weighted)
-    triggers = {
-        "verify your account": 3, "urgent": 2, "winner": 4, 
-        "lottery": 5, "inheritance": 4, "bank account": 2, 
-        "click here": 1, "unsubscribe": 0.5, "offer": 1, 
-        "limited time": 2, "crypto": 3, "investment": 2, "free": 2
-    }
-    
-    for word, weight in triggers.items():
-        if word in text:
-            score += weight
-            reasons.append(f"Contains '{word}'")
+    # 1. Trigger Words (Weighted), "!!!" and "$" in subject
+    units = ruleset.hits(text=text, subject=str(subject))
 
     # 2. Heuristics
     if subject.isupper():
-        score += 3
-        reasons.append("Subject is ALL CAPS")
-        
-    if "!" * 3 in text:
-        score += 2
-        reasons.append("Excessive exclamation marks")
-
-    if "$" in subject:
-        score += 2
-        reasons.append("Money symbol in subject")
+        name = "Subject is ALL CAPS"
+        units.append((name, CODE_WEIGHTS[name], name))
 
     # Classification Threshold
-    is_spam = score >= 4
+    score = sum(weight for _, weight, _ in units)
+    reasons = [reason for _, _, reason in units]
+    is_spam = score >= ruleset.threshold
     return {
         "method": "Traditional",
         "is_spam": is_spam,
         "score": score,
-        "reason": "; ".join(reasons) if reasons else "Clean"
+        "reason": "; ".join(reasons) if reasons else "Clean",
+        "hits": [name for name, _, _ in units]  # Kept in the CSV for --sweep
     }
 
 # --- METHOD 2: LLM (OpenAI GPT-4o-mini or GPT-3.5) ---
-def llm_spam_filter(subject, body):
-    """
-    Uses an LLM to analyze context, tone, and intent.
-    """
-    client = openai.Client(api_key=OPENAI_API_KEY)
-    
-    prompt = f"""
+SPAM_RULES = """
+    Rules:
+    - Look for phishing attempts, urgent fake requests, and unsolicited marketing.
+    - Newsletters from reputable companies are HAM.
+    - Personal emails are HAM.
+""".strip()
+
+SPAM_CHECK_INSTRUCTIONS = "For each email, determine if it is SPAM or HAM (Legitimate).\n" + SPAM_RULES  # Batch prompt
+
+def spam_prompt(subject, body):
+    return f"""
     Analyze the following email and determine if it is SPAM or HAM (Legitimate).
     
     Subject: {subject}
     Body snippet: {body}
     
-    Rules:
-    - Look for phishing attempts, urgent fake requests, and unsolicited marketing.
-    - Newsletters from reputable companies are HAM.
-    - Personal emails are HAM.
+    {SPAM_RULES}
     
     Respond in this exact format:
     CLASSIFICATION: [SPAM or HAM]
     REASON: [Short explanation]
     """
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini", # Cost effective model
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0
-        )
-        content = response.choices[0].message.content
-        
-        is_spam = "CLASSIFICATION: SPAM" in content
-        reason = content.split("REASON:")[1].strip() if "REASON:" in content else content
-        
-        return {
-            "method": "LLM",
-            "is_spam": is_spam,
-            "reason": reason
-        }
-    except Exception as e:
-        return {"method": "LLM", "is_spam": False, "reason": f"Error: {str(e)}"}
+def spam_check():
+    """The LLM check with the current settings (see llmclient.Classifier)."""
+    return llmclient.Classifier(
+        spam_prompt, SPAM_CHECK_INSTRUCTIONS, "CLASSIFICATION", ("SPAM", "HAM"),
+        lambda label, reason: {"method": "LLM", "is_spam": label == "SPAM", "reason": reason},
+        LLM_MODEL, OPENAI_API_KEY, LLM_PROMPT_VERSION, LLM_BATCH_PROMPT_VERSION, LLM_CACHE_FILE,
+        LLM_BATCH_SIZE, LLM_CONCURRENCY, llmclient.get_limiter(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE)
+    )
+
+def llm_spam_filter(subject, body):
+    """
+    Uses an LLM to analyze context, tone, and intent.
+    Verdicts are cached on disk (see llmcache); errors return None and are not cached.
+    """
+    return spam_check().classify(subject, body)
+
+def llm_spam_filter_batch(emails):
+    """
+    llm_spam_filter() for a list of (subject, body) pairs, LLM_BATCH_SIZE
+    emails per request. Emails without a valid verdict in the batch reply
+    are asked one by one. Returns results in order.
+    """
+    results = spam_check().classify_many(emails)
+    # is_spam None: logged with an empty LLM_Prediction, so it never passes for a HAM label
+    return [result or {"method": "LLM", "is_spam": None, "reason": "Error: no LLM verdict"} for result in results]
+
+# --- BOTH METHODS ON EVERY EMAIL ---
+# Neither stage decides anything (see decision.py): each records its result
+# on the email and the row shows them side by side.
+def run_traditional(email):
+    email.results["traditional"] = traditional_spam_filter(email.subject, email.body)
+
+def run_llm(emails):
+    print(f"\nRunning LLM filter on {len(emails)} emails...")
+    results = llm_spam_filter_batch([(email.subject, email.body) for email in emails])
+    for email, result in zip(emails, results):
+        email.results["llm"] = result
+    return [None] * len(emails)
+
+METHODS = decision.Pipeline([
+    decision.Stage("traditional", 10, run_traditional, uses_body=True),
+    decision.Stage("llm", 1000, batch=run_llm),  # LLM_BATCH_SIZE * LLM_CONCURRENCY emails at a time
+])
 
 # --- MAIN EXECUTION ---
 def main():
@@ -157,62 +156,42 @@ def main():
         return
 
     mail.select("inbox")
-    
-    # Fetch last N emails
-    status, messages = mail.search(None, "ALL")
-    email_ids = messages[0].split()
-    latest_email_ids = email_ids[-EMAIL_COUNT:]
-
-    results = []
-
-    print(f"Processing last {len(latest_email_ids)} emails...")
-
-    for i, e_id in enumerate(latest_email_ids):
-        try:
-            _, msg_data = mail.fetch(e_id, "(RFC822)")
-            for response_part in msg_data:
-                if isinstance(response_part, tuple):
-                    msg = email.message_from_bytes(response_part[1])
-                    
-                    # Decode Subject
-                    subject, encoding = decode_header(msg["Subject"])[0]
-                    if isinstance(subject, bytes):
-                        subject = subject.decode(encoding if encoding else "utf-8")
-                    
-                    sender = msg.get("From")
-                    body = clean_email_body(msg)
-
-                    print(f"[{i+1}/{EMAIL_COUNT}] Analyzing: {subject[:30]}...")
-
-                    # Run Method 1
-                    trad_result = traditional_spam_filter(subject, body)
-                    
-                    # Run Method 2
-                    llm_result = llm_spam_filter(subject, body)
-
-                    # Store Results
-                    results.append({
-                        "From": sender,
-                        "Subject": subject,
-                        "Body_Snippet": body[:100],
-                        "Traditional_Prediction": "SPAM" if trad_result['is_spam'] else "HAM",
-                        "Traditional_Reason": trad_result['reason'],
-                        "LLM_Prediction": "SPAM" if llm_result['is_spam'] else "HAM",
-                        "LLM_Reason": llm_result['reason'],
-                        "Human_Review": "" # Blank column for you to fill in
-                    })
-
-        except Exception as e:
-            print(f"Skipping email due to error: {e}")
-
-    # Save to CSV
-    df = pd.DataFrame(results)
-    df.to_csv(OUTPUT_FILE, index=False)
-    
+
+    print(f"Processing last {EMAIL_COUNT} emails...")
+
+    # Rows are written as soon as their LLM verdict is in
+    with runlog.RunLog(OUTPUT_FILE, OUTPUT_COLUMNS) as log:
+        def write_row(i, email, verdict):
+            print(f"[{i+1}/{EMAIL_COUNT}] Analyzing: {email.subject[:30]}...")
+            trad_result, llm_result = email.results["traditional"], email.results["llm"]
+            log.write({
+                "From": email.raw_sender,
+                "Subject": email.subject,
+                "Body_Snippet": email.body[:100],
+                "Traditional_Prediction": "SPAM" if trad_result['is_spam'] else "HAM",
+                "Traditional_Reason": trad_result['reason'],
+                "LLM_Prediction": "" if llm_result['is_spam'] is None else ("SPAM" if llm_result['is_spam'] else "HAM"),
+                "LLM_Reason": llm_result['reason'],
+                "Human_Review": "", # Blank column for you to fill in
+                "Trigger_Hits": json.dumps(trad_result["hits"]),
+            })
+
+        # Last N emails; Method 2 runs in chunks of LLM_BATCH_SIZE * LLM_CONCURRENCY
+        source = mailsource.IMAPSource(mail, "inbox", None, EMAIL_COUNT)
+        decision.scan(source, METHODS, write_row, clean_email_body, LLM_BATCH_SIZE * LLM_CONCURRENCY)
+
     mail.close()
     mail.logout()
+    print(llmcache.open_cache(LLM_CACHE_FILE).stats())
     print(f"\nDone! Results saved to {OUTPUT_FILE}")
     print("Open the CSV file to review the 'Traditional' vs 'LLM' verdicts.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Traditional vs LLM spam test")
+    rulesweep.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.sweep:
+        rulesweep.main(args, rules.get_ruleset("spam_score"), CODE_WEIGHTS)
+    else:
+        main()
\ No newline at end of file
@@ -1,12 +1,16 @@
+import argparse
 import imaplib
-import email
-from email.header import decode_header
-import openai
-import pandas as pd
-import html2text
+import json
 import re
 import os
 from datetime import datetime
+import decision
+import mailsource
+import rules
+import rulesweep
+import llmcache
+import llmclient
+import runlog
 
 # ================= CONFIGURATION =================
 # GMAIL SETTINGS
@@ -18,49 +22,37 @@ EMAIL_COUNT = 40  # How many recent emails to test
 
 # OPENAI SETTINGS
 OPENAI_API_KEY = "sk-......" # Your OpenAI Key
-openai.api_key = OPENAI_API_KEY
+LLM_MODEL = "gpt-4o-mini"
+LLM_PROMPT_VERSION = "paranoid-spam-ham-v2"  # Bump when you edit the prompt (invalidates cached verdicts)
+LLM_BATCH_PROMPT_VERSION = "paranoid-spam-ham-batch-v1"
+LLM_BATCH_SIZE = 10  # Emails per request (1 = one request per email)
+LLM_CACHE_FILE = "llm_cache.sqlite3"  # Verdicts are reused across runs
+LLM_CONCURRENCY = 8  # Parallel API requests
+LLM_REQUESTS_PER_MINUTE = 500  # Stay under your account's rate limits
+LLM_TOKENS_PER_MINUTE = 200000
 
 # OUTPUT FILE
 OUTPUT_FILE = f"paranoid_spam_test_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+OUTPUT_COLUMNS = ["From", "Subject", "Body_Snippet", "Traditional_Prediction", "Traditional_Reason",
+                  "LLM_Prediction", "LLM_Reason", "Human_Review", "Trigger_Hits"]
+
+# RULES (trigger words, weights and the threshold are in rules.json, "paranoid_spam_score")
+CODE_WEIGHTS = {"Technical Header: List-Unsubscribe found": 5}  # Heuristics scored in this script; --sweep varies them too
 # =================================================
 
 def clean_email_body(msg):
     """Extracts and cleans text from email, removing HTML."""
-    body = ""
-    if msg.is_multipart():
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            try:
-                payload = part.get_payload(decode=True)
-                if payload:
-                    if content_type == "text/plain":
-                        body += payload.decode()
-                    elif content_type == "text/html":
-                        h = html2text.HTML2Text()
-                        h.ignore_links = True # Ignore links to focus on text
-                        body += h.handle(payload.decode())
-            except:
-                pass
-    else:
-        try:
-            payload = msg.get_payload(decode=True)
-            if msg.get_content_type() == "text/html":
-                h = html2text.HTML2Text()
-                body = h.handle(payload.decode())
-            else:
-                body = payload.decode()
-        except:
-            pass
-            
-    return body[:1500].strip() # Slightly larger buffer for context
+    return decision.clean_email_body(msg, limit=1500, ignore_links=True) # Slightly larger buffer for context
 
 # --- METHOD 1: PARANOID TRADITIONAL (Heuristic) ---
 def traditional_spam_filter(msg, subject, body):
     """
     Flags ANYTHING that looks automated, corporate, or mass-mailed.
+    Sender patterns, trigger lists and the threshold live in rules.json
+    ("paranoid_spam_score").
     """
-    score = 0
-    reasons = []
+    ruleset = rules.get_ruleset("paranoid_spam_score")
+    units = []
     
     # Normalize text
     text = (str(subject) + " " + str(body)).lower()
@@ -69,89 +61,98 @@ def traditional_spam_filter(msg, subject, body):
     # 1. TECHNICAL HEADER CHECK (The smoking gun for automation)
     # Almost all newsletters, alerts, and marketing tools add this header.
     if msg.get("List-Unsubscribe"):
-        score += 5
-        reasons.append("Technical Header: List-Unsubscribe found")
+        name = "Technical Header: List-Unsubscribe found"
+        units.append((name, CODE_WEIGHTS[name], name))
 
     # 2. SENDER CHECKS
-    bad_senders = ["no-reply", "noreply", "newsletter", "info@", "support@", "marketing", "sales", "hello@"]
-    for bs in bad_senders:
-        if bs in sender:
-            score += 3
-            reasons.append(f"Generic sender: '{bs}'")
-
     # 3. CORPORATE FOOTER LANGUAGE
     # Real humans don't usually put copyright notices in emails to friends.
-    corporate_triggers = [
-        "privacy policy", "terms of service", "all rights reserved", 
-        "view in browser", "unsubscribe", "manage preferences", 
-        "copyright", "inc.", "llc"
-    ]
-    
-    found_triggers = [t for t in corporate_triggers if t in text]
-    if found_triggers:
-        score += 3
-        reasons.append(f"Corporate footer detected ({found_triggers[0]})")
-
     # 4. TRANSACTIONAL WORDS
     # Catching receipts and alerts
-    trans_triggers = ["order confirmation", "receipt", "invoice", "verify your email", "security alert"]
-    for t in trans_triggers:
-        if t in text:
-            score += 2
-            reasons.append(f"Transactional language: '{t}'")
+    units += ruleset.hits(sender=sender, text=text)
 
     # STRICT THRESHOLD: Even a score of 2 (one minor trigger) flags it.
-    is_spam = score >= 2
+    score = sum(weight for _, weight, _ in units)
+    reasons = [reason for _, _, reason in units]
+    is_spam = score >= ruleset.threshold
     
     return {
         "method": "Traditional (Paranoid)",
         "is_spam": is_spam,
         "score": score,
-        "reason": "; ".join(reasons) if reasons else "Clean (Likely Personal)"
+        "reason": "; ".join(reasons) if reasons else "Clean (Likely Personal)",
+        "hits": [name for name, _, _ in units]  # Kept in the CSV for --sweep
     }
 
 # --- METHOD 2: PARANOID LLM (Contextual Zero-Trust) ---
-def llm_spam_filter(subject, body):
-    """
-    Uses LLM with strict instructions to flag ANY non-personal email.
-    """
-    client = openai.Client(api_key=OPENAI_API_KEY)
-    
-    prompt = f"""
-    Analyze the following email.
-    
-    Subject: {subject}
-    Body snippet: {body}
-    
+SPAM_RULES = """
     STRICT "PERSONAL-ONLY" FILTERING RULES:
     1. The goal is to identify "Graymail" and "Machine Generated" mail.
     2. If the email is a Newsletter, Advertisement, Receipt, Security Alert, Shipping Notification, or Business Update: Classify as SPAM.
     3. If the email is a generic "No-Reply" notification: Classify as SPAM.
     4. The ONLY emails classified as HAM should be personal, hand-written correspondence between two humans (e.g., "Hey, do you want to grab lunch?").
+""".strip()
+
+SPAM_CHECK_INSTRUCTIONS = "Classify each email as SPAM or HAM.\n" + SPAM_RULES  # Batch prompt
+
+def spam_prompt(subject, body):
+    return f"""
+    Analyze the following email.
+    
+    Subject: {subject}
+    Body snippet: {body}
+    
+    {SPAM_RULES}
     
     Respond in this exact format:
     CLASSIFICATION: [SPAM or HAM]
     REASON: [Short explanation]
     """
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini", 
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0
-        )
-        content = response.choices[0].message.content
-        
-        is_spam = "CLASSIFICATION: SPAM" in content
-        reason = content.split("REASON:")[1].strip() if "REASON:" in content else content
-        
-        return {
-            "method": "LLM",
-            "is_spam": is_spam,
-            "reason": reason
-        }
-    except Exception as e:
-        return {"method": "LLM", "is_spam": False, "reason": f"Error: {str(e)}"}
+def spam_check():
+    """The LLM check with the current settings (see llmclient.Classifier)."""
+    return llmclient.Classifier(
+        spam_prompt, SPAM_CHECK_INSTRUCTIONS, "CLASSIFICATION", ("SPAM", "HAM"),
+        lambda label, reason: {"method": "LLM", "is_spam": label == "SPAM", "reason": reason},
+        LLM_MODEL, OPENAI_API_KEY, LLM_PROMPT_VERSION, LLM_BATCH_PROMPT_VERSION, LLM_CACHE_FILE,
+        LLM_BATCH_SIZE, LLM_CONCURRENCY, llmclient.get_limiter(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE)
+    )
+
+def llm_spam_filter(subject, body):
+    """
+    Uses LLM with strict instructions to flag ANY non-personal email.
+    Verdicts are cached on disk (see llmcache); errors return None and are not cached.
+    """
+    return spam_check().classify(subject, body)
+
+def llm_spam_filter_batch(emails):
+    """
+    llm_spam_filter() for a list of (subject, body) pairs, LLM_BATCH_SIZE
+    emails per request. Emails without a valid verdict in the batch reply
+    are asked one by one. Returns results in order.
+    """
+    results = spam_check().classify_many(emails)
+    # is_spam None: logged with an empty LLM_Prediction, so it never passes for a HAM label
+    return [result or {"method": "LLM", "is_spam": None, "reason": "Error: no LLM verdict"} for result in results]
+
+# --- BOTH METHODS ON EVERY EMAIL ---
+# Neither stage decides anything (see decision.py): each records its result
+# on the email and the row shows them side by side.
+def run_traditional(email):
+    # Method 1 gets the 'msg' object too, for header analysis
+    email.results["traditional"] = traditional_spam_filter(email.msg, email.subject, email.body)
+
+def run_llm(emails):
+    print(f"\nRunning LLM filter on {len(emails)} emails...")
+    results = llm_spam_filter_batch([(email.subject, email.body) for email in emails])
+    for email, result in zip(emails, results):
+        email.results["llm"] = result
+    return [None] * len(emails)
+
+METHODS = decision.Pipeline([
+    decision.Stage("traditional", 10, run_traditional, uses_body=True),
+    decision.Stage("llm", 1000, batch=run_llm),  # LLM_BATCH_SIZE * LLM_CONCURRENCY emails at a time
+])
 
 # --- MAIN EXECUTION ---
 def main():
@@ -165,60 +166,41 @@ def main():
         return
 
     mail.select("inbox")
-    
-    # Fetch last N emails
-    status, messages = mail.search(None, "ALL")
-    email_ids = messages[0].split()
-    latest_email_ids = email_ids[-EMAIL_COUNT:]
-
-    results = []
-
-    print(f"Processing last {len(latest_email_ids)} emails with PARANOID settings...")
-
-    for i, e_id in enumerate(latest_email_ids):
-        try:
-            _, msg_data = mail.fetch(e_id, "(RFC822)")
-            for response_part in msg_data:
-                if isinstance(response_part, tuple):
-                    msg = email.message_from_bytes(response_part[1])
-                    
-                    # Decode Subject
-                    subject, encoding = decode_header(msg["Subject"])[0]
-                    if isinstance(subject, bytes):
-                        subject = subject.decode(encoding if encoding else "utf-8")
-                    
-                    sender = msg.get("From")
-                    body = clean_email_body(msg)
-
-                    print(f"[{i+1}/{EMAIL_COUNT}] Analyzing: {subject[:30]}...")
-
-                    # Run Method 1 (Now passing 'msg' object for header analysis)
-                    trad_result = traditional_spam_filter(msg, subject, body)
-                    
-                    # Run Method 2
-                    llm_result = llm_spam_filter(subject, body)
-
-                    # Store Results
-                    results.append({
-                        "From": sender,
-                        "Subject": subject,
-                        "Body_Snippet": body[:100].replace("\n", " "),
-                        "Traditional_Prediction": "SPAM" if trad_result['is_spam'] else "HAM",
-                        "Traditional_Reason": trad_result['reason'],
-                        "LLM_Prediction": "SPAM" if llm_result['is_spam'] else "HAM",
-                        "LLM_Reason": llm_result['reason'],
-                        "Human_Review": "" 
-                    })
-
-        except Exception as e:
-            print(f"Skipping email due to error: {e}")
-
-    # Save to CSV
-    df = pd.DataFrame(results)
-    df.to_csv(OUTPUT_FILE, index=False)
-    
+
+    print(f"Processing last {EMAIL_COUNT} emails with PARANOID settings...")
+
+    # Rows are written as soon as their LLM verdict is in
+    with runlog.RunLog(OUTPUT_FILE, OUTPUT_COLUMNS) as log:
+        def write_row(i, email, verdict):
+            print(f"[{i+1}/{EMAIL_COUNT}] Analyzing: {email.subject[:30]}...")
+            trad_result, llm_result = email.results["traditional"], email.results["llm"]
+            log.write({
+                "From": email.raw_sender,
+                "Subject": email.subject,
+                "Body_Snippet": email.body[:100].replace("\n", " "),
+                "Traditional_Prediction": "SPAM" if trad_result['is_spam'] else "HAM",
+                "Traditional_Reason": trad_result['reason'],
+                "LLM_Prediction": "" if llm_result['is_spam'] is None else ("SPAM" if llm_result['is_spam'] else "HAM"),
+                "LLM_Reason": llm_result['reason'],
+                "Human_Review": "",
+                "Trigger_Hits": json.dumps(trad_result["hits"]),
+            })
+
+        # Last N emails; Method 2 runs in chunks of LLM_BATCH_SIZE * LLM_CONCURRENCY
+        source = mailsource.IMAPSource(mail, "inbox", None, EMAIL_COUNT)
+        decision.scan(source, METHODS, write_row, clean_email_body, LLM_BATCH_SIZE * LLM_CONCURRENCY)
+
     mail.close()
     mail.logout()
+    print(llmcache.open_cache(LLM_CACHE_FILE).stats())
     print(f"\nDone! Results saved to {OUTPUT_FILE}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Paranoid traditional vs LLM spam test")
+    rulesweep.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.sweep:
+        rulesweep.main(args, rules.get_ruleset("paranoid_spam_score"), CODE_WEIGHTS)
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,51 @@
+"""
+Sender reputation: domains are only judged on evidence about the domain.
+
+    python -m pytest tests
+"""
+import os
+import sys
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import reputation
+
+
+def test_new_gmail_human_is_not_judged_by_domain():
+    store = reputation.ReputationStore(":memory:")
+    for i in range(10):
+        store.record(f"poster{i}@gmail.com", is_bot=True)
+    store.record("friend@gmail.com", is_bot=False)
+
+    assert store.lookup("brand.new.human@gmail.com") == (None, "")
+
+
+def test_list_header_votes_do_not_count_for_the_domain():
+    store = reputation.ReputationStore(":memory:")
+    for i in range(12):
+        store.record(f"member{i}@example.org", is_bot=True, domain=False)
+
+    assert store.lookup("someone.new@example.org") == (None, "")
+    assert store.lookup("member0@example.org")[0] is None  # One verdict each: not enough either
+
+
+def test_domain_needs_several_bot_addresses():
+    store = reputation.ReputationStore(":memory:")
+    for _ in range(12):
+        store.record("news@shop.example", is_bot=True)
+    assert store.lookup("offers@shop.example") == (None, "")
+
+    for name in ("offers", "deals"):
+        store.record(f"{name}@shop.example", is_bot=True)
+    verdict, reason = store.lookup("promo@shop.example")
+    assert verdict == "bot"
+    assert "shop.example" in reason
+
+
+def test_repeat_sender_still_decided_by_address():
+    store = reputation.ReputationStore(":memory:")
+    for _ in range(3):
+        store.record("alice@gmail.com", is_bot=False)
+
+    assert store.lookup("alice@gmail.com")[0] == "human"
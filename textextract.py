@@ -0,0 +1,91 @@
+"""
+Size-bounded HTML to text conversion.
+
+Marketing HTML is often 100+ KB of nested tables, yet we only ever keep the
+first 1,000-1,500 characters of text. So instead of converting the whole
+document and truncating afterwards, we:
+  1. cut <head>, <style>, <script> and comments out with a regex (cheap),
+  2. cap the HTML we hand to the parser at MAX_HTML_CHARS,
+  3. stop the converter as soon as it has produced `limit` characters.
+
+Converters are reused per thread (and per ignore_links setting) instead of
+building a new html2text.HTML2Text for every part.
+"""
+import re
+import threading
+
+MAX_HTML_CHARS = 100_000  # Never feed the parser more than this
+MAX_RAW_HTML_CHARS = 4 * MAX_HTML_CHARS  # ...or the stripping regex more than this
+
+_STRIP_RE = re.compile(
+    r"<head\b.*?</head\s*>|<style\b.*?</style\s*>|<script\b.*?</script\s*>|<!--.*?-->",
+    re.IGNORECASE | re.DOTALL,
+)
+
+_local = threading.local()
+
+
+class _EnoughText(Exception):
+    """Raised from the output callback to stop the parser early."""
+
+
+class _CappedConverter:
+    """An html2text converter that stops once `limit` characters are out."""
+
+    def __init__(self, ignore_links):
+        self.ignore_links = ignore_links
+        self.parts = []
+        self.size = 0
+        self.limit = 0
+        self._new_parser()
+
+    def _new_parser(self):
+        # bodywidth=0: no hard wrapping, so phrases like "privacy policy"
+        # are not split across lines before the keyword filters see them.
+        import html2text  # Deferred: plain-text mail never needs it
+        self.parser = html2text.HTML2Text(out=self._out, bodywidth=0)
+        self.parser.ignore_links = self.ignore_links
+
+    def _out(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.limit:
+            raise _EnoughText()
+
+    def convert(self, html, limit):
+        self.parts, self.size, self.limit = [], 0, limit
+        try:
+            self.parser.handle(html)
+        except _EnoughText:
+            # Parser state is mid-document now; don't reuse it.
+            self._new_parser()
+        except Exception:
+            self._new_parser()
+            raise
+        return "".join(self.parts)
+
+
+def _get_converter(ignore_links):
+    converters = getattr(_local, "converters", None)
+    if converters is None:
+        converters = _local.converters = {}
+    if ignore_links not in converters:
+        converters[ignore_links] = _CappedConverter(ignore_links)
+    return converters[ignore_links]
+
+
+def strip_noise(html):
+    """Removes <head>, <style>, <script> blocks and comments."""
+    return _STRIP_RE.sub(" ", html)
+
+
+def html_to_text(html, limit, ignore_links=True):
+    """
+    Converts HTML to text, doing only as much work as needed to produce about
+    `limit` characters. The result may run slightly past `limit`; callers
+    truncate as before.
+    """
+    if limit <= 0:
+        return ""
+    html = strip_noise(html[:MAX_RAW_HTML_CHARS])[:MAX_HTML_CHARS]
+    return _get_converter(ignore_links).convert(html, limit)
@@ -0,0 +1,183 @@
+"""
+Whitelist store backed by a plain text file (one entry per line).
+
+The file is read once into hash sets and only re-read when another process
+has changed it. Besides exact addresses it understands:
+
+    *@example.com      anyone at example.com
+    *@*.example.com    anyone at any subdomain of example.com
+
+Subdomain rules are kept in a suffix set, so a lookup costs one hash probe
+per label of the sender's domain. Additions are buffered in memory and
+written by flush(): under an exclusive lock file, the current file is
+re-read, the new entries are merged in and the result is written to a
+temporary file and renamed over the original. Concurrent runs therefore
+never interleave or lose lines.
+"""
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+LOCK_TIMEOUT = 30  # Seconds to wait for another process's flush
+
+
+# --- LOCKING ---
+class _FileLock:
+    """Exclusive inter-process lock on `<path>.lock`."""
+
+    def __init__(self, path, timeout=LOCK_TIMEOUT):
+        self.path = f"{path}.lock"
+        self.timeout = timeout
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, "a+")
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                if fcntl:
+                    fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    self._file.seek(0)
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_NBLCK, 1)
+                return self
+            except OSError:
+                if time.monotonic() >= deadline:
+                    self._file.close()
+                    raise TimeoutError(f"Could not lock {self.path} within {self.timeout}s")
+                time.sleep(0.05)
+
+    def __exit__(self, *exc):
+        try:
+            if fcntl:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._file.close()
+
+
+# --- STORE ---
+def normalize(entry):
+    return entry.strip().lower()
+
+
+class Whitelist:
+    """In-memory view of a whitelist file. `sender in whitelist` does the matching."""
+
+    def __init__(self, path):
+        self.path = path
+        self.addresses = set()
+        self.domains = set()  # *@example.com
+        self.suffixes = set()  # *@*.example.com, stored as "example.com"
+        self.pending = []  # Added but not flushed yet
+        self._stamp = None
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _read_lines(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return f.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+    def _index(self, entries):
+        addresses, domains, suffixes = set(), set(), set()
+        for entry in entries:
+            entry = normalize(entry)
+            if not entry or entry.startswith("#"):
+                continue
+            if entry.startswith("*@*."):
+                suffixes.add(entry[4:])
+            elif entry.startswith("*@"):
+                domains.add(entry[2:])
+            else:
+                addresses.add(entry)
+        return addresses, domains, suffixes
+
+    def refresh(self):
+        """Re-reads the file if it changed on disk since we last looked."""
+        with self._lock:
+            stamp = self._file_stamp()
+            if stamp == self._stamp:
+                return
+            lines = self._read_lines()
+            self.addresses, self.domains, self.suffixes = self._index(lines + self.pending)
+            self._stamp = stamp
+
+    def __contains__(self, sender):
+        sender = normalize(sender)
+        if sender in self.addresses:
+            return True
+        domain = sender.rpartition("@")[2]
+        if domain in self.domains:
+            return True
+        labels = domain.split(".")
+        return any(".".join(labels[i:]) in self.suffixes for i in range(1, len(labels)))
+
+    def __len__(self):
+        return len(self.addresses) + len(self.domains) + len(self.suffixes)
+
+    def add(self, entry):
+        """Buffers a new entry (address or wildcard rule); call flush() to write it."""
+        entry = normalize(entry)
+        with self._lock:
+            addresses, domains, suffixes = self._index([entry])
+            self.addresses |= addresses
+            self.domains |= domains
+            self.suffixes |= suffixes
+            self.pending.append(entry)
+
+    def flush(self):
+        """
+        Writes buffered additions: lock, re-read, merge, write-then-rename.
+        Returns the entries that were actually new on disk.
+        """
+        with self._lock:
+            if not self.pending:
+                return []
+            with _FileLock(self.path):
+                lines = self._read_lines()
+                on_disk = {normalize(line) for line in lines}
+                added = [e for e in dict.fromkeys(self.pending) if e not in on_disk]
+                if added:
+                    tmp_path = f"{self.path}.tmp"
+                    with open(tmp_path, "w", encoding="utf-8") as f:
+                        f.write("".join(f"{line}\n" for line in lines + added if line.strip()))
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp_path, self.path)
+                # Pick up whatever other processes added in the meantime too.
+                self.pending = []
+                self.addresses, self.domains, self.suffixes = self._index(lines + added)
+                self._stamp = self._file_stamp()
+            return added
+
+
+_whitelists = {}
+_whitelists_lock = threading.Lock()
+
+
+def open_whitelist(path):
+    """Returns the process-wide Whitelist for `path`, refreshed from disk if it changed."""
+    with _whitelists_lock:
+        if path not in _whitelists:
+            _whitelists[path] = Whitelist(path)
+            return _whitelists[path]
+    _whitelists[path].refresh()
+    return _whitelists[path]